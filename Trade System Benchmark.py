@@ -0,0 +1,653 @@
+import os
+import sys
+import json
+import time
+import random
+import sqlite3
+import argparse
+import platform
+import tempfile
+import subprocess
+import statistics
+import importlib.util
+import mysql.connector
+from contextlib import contextmanager, redirect_stdout
+from datetime import date, datetime, timedelta
+
+
+# Trade System Tools is loaded from the same directory (its filename is not importable)
+TOOLS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Trade System Tools.py')
+
+# Synthetic data sizes: number of trades and the dimension table sizes that go with them
+SCALES = {
+    '10k': {'trades': 10_000, 'brokers': 20, 'companies': 50, 'exchanges': 5, 'days': 365},
+    '1m': {'trades': 1_000_000, 'brokers': 200, 'companies': 500, 'exchanges': 10, 'days': 730},
+    '10m': {'trades': 10_000_000, 'brokers': 1000, 'companies': 2000, 'exchanges': 20, 'days': 1095}
+}
+
+# First day of generated trading history, rows inserted per statement and random seed
+START_DATE = datetime(2020, 1, 1)
+INSERT_BATCH_SIZE = 10000
+SEED = 42
+
+# Default MySQL database for generated data, kept apart from the real Trading_Platform
+BENCH_DATABASE = 'Trading_Platform_bench'
+
+# Command lines timed by the startup benchmark, by case name
+STARTUP_COMMANDS = {
+    'startup_cli_brokers': ['query', 'brokers'],
+    'startup_cli_trade': ['query', 'trade', '1']
+}
+
+# A run is flagged as a regression when its total time exceeds the baseline by this fraction
+REGRESSION_TOLERANCE = 0.20
+
+# Trading_Platform schema, in MySQL and SQLite dialects
+MYSQL_SCHEMA = (
+    """CREATE TABLE brokers (
+        broker_id INT PRIMARY KEY,
+        first_name VARCHAR(50) NOT NULL,
+        last_name VARCHAR(50) NOT NULL)""",
+    """CREATE TABLE companies (
+        company_id INT PRIMARY KEY,
+        name VARCHAR(100) NOT NULL,
+        place_id INT NOT NULL)""",
+    """CREATE TABLE shares (
+        share_id INT PRIMARY KEY,
+        company_id INT NOT NULL,
+        currency_id INT NOT NULL)""",
+    """CREATE TABLE shares_prices (
+        price_id INT PRIMARY KEY,
+        share_id INT NOT NULL,
+        price DECIMAL(12, 4) NOT NULL,
+        time_start DATETIME NOT NULL,
+        time_end DATETIME NOT NULL)""",
+    """CREATE TABLE stock_exchanges (
+        stock_ex_id INT PRIMARY KEY,
+        name VARCHAR(100) NOT NULL)""",
+    """CREATE TABLE trades (
+        trade_id INT PRIMARY KEY,
+        share_id INT NOT NULL,
+        broker_id INT NOT NULL,
+        stock_ex_id INT NOT NULL,
+        transaction_time DATETIME NOT NULL,
+        share_amount INT NOT NULL,
+        price_total DECIMAL(16, 4) NOT NULL)"""
+)
+SQLITE_SCHEMA = tuple(statement.replace('DATETIME', 'TIMESTAMP').replace('DECIMAL(12, 4)', 'REAL')
+                      .replace('DECIMAL(16, 4)', 'REAL') for statement in MYSQL_SCHEMA)
+TABLES = ('brokers', 'companies', 'shares', 'shares_prices', 'stock_exchanges', 'trades')
+
+
+##############################
+## Embedded SQLite Stand-in ##
+##############################
+
+
+class SQLiteCursor:
+    '''
+    Cursor over a SQLite connection that accepts the MySQL %s parameter style used by
+    Trade System Tools
+
+    SQLite errors are raised as mysql.connector errors so the tools' fallbacks still apply
+    '''
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, query, params=None):
+        try:
+            self.cursor.execute(query.replace('%s', '?'), tuple(params or ()))
+        except sqlite3.Error as errMsg:
+            raise mysql.connector.Error(msg=str(errMsg))
+
+    @property
+    def description(self):
+        return self.cursor.description
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchmany(self, size):
+        return self.cursor.fetchmany(size)
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def close(self):
+        self.cursor.close()
+
+
+class SQLiteConnection:
+    '''
+    SQLite connection exposing the subset of the pooled MySQL connection interface that
+    Trade System Tools uses
+    '''
+
+    unread_result = False
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(
+            path, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+
+    def cursor(self, **kwargs):
+        return SQLiteCursor(self.connection.cursor())
+
+    def consume_results(self):
+        pass
+
+    def start_transaction(self, readonly=False):
+        # SQLite has no read-only transactions, so refuse writes until the rollback instead
+        if readonly:
+            self.connection.execute('PRAGMA query_only = ON;')
+
+    def commit(self):
+        self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
+        self.connection.execute('PRAGMA query_only = OFF;')
+
+
+# SQLite stores dates and times as ISO strings, which compare in time order
+sqlite3.register_adapter(date, date.isoformat)
+sqlite3.register_adapter(datetime, lambda value: value.isoformat(' '))
+sqlite3.register_converter('TIMESTAMP', lambda value: datetime.fromisoformat(value.decode()))
+
+
+def use_sqlite(tools, path):
+    '''
+    Takes the loaded tools module and a SQLite database path
+    Routes every query the tools make to the SQLite database instead of MySQL
+    '''
+
+    connection = SQLiteConnection(path)
+
+    @contextmanager
+    def get_connection():
+        yield connection
+
+    tools.get_connection = get_connection
+
+
+#####################
+## Data Generation ##
+#####################
+
+
+def generate_rows(scale):
+    '''
+    Takes a scale name from SCALES
+    Yields (table, list of rows) pairs of deterministic synthetic data for every table
+    '''
+
+    sizes = SCALES[scale]
+    rng = random.Random(SEED)
+
+    yield 'brokers', [(broker_id, f'First{broker_id}', f'Last{broker_id}')
+                      for broker_id in range(1, sizes['brokers'] + 1)]
+    yield 'stock_exchanges', [(stock_ex_id, f'Exchange {stock_ex_id}')
+                              for stock_ex_id in range(1, sizes['exchanges'] + 1)]
+    yield 'companies', [(company_id, f'Company {company_id}', rng.randint(1, 20))
+                        for company_id in range(1, sizes['companies'] + 1)]
+    yield 'shares', [(share_id, share_id, rng.randint(1, 5))
+                     for share_id in range(1, sizes['companies'] + 1)]
+
+    # One price interval per share per day, following a random walk
+    prices = {}
+    rows = []
+    price_id = 0
+    for share_id in range(1, sizes['companies'] + 1):
+        price = rng.uniform(5, 500)
+        walk = []
+        for day in range(sizes['days']):
+            price = max(0.01, price * (1 + rng.gauss(0, 0.02)))
+            walk.append(round(price, 4))
+            price_id += 1
+            time_start = START_DATE + timedelta(days=day)
+            rows.append((price_id, share_id, walk[-1], time_start, time_start + timedelta(days=1)))
+
+            if len(rows) == INSERT_BATCH_SIZE:
+                yield 'shares_prices', rows
+                rows = []
+        prices[share_id] = walk
+    yield 'shares_prices', rows
+
+    # Trades in transaction_time order, priced at the share's price for that day
+    seconds = sizes['days'] * 86400
+    rows = []
+    for trade_id in range(1, sizes['trades'] + 1):
+        offset = min(seconds - 1, seconds * (trade_id - 1) // sizes['trades'] + rng.randrange(60))
+        share_id = rng.randint(1, sizes['companies'])
+        amount = rng.randint(1, 1000)
+        price = prices[share_id][offset // 86400]
+        rows.append((trade_id, share_id, rng.randint(1, sizes['brokers']),
+                     rng.randint(1, sizes['exchanges']), START_DATE + timedelta(seconds=offset),
+                     amount, round(amount * price, 4)))
+
+        if len(rows) == INSERT_BATCH_SIZE:
+            yield 'trades', rows
+            rows = []
+    yield 'trades', rows
+
+
+def generate(args):
+    '''
+    Creates the Trading_Platform tables in the benchmark database and fills them with
+    synthetic data at the requested scale, replacing any existing benchmark tables
+    '''
+
+    if args.backend == 'sqlite':
+        if os.path.exists(args.sqlite_path):
+            os.remove(args.sqlite_path)
+        connection = sqlite3.connect(args.sqlite_path)
+        schema = SQLITE_SCHEMA
+    else:
+        config = dict(load_tools().DB_CONFIG)
+        config.pop('database')
+        connection = mysql.connector.connect(**config)
+        setup_cursor = connection.cursor()
+        setup_cursor.execute(f'CREATE DATABASE IF NOT EXISTS `{args.database}`')
+        setup_cursor.execute(f'USE `{args.database}`')
+        for table in TABLES:
+            setup_cursor.execute(f'DROP TABLE IF EXISTS {table}')
+        setup_cursor.close()
+        schema = MYSQL_SCHEMA
+
+    insert_cursor = connection.cursor()
+    for statement in schema:
+        insert_cursor.execute(statement)
+
+    placeholder = '?' if args.backend == 'sqlite' else '%s'
+    counts = {}
+    started = time.perf_counter()
+
+    for table, rows in generate_rows(args.scale):
+        if not rows:
+            continue
+        values = ', '.join([placeholder] * len(rows[0]))
+        insert_cursor.executemany(f'INSERT INTO {table} VALUES ({values})', rows)
+        connection.commit()
+        counts[table] = counts.get(table, 0) + len(rows)
+
+    insert_cursor.close()
+    connection.close()
+
+    print(f"\n>>>>> Generated {args.scale} data in {time.perf_counter() - started:.1f}s: {counts}\n")
+    return 0
+
+
+################
+## Benchmarks ##
+################
+
+
+def load_tools():
+    '''
+    Loads Trade System Tools as a module without starting its menus
+    '''
+
+    spec = importlib.util.spec_from_file_location('trade_system_tools', TOOLS_PATH)
+    tools = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(tools)
+    return tools
+
+
+class TimedBatches:
+    '''
+    Wraps an iterable of row batches and records the time spent producing them
+    (i.e. executing and fetching) and the number of rows produced
+    '''
+
+    def __init__(self, batches):
+        self.batches = iter(batches)
+        self.seconds = 0.0
+        self.rows = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        started = time.perf_counter()
+        try:
+            batch = next(self.batches)
+        finally:
+            self.seconds += time.perf_counter() - started
+        self.rows += len(batch)
+        return batch
+
+
+def time_call(function, *args, **kwargs):
+    '''
+    Calls function with its output discarded and returns the elapsed time in seconds
+    '''
+
+    started = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        function(*args, **kwargs)
+    return time.perf_counter() - started
+
+
+def time_tool(tools, function, *args, **kwargs):
+    '''
+    Takes the tools module and a tool function with its arguments, and calls it as
+    time_call does
+    Returns the total time and, from the queries the tool recorded as it ran, its SQL
+    (execute), fetch and DataFrame build times in seconds and the row count
+    '''
+
+    with tools.stats_lock:
+        tools.query_stats.clear()
+
+    total = time_call(function, *args, **kwargs)
+
+    with tools.stats_lock:
+        records = list(tools.query_stats)
+
+    return {'sql': sum(record['execute'] for record in records),
+            'fetch': sum(record['fetch'] for record in records),
+            'convert': sum(record['convert'] for record in records),
+            'rows': sum(record['rows'] for record in records),
+            'total': total}
+
+
+def build_cases(tools, rng, sizes):
+    '''
+    Takes the tools module, a random generator and the sizes of the benchmark data
+    Returns {case name: function returning that case's timings} for every query,
+    export and report path
+    '''
+
+    period = (START_DATE.date(), START_DATE.date() + timedelta(days=sizes['days'] - 1))
+    month = (period[0] + timedelta(days=30), period[0] + timedelta(days=59))
+    quarter = (period[0] + timedelta(days=90), period[0] + timedelta(days=179))
+    trade_ids = rng.sample(range(1, sizes['trades'] + 1), min(100, sizes['trades']))
+    bulk_ids = rng.sample(range(1, sizes['trades'] + 1), min(5000, sizes['trades']))
+    share_ids = rng.sample(range(1, sizes['companies'] + 1), 3)
+    broker_id = rng.randint(1, sizes['brokers'])
+    workdir = tempfile.mkdtemp(prefix='trade_bench_')
+
+    def query_case(**filters):
+        def run():
+            return time_tool(tools, tools.print_trades, **filters)
+        return run
+
+    def lookup_case(trade_ids):
+        def run():
+            return time_tool(tools, tools.lookup_trades, trade_ids)
+        return run
+
+    def export_case():
+        queries = tools.build_trade_queries(broker_ids=[broker_id], date_range=quarter)
+        batches = TimedBatches(tools.stream_queries(queries))
+        started = time.perf_counter()
+        tools.write_excel_stream(batches, os.path.join(workdir, 'export.xlsx'), tools.TRADE_COLUMNS)
+        total = time.perf_counter() - started
+        return {'fetch': batches.seconds, 'write': total - batches.seconds,
+                'rows': batches.rows, 'total': total}
+
+    def report_case(report, *args):
+        def run():
+            timings = time_tool(tools, report, *args, out=os.path.join(workdir, 'report.png'))
+            timings['render'] = max(0.0, timings['total'] - timings['sql'] - timings['fetch']
+                                    - timings['convert'])
+            return timings
+        return run
+
+    return {
+        'lookup_trade': lookup_case(trade_ids),
+        'lookup_trade_bulk': lookup_case(bulk_ids),
+        'search_trade': query_case(share_ids=share_ids, date_range=month),
+        'search_trade_broker_quarter': query_case(broker_ids=[broker_id], date_range=quarter),
+        'export_trade_data': export_case,
+        'report_broker_hist': report_case(tools.trades_per_broker_hist),
+        'report_price_history': report_case(tools.plot_share_price_history, [share_ids[0]]),
+        'report_exchange_pie': report_case(tools.trade_proportion)
+    }
+
+
+def run(args):
+    '''
+    Times every case against the benchmark data, writes the median timings to a JSON file
+    and optionally compares them with an earlier run
+
+    Returns 1 if a regression was found, otherwise 0
+    '''
+
+    tools = load_tools()
+    tools.set_headless()
+    connect(tools, args)
+
+    # Size the random inputs from the data actually present
+    with tools.get_connection() as conn:
+        size_cursor = conn.cursor()
+        sizes = {'days': SCALES[args.scale]['days']}
+        for key, sql in (('trades', 'SELECT MAX(trade_id) FROM trades'),
+                         ('brokers', 'SELECT MAX(broker_id) FROM brokers'),
+                         ('companies', 'SELECT MAX(share_id) FROM shares')):
+            size_cursor.execute(sql)
+            sizes[key] = size_cursor.fetchone()[0]
+        size_cursor.close()
+
+    cases = build_cases(tools, random.Random(SEED), sizes)
+    results = {}
+
+    for name, case in cases.items():
+        if args.only and name not in args.only:
+            continue
+
+        runs = []
+        for _ in range(args.repeat):
+            tools.invalidate_cache()
+            runs.append(case())
+
+        # Median of each timing across the repeats
+        results[name] = {key: statistics.median(run[key] for run in runs)
+                         for key in runs[0] if key != 'rows'}
+        results[name]['rows'] = runs[-1]['rows']
+        print(f"{name:<30} {results[name]['total']:>9.4f}s  {results[name]['rows']:>10} rows")
+
+    return save_results(args, results, sizes=sizes)
+
+
+def connect(tools, args):
+    '''
+    Takes the loaded tools module and the parsed target arguments
+    Points the tools at the benchmark database
+    '''
+
+    if args.backend == 'sqlite':
+        use_sqlite(tools, args.sqlite_path)
+    else:
+        tools.DB_CONFIG['database'] = args.database
+
+
+def save_results(args, results, **meta):
+    '''
+    Takes the parsed arguments, the timings of each case and any extra metadata
+    Writes them to the JSON results file and compares them with the baseline if one was given
+
+    Returns 1 if a regression was found, otherwise 0
+    '''
+
+    output = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'backend': args.backend,
+            'scale': args.scale,
+            'repeat': args.repeat,
+            'python': platform.python_version(),
+            **meta
+        },
+        'results': results
+    }
+
+    with open(args.out, 'w') as file:
+        json.dump(output, file, indent=2)
+    print(f"\n>>>>> Results written! Filename: {args.out}\n")
+
+    if args.compare:
+        return compare(args.compare, args.out)
+    return 0
+
+
+#######################
+## Startup Benchmark ##
+#######################
+
+
+def time_first_prompt():
+    '''
+    Starts the interactive menus in a new interpreter and exits them again
+    Returns the seconds until the Main Menu prompt is shown
+    '''
+
+    started = time.perf_counter()
+    process = subprocess.Popen([sys.executable, '-u', TOOLS_PATH], stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+
+    output = ''
+    while not output.endswith('Selection: '):
+        char = process.stdout.read(1)
+        if not char:
+            raise RuntimeError('Trade System Tools exited before showing the Main Menu')
+        output += char
+    seconds = time.perf_counter() - started
+
+    process.communicate('4\n')
+    return seconds
+
+
+def time_command(args, argv):
+    '''
+    Takes the parsed target arguments and a Trade System Tools command line
+    Runs it against the benchmark database in a new interpreter
+
+    Returns the seconds from starting the interpreter until it exits
+    '''
+
+    command = [sys.executable, os.path.abspath(__file__), 'cli', '--backend', args.backend,
+               '--database', args.database, '--sqlite-path', args.sqlite_path, '--', *argv]
+
+    started = time.perf_counter()
+    subprocess.run(command, stdout=subprocess.DEVNULL, check=True)
+    return time.perf_counter() - started
+
+
+def startup(args):
+    '''
+    Times a cold start of the interactive menus up to the first prompt, and of each of
+    STARTUP_COMMANDS, in new interpreters; writes the median timings to a JSON file and
+    optionally compares them with an earlier run
+
+    Returns 1 if a regression was found, otherwise 0
+    '''
+
+    cases = {'startup_first_prompt': time_first_prompt}
+    for name, argv in STARTUP_COMMANDS.items():
+        cases[name] = lambda argv=argv: time_command(args, argv)
+
+    results = {}
+    for name, case in cases.items():
+        seconds = statistics.median(case() for _ in range(args.repeat))
+        results[name] = {'total': seconds}
+        print(f"{name:<30} {seconds:>9.4f}s")
+
+    return save_results(args, results)
+
+
+def cli(args):
+    '''
+    Runs a Trade System Tools command line against the benchmark database
+
+    Returns its exit status
+    '''
+
+    argv = args.argv[1:] if args.argv[:1] == ['--'] else args.argv
+
+    tools = load_tools()
+    connect(tools, args)
+    return tools.main(argv)
+
+
+def compare(baseline_path, current_path, tolerance=REGRESSION_TOLERANCE):
+    '''
+    Takes the paths of two result files and prints the change in total time per case
+
+    Returns 1 if any case is slower than the baseline by more than tolerance, otherwise 0
+    '''
+
+    with open(baseline_path) as file:
+        baseline = json.load(file)['results']
+    with open(current_path) as file:
+        current = json.load(file)['results']
+
+    regressions = 0
+    print(f"{'Case':<30} {'Baseline':>10} {'Current':>10} {'Change':>8}")
+
+    for name in sorted(set(baseline) & set(current)):
+        before = baseline[name]['total']
+        after = current[name]['total']
+        change = (after - before) / before if before else 0.0
+        flag = ''
+        if change > tolerance:
+            flag = '  (!!!!!) REGRESSION'
+            regressions += 1
+        print(f"{name:<30} {before:>9.4f}s {after:>9.4f}s {change:>+7.1%}{flag}")
+
+    return 1 if regressions else 0
+
+
+def main(argv=None):
+    '''
+    Runs the generate, run, startup, cli or compare command and returns an exit status
+    '''
+
+    parser = argparse.ArgumentParser(description='Trade System Tools benchmark suite.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    target = argparse.ArgumentParser(add_help=False)
+    target.add_argument('--backend', choices=['mysql', 'sqlite'], default='sqlite',
+                        help='local MySQL instance or embedded SQLite stand-in')
+    target.add_argument('--database', default=BENCH_DATABASE, help='MySQL database name')
+    target.add_argument('--sqlite-path', default='trade_bench.sqlite', help='SQLite database file')
+    target.add_argument('--scale', choices=list(SCALES), default='10k')
+
+    commands.add_parser('generate', parents=[target], help='create and fill the benchmark schema')
+
+    run_parser = commands.add_parser('run', parents=[target], help='time every query, export and report path')
+    run_parser.add_argument('--out', default='bench_results.json', help='JSON results file')
+    run_parser.add_argument('--repeat', type=int, default=3, help='runs per case (median is kept)')
+    run_parser.add_argument('--only', nargs='+', metavar='CASE', help='run only these cases')
+    run_parser.add_argument('--compare', metavar='BASELINE', help='earlier results file to compare against')
+
+    startup_parser = commands.add_parser('startup', parents=[target],
+                                         help='time a cold start to the first prompt and of one-off CLI queries')
+    startup_parser.add_argument('--out', default='bench_startup.json', help='JSON results file')
+    startup_parser.add_argument('--repeat', type=int, default=5, help='runs per case (median is kept)')
+    startup_parser.add_argument('--compare', metavar='BASELINE', help='earlier results file to compare against')
+
+    cli_parser = commands.add_parser('cli', parents=[target],
+                                     help='run a Trade System Tools command against the benchmark data')
+    cli_parser.add_argument('argv', nargs=argparse.REMAINDER, metavar='-- COMMAND',
+                            help='Trade System Tools command line, after --')
+
+    compare_parser = commands.add_parser('compare', help='compare two results files')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'generate':
+        return generate(args)
+    if args.command == 'run':
+        return run(args)
+    if args.command == 'startup':
+        return startup(args)
+    if args.command == 'cli':
+        return cli(args)
+    return compare(args.baseline, args.current)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
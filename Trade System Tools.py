@@ -1,24 +1,385 @@
 import os
+import re
+import io
+import csv
+import gzip
+import json
+import hmac
+import heapq
+import pickle
+import shutil
+import tempfile
+import sys
+import time
+import logging
+import argparse
+import threading
+import multiprocessing
+import logging.handlers
 import mysql.connector
-import numpy as np
-import pandas as pd
-import matplotlib.pyplot as plt
-import openpyxl
-from datetime import date
-
-
-connection = mysql.connector.connect(
-    host='localhost',
-    user='root',    # please use the correct user name
-    password='10RelationalDatabasesAreVeryUseful!',
-    database='Trading_Platform',
-    auth_plugin='mysql_native_password'
+import mysql.connector.pooling
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import contextmanager
+from itertools import chain, groupby, product
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+
+# Render reports straight to files on the Agg backend instead of displaying them
+HEADLESS = False
+
+# Connection settings for the Trading_Platform database
+DB_CONFIG = {
+    'host': 'localhost',
+    'user': 'root',    # please use the correct user name
+    'password': '10RelationalDatabasesAreVeryUseful!',
+    'database': 'Trading_Platform',
+    'auth_plugin': 'mysql_native_password'
+}
+
+# Connection pool size and how long to wait (seconds) for a free pooled connection
+POOL_NAME = 'trade_system_tools'
+POOL_SIZE = 5
+POOL_TIMEOUT = 30
+
+# Settings copied into each export worker process, which would otherwise start from the
+# module defaults and lose any changed at runtime (e.g. the database by the benchmark)
+WORKER_SETTINGS = ['DB_CONFIG', 'POOL_TIMEOUT', 'EXPORT_TIMEOUT_SECONDS', 'STREAM_BATCH_SIZE',
+                   'SLOW_QUERY_SECONDS', 'SLOW_QUERY_LOG', 'SLOW_QUERY_LOG_BYTES',
+                   'SLOW_QUERY_LOG_BACKUPS', 'QUERY_STATS_LIMIT']
+
+# Server-side time limit (seconds, 0 for none) of each query, and of the queries of an export;
+# searches and exports the server estimates will examine more rows than ADMISSION_MAX_ROWS
+# need confirming first, unless ADMISSION_FORCE is set
+QUERY_TIMEOUT_SECONDS = 120
+EXPORT_TIMEOUT_SECONDS = 3600
+ADMISSION_MAX_ROWS = 1000000
+ADMISSION_FORCE = False
+
+# Time limit overrides for the queries of the current thread (see query_time_limit)
+admission_local = threading.local()
+
+# MySQL errors raised when a statement hits its time limit or is stopped by KILL QUERY
+ER_QUERY_TIMEOUT = 3024
+ER_QUERY_INTERRUPTED = 1317
+
+# Connection pool, created on first use so the menu does not wait on the database
+pool = None
+pool_lock = threading.Lock()
+
+# Number of rows fetched from the server per round trip when streaming large results
+STREAM_BATCH_SIZE = 10000
+
+# Answer queries from the local snapshot (SNAPSHOT_DIR) instead of the database, and how
+# old (seconds) the snapshot may get before it is flagged as stale
+SNAPSHOT = False
+SNAPSHOT_DIR = 'snapshot'
+SNAPSHOT_MAX_AGE = 3600
+
+# Snapshot watermarks and sync time, and the tables loaded from it keyed on table name
+snapshot_state = None
+snapshot_frames = {}
+
+# Engine for analytical queries (reports, searches, exports): 'mysql', or 'duckdb' to run
+# them in-process over the local snapshot; point lookups always go to MySQL
+ANALYTICS_BACKEND = 'mysql'
+
+# Embedded DuckDB connection, created on first use
+duckdb_conn = None
+duckdb_lock = threading.Lock()
+
+# Address the query service ('serve' command) listens on, and the service the menus and
+# commands send their queries to instead of connecting to MySQL (None to connect directly)
+SERVICE_HOST = '127.0.0.1'
+SERVICE_PORT = 8765
+SERVICE_URL = None
+
+# Shared secret the service asks clients for, read from the environment variable named
+# below (None for no check, only allowed when serving on a loopback address)
+SERVICE_TOKEN_ENV = 'TRADE_SERVICE_TOKEN'
+SERVICE_TOKEN = None
+
+# Worker threads, free connection slots and in-flight requests of the running service
+service_executor = None
+service_slots = None
+service_inflight = {}
+
+# Trading days summed by the rolling volume report, and gainers and losers shown by the
+# top movers report, unless user asks for others
+ROLLING_WINDOW_DAYS = 20
+TOP_MOVERS = 10
+
+# Add company, broker and exchange names to trade results (off by default, so results and
+# exports keep their columns; see --names), the tables the names come from, and how often
+# (seconds) at most to check them for changes
+ENRICH_TRADES = False
+DIMENSION_TABLES = ['shares', 'companies', 'brokers', 'stock_exchanges']
+DIMENSION_CHECK_SECONDS = 60
+
+# Dimension store (see get_dimensions), the table version it was loaded at and when that was checked
+dimension_store = None
+dimension_version = None
+dimension_checked = 0
+dimension_lock = threading.Lock()
+
+# Most matches a company name search returns, and the least share of trigrams (Dice
+# coefficient) a misspelt name must have in common with a company name to match it
+NAME_SEARCH_LIMIT = 10
+NAME_MATCH_THRESHOLD = 0.4
+
+# Company name index, with the dimension store it was built from (see get_name_index)
+name_index = None
+
+# Result cache size and time to live (seconds) for cached queries; reference data such as
+# brokers and shares changes rarely and is kept for longer
+CACHE_MAX_ENTRIES = 128
+CACHE_TTL = 300
+REFERENCE_DATA_TTL = 3600
+
+# Cached query results keyed on (normalized SQL, parameters), least recently used first
+query_cache = OrderedDict()
+cache_lock = threading.Lock()
+
+# share_id values that have a price history, loaded on first use, and when they expire
+valid_share_ids = None
+valid_share_ids_expiry = 0
+
+# Per-day summary tables kept incrementally up to date from the trades table, and their
+# (trade_id, transaction_time) watermark
+SUMMARY_TABLES = (
+    """CREATE TABLE IF NOT EXISTS trade_summary_broker_day (
+        trade_date DATE NOT NULL,
+        broker_id INT NOT NULL,
+        trades BIGINT NOT NULL,
+        notional DECIMAL(24, 4) NOT NULL,
+        PRIMARY KEY (trade_date, broker_id))""",
+    """CREATE TABLE IF NOT EXISTS trade_summary_exchange_day (
+        trade_date DATE NOT NULL,
+        stock_ex_id INT NOT NULL,
+        trades BIGINT NOT NULL,
+        notional DECIMAL(24, 4) NOT NULL,
+        PRIMARY KEY (trade_date, stock_ex_id))""",
+    """CREATE TABLE IF NOT EXISTS trade_summary_day_watermark (
+        id TINYINT PRIMARY KEY,
+        last_trade_id BIGINT NOT NULL,
+        last_transaction_time DATETIME NULL)"""
 )
-if connection.is_connected():
-    db_Info = connection.get_server_info()
-    # print("Connected to MySQL Server version ", db_Info, '\n')
 
-cursor = connection.cursor()
+# Summary tables of earlier versions, kept per broker and exchange without days, which are
+# dropped when the per-day tables are created
+OLD_SUMMARY_TABLES = ['trade_summary_broker', 'trade_summary_exchange', 'trade_summary_daily',
+                      'trade_summary_watermark']
+
+# Statements that recompute each summary table over the trades of a [start, end) range of days
+SUMMARY_UPDATES = {
+    'trade_summary_broker_day': """INSERT INTO trade_summary_broker_day (trade_date, broker_id, trades, notional)
+    SELECT DATE(transaction_time), broker_id, COUNT(*), SUM(price_total) FROM trades
+    WHERE transaction_time >= %s AND transaction_time < %s
+    GROUP BY DATE(transaction_time), broker_id""",
+    'trade_summary_exchange_day': """INSERT INTO trade_summary_exchange_day (trade_date, stock_ex_id, trades, notional)
+    SELECT DATE(transaction_time), stock_ex_id, COUNT(*), SUM(price_total) FROM trades
+    WHERE transaction_time >= %s AND transaction_time < %s
+    GROUP BY DATE(transaction_time), stock_ex_id"""
+}
+
+# Days before the transaction_time watermark recomputed on every refresh, so trades that
+# commit late (with a trade_id below one already summarised) are still counted
+SUMMARY_RESCAN_DAYS = 2
+
+# Largest number of values bound into a single IN (...) list; longer ID lists are split
+# across several statements
+MAX_IN_LIST = 1000
+
+# Trades shown per page of search results
+SEARCH_PAGE_SIZE = 50
+
+# Trade ID lookups: runs of at least this many consecutive IDs are sent as one BETWEEN, and
+# lookups of more single IDs than this are joined against a temporary table instead
+MIN_RANGE_RUN = 3
+TEMP_TABLE_MIN_IDS = 20000
+
+# Queries taking longer than this many seconds are written, with their EXPLAIN plan, to a
+# rotating slow-query log
+SLOW_QUERY_SECONDS = 1.0
+SLOW_QUERY_LOG = 'slow_queries.log'
+SLOW_QUERY_LOG_BYTES = 1000000
+SLOW_QUERY_LOG_BACKUPS = 5
+
+# Timings of the most recent queries this session, and the last query run on each thread
+# (so the DataFrame build that follows it can be added to its timings)
+QUERY_STATS_LIMIT = 10000
+query_stats = deque(maxlen=QUERY_STATS_LIMIT)
+stats_lock = threading.Lock()
+stats_local = threading.local()
+slow_query_logger = None
+
+# Functions that run queries on behalf of others; a query's caller is reported as the first
+# function of this script up the stack that is not one of these (nor takes row batches)
+QUERY_HELPERS = {
+    'record_query', 'execute_query', 'execute_queries', 'cached_query', 'execute_duckdb',
+    'stream_query', 'stream_queries', 'stream_connection_query', 'stream_trades_by_id_table',
+    'stream_duckdb', 'remote_query', 'remote_stream', 'convert_to_df', 'fetch_df'
+}
+
+# Most points plotted per share in a price history chart; longer histories are downsampled
+MAX_PLOT_POINTS = 2000
+
+# Server-side bucket expressions for resampled price histories on each analytics backend
+# (weeks start on Monday)
+RESAMPLE_BUCKETS = {
+    'mysql': {
+        'daily': 'DATE(time_start)',
+        'weekly': 'DATE_SUB(DATE(time_start), INTERVAL WEEKDAY(time_start) DAY)'
+    },
+    'duckdb': {
+        'daily': 'CAST(time_start AS DATE)',
+        'weekly': "CAST(date_trunc('week', time_start) AS DATE)"
+    }
+}
+
+# Result columns of each table, declared once and shared by every query function
+TRADE_COLUMNS = ['Trade ID', 'Share ID', 'Broker ID', 'Stock Ex ID',
+                 'Transaction Time', 'Share Amount', 'Price Total']
+SHARE_PRICE_COLUMNS = ['Share ID', 'Price', 'Time Start', 'Time End']
+OHLC_COLUMNS = ['Share ID', 'Time Start', 'Open', 'High', 'Low', 'Close']
+BROKER_COLUMNS = ['Broker ID', 'First Name', 'Last Name']
+SHARE_COLUMNS = ['Company', 'Company ID', 'Share ID', 'Currency ID', 'Place ID']
+COMPANY_COLUMNS = ['Company ID', 'Company', 'Place ID']
+EXCHANGE_COLUMNS = ['Stock Ex ID', 'Stock Exchanges']
+
+# Dimensions naming the IDs in trade results: name column -> (trade column holding the ID,
+# query of (ID, name parts...) rows, snapshot table, snapshot columns of those rows)
+DIMENSIONS = {
+    'Company': ('Share ID', 'SELECT s.share_id, c.name FROM shares s '
+                            'INNER JOIN companies c ON s.company_id = c.company_id;',
+                'shares', ['Share ID', 'Company']),
+    'Broker': ('Broker ID', 'SELECT broker_id, first_name, last_name FROM brokers;',
+               'brokers', BROKER_COLUMNS),
+    'Stock Exchange': ('Stock Ex ID', 'SELECT stock_ex_id, name FROM stock_exchanges;',
+                       'stock_exchanges', EXCHANGE_COLUMNS)
+}
+ENRICHED_TRADE_COLUMNS = TRADE_COLUMNS + list(DIMENSIONS)
+
+# Columns of the analytics reports
+VWAP_COLUMNS = ['Share ID', 'Date', 'VWAP', 'Volume', 'Trades']
+ROLLING_VOLUME_COLUMNS = ['Share ID', 'Date', 'Volume', 'Rolling Volume']
+TURNOVER_COLUMNS = ['Broker ID', 'Trades', 'Volume', 'Notional', 'Average Notional',
+                    'Notional %', 'Rank']
+
+# ID column of each breakdown of the mark-to-market valuation
+VALUATION_LEVELS = {
+    'share': 'Share ID',
+    'broker': 'Broker ID'
+}
+
+# Reference data queries by table, with their column names
+REFERENCE_QUERIES = {
+    'brokers': ('SELECT * FROM brokers;', BROKER_COLUMNS),
+    'shares': ("""
+    SELECT c.name, c.company_id, s.share_id, s.currency_id, c.place_id
+    FROM shares s
+    INNER JOIN companies c
+    ON s.company_id = c.company_id""", SHARE_COLUMNS)
+}
+
+# Storage type of each result column: IDs as int32, counts as int64, money as float64,
+# times as datetime64[ns] and names/codes as pandas categoricals
+# Columns not listed are kept as Python objects
+COLUMN_TYPES = {
+    'Trade ID': 'int32',
+    'Share ID': 'int32',
+    'Broker ID': 'int32',
+    'Stock Ex ID': 'int32',
+    'Company ID': 'int32',
+    'Transaction Time': 'datetime64[ns]',
+    'Time Start': 'datetime64[ns]',
+    'Time End': 'datetime64[ns]',
+    'Share Amount': 'int64',
+    'Trades': 'int64',
+    'Price': 'float64',
+    'Price Total': 'float64',
+    'Trade Price': 'float64',
+    'Mark Price': 'float64',
+    'Market Value': 'float64',
+    'Unrealized P&L': 'float64',
+    'Cost': 'float64',
+    'Date': 'datetime64[ns]',
+    'First Date': 'datetime64[ns]',
+    'Last Date': 'datetime64[ns]',
+    'VWAP': 'float64',
+    'First VWAP': 'float64',
+    'Last VWAP': 'float64',
+    'Change %': 'float64',
+    'Volume': 'int64',
+    'Rolling Volume': 'int64',
+    'Notional': 'float64',
+    'Average Notional': 'float64',
+    'Notional %': 'float64',
+    'Rank': 'int64',
+    'Open': 'float64',
+    'High': 'float64',
+    'Low': 'float64',
+    'Close': 'float64',
+    'First Name': 'category',
+    'Last Name': 'category',
+    'Company': 'category',
+    'Currency ID': 'category',
+    'Place ID': 'category',
+    'Stock Exchanges': 'category',
+    'Broker': 'category',
+    'Stock Exchange': 'category'
+}
+
+# Excel worksheet row limit (including the header row) and sheets per workbook before
+# a streamed export rolls over into a new file
+EXCEL_MAX_ROWS = 1048576
+EXCEL_MAX_SHEETS = 10
+
+# Export file formats, named by their file extension, and the Parquet compression codec
+# ('zstd' or 'snappy'); 'auto' picks Excel unless the export has more rows than a sheet holds
+EXPORT_FORMATS = ['auto', 'xlsx', 'parquet', 'arrow', 'csv.gz', 'csv.zst', 'csv']
+PARQUET_COMPRESSION = 'zstd'
+
+# Composite indexes serving the predicates the tool generates, by index name, and how many
+# times the index advisor runs each query shape (keeping the fastest run)
+ADVISED_INDEXES = {
+    'idx_trades_share_time': ('trades', ['share_id', 'transaction_time']),
+    'idx_trades_broker_time': ('trades', ['broker_id', 'transaction_time']),
+    'idx_trades_time': ('trades', ['transaction_time']),
+    'idx_shares_prices_share_time': ('shares_prices', ['share_id', 'time_start'])
+}
+ADVISOR_REPEAT = 3
+
+# DuckDB views over the snapshot giving each database table its column names back:
+# view -> (snapshot table, [(column, snapshot column), ...])
+DUCKDB_VIEWS = {
+    'trades': ('trades', list(zip(['trade_id', 'share_id', 'broker_id', 'stock_ex_id',
+                                   'transaction_time', 'share_amount', 'price_total'], TRADE_COLUMNS))),
+    'shares_prices': ('shares_prices', list(zip(['share_id', 'price', 'time_start', 'time_end'],
+                                                SHARE_PRICE_COLUMNS))),
+    'brokers': ('brokers', list(zip(['broker_id', 'first_name', 'last_name'], BROKER_COLUMNS))),
+    'companies': ('companies', list(zip(['company_id', 'name', 'place_id'], COMPANY_COLUMNS))),
+    'shares': ('shares', [('share_id', 'Share ID'), ('company_id', 'Company ID'),
+                          ('currency_id', 'Currency ID')]),
+    'stock_exchanges': ('stock_exchanges', list(zip(['stock_ex_id', 'name'], EXCHANGE_COLUMNS)))
+}
+
+# Tables mirrored into the local snapshot: the query pulling them, their columns and the
+# (column, header, key) watermark from which new rows are pulled, or None to reload them in
+# full. A watermark that is not unique has the headers (key) telling apart the rows sharing
+# a value; rows from the last value seen are pulled again and the known keys dropped
+SNAPSHOT_TABLES = {
+    'trades': ('SELECT * FROM trades', TRADE_COLUMNS, ('trade_id', 'Trade ID', None)),
+    'shares_prices': ('SELECT share_id, price, time_start, time_end FROM shares_prices',
+                      SHARE_PRICE_COLUMNS, ('time_start', 'Time Start', ['Share ID'])),
+    'brokers': ('SELECT * FROM brokers', BROKER_COLUMNS, None),
+    'shares': ('SELECT c.name, c.company_id, s.share_id, s.currency_id, c.place_id '
+               'FROM shares s INNER JOIN companies c ON s.company_id = c.company_id',
+               SHARE_COLUMNS, None),
+    'companies': ('SELECT company_id, name, place_id FROM companies', COMPANY_COLUMNS, None),
+    'stock_exchanges': ('SELECT stock_ex_id, name FROM stock_exchanges', EXCHANGE_COLUMNS, None)
+}
 
 
 ####################
@@ -44,12 +405,12 @@ Trade System Tools
 
     option = get_menu_selection('main')
     dispatch = {
-        1: query_menu,
-        2: export_trade_data,
-        3: reporting_menu,
-        4: exit_program
+        1: 'query',
+        2: 'export',
+        3: 'reporting',
+        4: 'exit'
     }
-    return dispatch[int(option)]()
+    return dispatch[int(option)]
 
 
 def query_menu():
@@ -68,16 +429,22 @@ Run Queries
 2. List All Shares
 3. Lookup Trade
 4. Search Table
-5. Return to Main Menu
+5. Session Query Statistics
+6. Find Shares by Company Name
+7. Return to Main Menu
 ''')
 
         option = get_menu_selection('query')
+        if option == '7':
+            return 'main'
+
         dispatch = {
             1: list_all_brokers,
             2: list_all_shares,
             3: lookup_trade,
             4: search_trade,
-            5: main_menu
+            5: print_query_stats,
+            6: find_shares
         }
         dispatch[int(option)]()
 
@@ -97,30 +464,69 @@ Select Reports
 1. Trades Made Per Broker (Histogram)
 2. Share Price Histories (Time Series)
 3. Distribution of Trades Across Stock Exchanges (Pie Chart)
-4. Return to Main Menu
+4. Mark-to-Market Valuation (Unrealized P&L)
+5. VWAP Per Share Per Day
+6. Rolling Traded Volume
+7. Broker Turnover and Notional
+8. Top Movers
+9. Return to Main Menu
 ''')
 
         option = get_menu_selection('reporting')
+        if option == '9':
+            return 'main'
+
         dispatch = {
             1: trades_per_broker_hist,
             2: share_price_history,
             3: trade_proportion,
-            4: main_menu
+            4: mark_to_market,
+            5: lambda: analytics_report('vwap'),
+            6: lambda: analytics_report('rolling-volume'),
+            7: lambda: analytics_report('broker-turnover'),
+            8: lambda: analytics_report('top-movers')
         }
         dispatch[int(option)]()
 
 
 def exit_program():
     '''
-    Close cursor and connection
+    Close pooled connections
 
-    Exit program
+    Exit program by returning no next menu
     '''
 
     print("\n>>>>> Goodbye!\n")
-    cursor.close()
-    connection.close()
-    exit()
+    close_pool()
+    return None
+
+
+def run_menus():
+    '''
+    Runs the interactive menus as a flat state machine
+
+    Each menu function returns the name of the next menu (a key of MENUS), or None to exit,
+    so moving between menus never grows the call stack
+    '''
+
+    state = 'main'
+    while state is not None:
+        try:
+            state = MENUS[state]()
+
+        # Ctrl-C cancels what is running and goes back to the Main Menu, or exits from it
+        except KeyboardInterrupt:
+            if state == 'main':
+                state = 'exit'
+            else:
+                print('\n(!!!!!) Cancelled! Returning to Main Menu\n')
+                state = 'main'
+
+        except mysql.connector.Error as errMsg:
+            if errMsg.errno not in (ER_QUERY_TIMEOUT, ER_QUERY_INTERRUPTED):
+                raise
+            print(f'\n(!!!!!) Query stopped by the server: {errMsg.msg}\n')
+            state = 'main'
 
 
 def get_menu_selection(menu):
@@ -133,10 +539,7 @@ def get_menu_selection(menu):
     Function returns option
     '''
 
-    if menu == 'query':
-        choices = '12345'
-    else:
-        choices = '1234'
+    choices = MENU_CHOICES[menu]
 
     while True:
         selection = input('Selection: ')
@@ -168,20 +571,20 @@ def list_all_brokers():
     Prints SQL output as a pandas DataFrame to stdout
     '''
 
-    # Store Data
-    sql = 'SELECT * FROM brokers;'
-    data = execute_query(sql)
+    if SNAPSHOT:
+        df = load_snapshot('brokers')
+
+    else:
+        # Store Data
+        sql, headers = REFERENCE_QUERIES['brokers']
+        df = convert_to_df(cached_query(sql, ttl=REFERENCE_DATA_TTL), headers)
+        print(f'\n>>>>> Your Query: {sql}\n')
 
     # If no data returned from SQL, inform user
-    if len(data) == 0:
+    if len(df) == 0:
         print("\n>>>>> No data found\n")
         return 1
 
-    # Column names
-    cols = ['Broker ID', 'First Name', 'Last Name']
-
-    df = convert_to_df(data, cols)
-    print(f'\n>>>>> Your Query: {sql}\n')
     print(df)
 
 
@@ -192,83 +595,115 @@ def list_all_shares():
     Prints SQL output as a pandas DataFrame to stdout
     '''
 
-    # Store Data
-    sql = """
-    SELECT c.name, c.company_id, s.share_id, s.currency_id, c.place_id
-    FROM shares s
-    INNER JOIN companies c
-    ON s.company_id = c.company_id"""
-    data = execute_query(sql)
+    if SNAPSHOT:
+        df = load_snapshot('shares')
+
+    else:
+        # Store Data
+        sql, headers = REFERENCE_QUERIES['shares']
+        df = convert_to_df(cached_query(sql, ttl=REFERENCE_DATA_TTL), headers)
+        print(f'\n>>>>> Your Query: {sql}\n')
 
     # If no data returned from SQL, inform user
-    if len(data) == 0:
+    if len(df) == 0:
         print("\n>>>>> No data found\n")
         return 1
 
-    # Column names
-    cols = ['Company', 'Company ID', 'Share ID', 'Currency ID', 'Place ID']
-    df = convert_to_df(data, cols)
-    print(f'\n>>>>> Your Query: {sql}\n')
     print(df)
 
 
 def lookup_trade():
     '''
-    Function prompts user for trade_id
-    SQL query is generated based on user input and executed
-    Prints SQL output as a pandas DataFrame to stdout
+    Function prompts user for trade_ids, ranges of trade_ids or the path of a file of them,
+    and for an optional output file
+    SQL queries are generated based on user input and executed
+    Streams SQL output to stdout, or to the file
 
-    Note: trade_id input value must be a valid digit
+    Note: trade_id input values must be valid digits or ranges (1000-2000)
     '''
 
     while True:
 
-        trade_id = input(
-            "Please enter ONE OR MORE Trade IDs in the format (1 2 3): ")
+        text = input("Please enter ONE OR MORE Trade IDs or ranges in the format (1 2 1000-2000), "
+                     "or the path of a file of them: ")
 
         try:
-            assert len(
-                trade_id) > 0, '\n(!!!!!) Please enter AT LEAST ONE Trade ID!\n'
-            trade_id_list = trade_id.split(' ')
-
-            for id in trade_id_list:
-                assert id.isdigit(), '\n(!!!!!) Please enter digit(s) for Trade ID!\n'
+            assert len(text.strip()) > 0, '\n(!!!!!) Please enter AT LEAST ONE Trade ID!\n'
+            trade_ids, ranges = read_trade_ids(text.strip())
+            assert trade_ids or ranges, '\n(!!!!!) No Trade IDs found!\n'
 
         except AssertionError as errMsg:
             print(errMsg)
-            continue
+
+        except ValueError as errMsg:
+            print(f'\n(!!!!!) {errMsg}\n')
 
         else:
             break
 
-    sql = 'SELECT * FROM trades'
-    # Loop through multiple values provided for share_id
-    count = 0
-    for id in trade_id_list:
-        condition = f"trade_id = {id}"
+    out = input("Output file (.csv, .csv.gz, .parquet, ...), press ENTER for screen: ").strip()
+    return lookup_trades(trade_ids, ranges, out or None)
 
-        if count == 0:
-            sql = append_sql(sql, condition, "AND", True)
-        else:
-            sql = append_sql(sql, condition, 'OR', False)
 
-        count += 1
-    sql += ')'
+def lookup_trades(trade_ids=(), ranges=(), out=None):
+    '''
+    Takes a list of trade_id values, a list of inclusive (low, high) trade_id ranges and an
+    optional output filename
+    Runs of consecutive IDs are looked up with BETWEEN, the remaining IDs in chunked IN lists
+    or, for very many IDs, by a join against a temporary table
 
-    print(f'\n>>>>> Your Query: {sql}\n')
-    data = execute_query(sql)
+    Streams the matching trades to stdout batch by batch, or to out in the format given by
+    its extension. Returns an exit status
+    '''
+
+    singles, ranges = group_trade_ids(trade_ids, ranges)
+
+    if SNAPSHOT:
+        batches = frame_batches(snapshot_lookup(singles, ranges))
+    else:
+        # The temporary table needs a connection of our own, which the service does not lend
+        id_table = len(singles) > TEMP_TABLE_MIN_IDS and SERVICE_URL is None
+        queries = build_trade_lookup_queries([] if id_table else singles, ranges)
+        if queries:
+            print_queries(queries)
+        batches = stream_queries(queries)
+        if id_table:
+            batches = chain(stream_trades_by_id_table(singles), batches)
+
+    # Count rows on their way through to the writer
+    rows = 0
+
+    def counted(batches):
+        nonlocal rows
+        for batch in batches:
+            rows += len(batch)
+            yield batch
+
+    if out is not None:
+        fmt = next((name for name in EXPORT_FORMATS[1:] if out.endswith('.' + name)), 'csv')
+        with query_time_limit(EXPORT_TIMEOUT_SECONDS):
+            if ENRICH_TRADES:
+                EXPORT_WRITERS[fmt](enrich_batches(counted(batches)), out, ENRICHED_TRADE_COLUMNS)
+            else:
+                EXPORT_WRITERS[fmt](counted(batches), out, TRADE_COLUMNS)
+        print(f"\n>>>>> {rows} trades written to {out}\n")
+    else:
+        # Print a page, with its own header, every STREAM_BATCH_SIZE rows
+        page = []
+        for batch in chain(counted(batches), [None]):
+            page += batch or []
+            if page and (batch is None or len(page) >= STREAM_BATCH_SIZE):
+                df = convert_to_df(page, TRADE_COLUMNS)
+                if ENRICH_TRADES:
+                    df = enrich_trades(df)
+                print(df.to_string(index=False))
+                page = []
 
     # If no data returned from SQL, inform user
-    if len(data) == 0:
+    if rows == 0:
         print("\n>>>>> No data found\n")
         return 1
 
-    # Column names
-    cols = ['Trade ID', 'Share ID', 'Broker ID', 'Stock Ex ID',
-            'Transaction Time', 'Share Amount', 'Price Total']
-    df = convert_to_df(data, cols)
-    print(df)
-
 
 def search_trade():
     '''
@@ -283,119 +718,144 @@ def search_trade():
 
         print('\nPlease enter AT LEAST ONE of the following: Share ID, Broker ID, Date Range. Press ENTER to skip.\n')
 
-        while True:
+        share_id_list = get_id_list('Share', skip=True)
+        broker_id_list = get_id_list('Broker', skip=True)
+        date_range = input("Date Range (DDMMYYYY - DDMMYYYY): ")
 
-            share_id = input(
-                "Please enter ONE OR MORE Share IDs in the format (1 2 3): ")
+        try:
+            # Check if at least one value given
+            assert share_id_list or broker_id_list or date_range, '\n(!!!!!) Not enough details provided!\n'
 
-            if len(share_id) == 0:
-                share_id_list = ''
-                break
+            if date_range:
+                date_range = parse_date_range(date_range)
 
-            try:
-                share_id_list = share_id.split(' ')
+        except AssertionError as errMsg:
+            print(errMsg)
 
-                for id in share_id_list:
-                    assert id.isdigit(), '\n(!!!!!) Please enter digit(s) for Share ID or ENTER to skip!\n'
+        except ValueError:
+            print("\n(!!!!!) Invalid values provided!\n")
 
-            except AssertionError as errMsg:
-                print(errMsg)
-                continue
+        else:
+            break
 
-            else:
-                break
+    while True:
 
-        while True:
+        page_size = input(f"Trades per page, press ENTER for {SEARCH_PAGE_SIZE}: ")
 
-            broker_id = input(
-                "Please enter ONE OR MORE Broker IDs in the format (1 2 3): ")
+        if page_size == '' or (page_size.isdigit() and int(page_size) > 0):
+            break
+        print('\n(!!!!!) Please enter a digit for the page size!\n')
 
-            if len(broker_id) == 0:
-                broker_id_list = ''
-                break
+    return print_trade_pages(share_ids=share_id_list, broker_ids=broker_id_list,
+                             date_range=date_range or None,
+                             page_size=int(page_size or SEARCH_PAGE_SIZE))
 
-            try:
-                broker_id_list = broker_id.split(' ')
 
-                for id in broker_id_list:
-                    assert id.isdigit(), '\n(!!!!!) Please enter digit(s) for Broker ID or ENTER to skip!\n'
+def print_trade_pages(share_ids=None, broker_ids=None, date_range=None, page_size=SEARCH_PAGE_SIZE):
+    '''
+    Takes ONE OR MORE filters on the trades table, as for build_trade_queries, and a page size
+    Prints the number of matching trades, then the trades a page at a time ordered by
+    transaction_time and trade_id, asking before fetching each next page
+    '''
 
-            except AssertionError as errMsg:
-                print(errMsg)
-                continue
+    if not SNAPSHOT and not admit_queries(build_trade_queries(
+            share_ids=share_ids, broker_ids=broker_ids, date_range=date_range)):
+        return 1
 
-            else:
-                break
+    total = count_trades(share_ids, broker_ids, date_range)
 
-        date_range = input("Date Range (DDMMYYYY - DDMMYYYY): ")
+    # If no data returned from SQL, inform user
+    if total == 0:
+        print("\n>>>>> No data found\n")
+        return 1
+
+    pages = -(-total // page_size)
+    print(f"\n>>>>> {total} matching trades, {pages} pages of {page_size}\n")
+
+    shown = 0
+    for number, page in enumerate(page_trades(share_ids, broker_ids, date_range, page_size), 1):
+        page.index += shown + 1
+        if ENRICH_TRADES:
+            page = enrich_trades(page)
+        print(page.to_string())
+        shown += len(page)
+        print(f"\n>>>>> Page {number} of {pages}\n")
+
+        if shown >= total:
+            break
 
         try:
-            # Check if at least one value given
-            attributes = ('share_id', 'broker_id', 'date_range')
-            input_values = (share_id_list, broker_id_list, date_range)
-            given_values = {}
+            if input("Press ENTER for the next page, or q to stop: ").strip().lower() == 'q':
+                break
+        except EOFError:
+            break
 
-            for index in range(3):
-                if len(input_values[index]) != 0:
-                    given_values[attributes[index]] = input_values[index]
 
-            assert len(given_values.keys()
-                       ) > 0, '\n(!!!!!) Not enough details provided!\n'
+def page_trades(share_ids=None, broker_ids=None, date_range=None, page_size=SEARCH_PAGE_SIZE):
+    '''
+    Takes ZERO OR MORE filters on the trades table, as for build_trade_queries, and a page size
+    Yields the matching trades a page at a time as pandas DataFrames, ordered by
+    transaction_time and trade_id, only querying for a page when it is asked for
 
-            # Store Data and add appropriate SQL conditions
-            sql = f'SELECT * FROM trades'
-            conditions = 0
+    Note: Each page starts after the (transaction_time, trade_id) of the last trade of the
+    one before (keyset pagination), so a late page costs no more than the first. A share or
+    broker list longer than MAX_IN_LIST is paged one chunk of it at a time
+    '''
 
-            for key, value in given_values.items():
+    if SNAPSHOT:
+        df = snapshot_trades(share_ids=share_ids, broker_ids=broker_ids, date_range=date_range)
+        df = df.sort_values(['Transaction Time', 'Trade ID'], ignore_index=True)
+        for start in range(0, len(df), page_size):
+            yield df.iloc[start:start + page_size].reset_index(drop=True)
+        return
 
-                # Generate SQL condition strings based on user values
-                if key == 'date_range':
-                    start_date = value.split(' - ')[0]
-                    end_date = value.split(' - ')[1]
-                    start = f"{start_date[4:]}-{start_date[2:4]}-{start_date[:2]}"
-                    end = f"{end_date[4:]}-{end_date[2:4]}-{end_date[:2]}"
-                    condition = f"transaction_time >= '{start}' AND transaction_time <= '{end}'"
+    filters = dict(share_ids=share_ids, broker_ids=broker_ids, date_range=date_range)
+    suffix = f' ORDER BY transaction_time, trade_id LIMIT {int(page_size)}'
+    time_index = TRADE_COLUMNS.index('Transaction Time')
 
-                    sql = append_sql(sql, condition, 'date')
-                else:
-                    # Loop through multiple values provided for share_id and broker_id
-                    count = 0
-                    for id in value:
-                        condition = f"{key} = {id}"
-
-                        if count == 0:
-                            sql = append_sql(sql, condition, "AND", True)
-                        else:
-                            sql = append_sql(sql, condition, 'OR', False)
-
-                        count += 1
-
-                sql += ')'
-                conditions += 1
-                if conditions == len(given_values.keys()):
-                    sql += ';'
-
-            data = execute_query(sql)
-            # If no data returned from SQL, inform user
-            if len(data) == 0:
-                print(f'\n>>>>> Your Query: {sql}\n')
-                print("\n>>>>> No data found\n")
-                return 1
+    for chunk in range(len(build_trade_queries(**filters))):
+        after = None
 
-        except AssertionError as errMsg:
-            print(errMsg)
+        while True:
+            sql, params = build_trade_queries(**filters, after=after, suffix=suffix)[chunk]
+            data = execute_query(sql, params, analytical=True)
 
-        except:
-            print("\n(!!!!!) Invalid values provided!\n")
+            if data:
+                yield convert_to_df(data, TRADE_COLUMNS)
+            if len(data) < page_size:
+                break
+            after = (data[-1][time_index], data[-1][0])
 
-        else:
-            break
 
-    # Column names
-    cols = ['Trade ID', 'Share ID', 'Broker ID', 'Stock Ex ID',
-            'Transaction Time', 'Share Amount', 'Price Total']
-    df = convert_to_df(data, cols)
-    print(f'\n>>>>> Your Query: {sql}\n')
+def print_trades(trade_ids=None, share_ids=None, broker_ids=None, date_range=None):
+    '''
+    Takes ZERO OR MORE filters on the trades table, as for build_trade_queries
+    Fetches the matching trades, from the local snapshot in snapshot mode
+
+    Prints SQL output as a pandas DataFrame to stdout
+    '''
+
+    if SNAPSHOT:
+        df = snapshot_trades(trade_ids, share_ids, broker_ids, date_range)
+
+    else:
+        queries = build_trade_queries(trade_ids=trade_ids, share_ids=share_ids,
+                                      broker_ids=broker_ids, date_range=date_range,
+                                      suffix=' ORDER BY trade_id')
+        print_queries(queries)
+        if not trade_ids and not admit_queries(queries):
+            return 1
+
+        # Searches scan ranges of the table; lookups by trade_id stay point queries
+        df = fetch_df(queries, TRADE_COLUMNS, analytical=not trade_ids)
+
+    # If no data returned from SQL, inform user
+    if len(df) == 0:
+        print("\n>>>>> No data found\n")
+        return 1
+
+    if ENRICH_TRADES:
+        df = enrich_trades(df)
     print(df)
 
 
@@ -404,7 +864,7 @@ def export_trade_data():
     Function prompts user to specify ZERO OR MORE of share_id, broker_id, and date_range
     Selection is made by entering the corresponding digits from the menu
     SQL query is generated based on user input and executed
-    Exports SQL output as a pandas DataFrame to a .xlsx in working directory
+    Exports SQL output to a .xlsx in working directory
 
     Note: ZERO values can be specied but all values specified must be valid
     '''
@@ -450,130 +910,157 @@ Selection: ''')
             else:
                 break
 
-        # Default SQL query and file name
-        sql = 'SELECT * FROM trades'
-        filename = 'trade_details'
-        condition = ''
+        # Default filters
+        share_id_list = []
+        broker_id_list = []
+        date_range = None
 
         if selection == '4':
-            return main_menu()
+            return 'main'
 
-        # Read selections and add the appropriate condition to the current SQL string and update file name
-        # Add share_id condition(s) if specified by user
+        # Read selections and collect the appropriate filters
+        # Add share_id filter if specified by user
         if '1' in selection:
+            share_id_list = get_id_list('Share')
 
-            while True:
+        # Add broker_id filter if specified by user
+        if '2' in selection:
+            broker_id_list = get_id_list('Broker')
 
-                share_id = input(
-                    "Please enter ONE OR MORE Share IDs in the format (1 2 3): ")
+        # Add date filter if specified by user
+        if '3' in selection:
+            date_range = get_date_range()
 
-                try:
-                    share_id_list = share_id.split(' ')
-                    for id in share_id_list:
-                        assert id.isdigit(), '\n(!!!!!) Please enter digit(s) for Share ID!\n'
+        export_trades(share_id_list, broker_id_list, date_range, fmt=get_export_format())
 
-                except AssertionError as errMsg:
-                    print(errMsg)
-                    continue
 
-                else:
-                    break
+def get_export_format():
+    '''
+    Prompts user for an export file format
 
-            # Loop through multiple values provided for share_id
-            count = 0
-            for id in share_id_list:
-                condition = f"share_id = {id}"
+    Returns one of EXPORT_FORMATS
+    '''
 
-                if count == 0:
-                    sql = append_sql(sql, condition, "AND", True)
-                else:
-                    sql = append_sql(sql, condition, 'OR', False)
+    while True:
 
-                count += 1
-            sql += ')'
-            filename += f"_share_id_{'_'.join(share_id_list)}"
+        selection = input(
+            "Format (1. Auto 2. Excel 3. Parquet 4. Arrow 5. CSV.gz 6. CSV.zst), press ENTER for Auto: ")
 
-        # Add broker_id condition(s) if specified by user
-        if '2' in selection:
+        if selection == '':
+            return 'auto'
+        if len(selection) == 1 and selection in '123456':
+            return EXPORT_FORMATS[int(selection) - 1]
+        print('\n(!!!!!) Invalid Selection!\n')
 
-            while True:
 
-                broker_id = input(
-                    "Please enter ONE OR MORE Broker IDs in the format (1 2 3): ")
+def export_trades(share_ids=None, broker_ids=None, date_range=None, filename=None, launch=True,
+                  workers=1, fmt='auto'):
+    '''
+    Takes ZERO OR MORE filters (lists of share_id and broker_id values and an inclusive
+    date range), an optional filename, whether to open a .xlsx in Excel afterwards,
+    the number of worker processes to fetch with and a file format from EXPORT_FORMATS
+    Exports the matching trades, ordered by trade_id, to a file in working directory
+
+    Note: If no filename is given one is generated from the filters. With the 'auto' format
+    the filename's extension decides, or else Parquet is used when the trades do not fit
+    on one Excel sheet. Exports estimated to examine over ADMISSION_MAX_ROWS rows are
+    confirmed first
+    Returns the list of files written
+    '''
 
-                try:
-                    broker_id_list = broker_id.split(' ')
-                    for id in broker_id_list:
-                        assert id.isdigit(), '\n(!!!!!) Please enter digit(s) for Broker ID!\n'
+    if not SNAPSHOT and not admit_queries(build_trade_queries(
+            share_ids=share_ids, broker_ids=broker_ids, date_range=date_range)):
+        return []
 
-                except AssertionError as errMsg:
-                    print(errMsg)
-                    continue
+    if fmt == 'auto' and filename is not None:
+        fmt = next((name for name in EXPORT_FORMATS[1:] if filename.endswith('.' + name)), 'auto')
 
-                else:
-                    break
+    if fmt == 'auto':
+        count = count_trades(share_ids, broker_ids, date_range)
+        fmt = 'parquet' if count > EXCEL_MAX_ROWS - 1 else 'xlsx'
+        print(f"\n>>>>> {count} trades to export, writing {fmt}\n")
 
-            # Loop through multiple values provided for broker_id
-            count = 0
-            for id in broker_id_list:
-                condition = f"broker_id = {id}"
+    # Default file name, updated with each filter
+    if filename is None:
+        filename = 'trade_details'
 
-                if count == 0:
-                    sql = append_sql(sql, condition, "AND", True)
-                else:
-                    sql = append_sql(sql, condition, 'OR', False)
+        if share_ids:
+            filename += f"_share_id_{'_'.join(map(str, share_ids))}"
 
-                count += 1
+        if broker_ids:
+            filename += f"_broker_id_{'_'.join(map(str, broker_ids))}"
 
-            sql += ')'
-            filename += f"_broker_id_{'_'.join(broker_id_list)}"
+        if date_range:
+            start, end = date_range
+            filename += f"_date_range_{start.strftime('%d%m%Y')}_{end.strftime('%d%m%Y')}"
 
-        # Add date condition if specified by user
-        if '3' in selection:
+        filename += '.' + fmt
 
-            while True:
+    queries = build_trade_queries(share_ids=share_ids, broker_ids=broker_ids,
+                                  date_range=date_range, suffix=' ORDER BY trade_id')
 
-                date_range = input(
-                    "Please enter a Date Range in the format (DDMMYYYY - DDMMYYYY): ")
+    # Stream rows from the snapshot, the server or the merged worker output straight into the file(s) and launch
+    if SNAPSHOT:
+        batches = frame_batches(snapshot_trades(share_ids=share_ids, broker_ids=broker_ids,
+                                                date_range=date_range))
+    elif workers > 1 and ANALYTICS_BACKEND == 'mysql' and SERVICE_URL is None:
+        print_queries(queries)
+        batches = parallel_stream_trades(queries, share_ids, broker_ids, date_range, workers)
+    else:
+        print_queries(queries)
+        batches = stream_queries(queries, analytical=True)
+    headers = TRADE_COLUMNS
+    if ENRICH_TRADES:
+        batches = enrich_batches(batches)
+        headers = ENRICHED_TRADE_COLUMNS
 
-                try:
-                    start_date = date_range.split(' - ')[0]
-                    end_date = date_range.split(' - ')[1]
+    with query_time_limit(EXPORT_TIMEOUT_SECONDS):
+        filenames = EXPORT_WRITERS[fmt](batches, filename, headers)
+    for name in filenames:
+        print(f"\n>>>>> File Export Successful! Filename: {name}\n")
 
-                    start = f"{start_date[4:]}-{start_date[2:4]}-{start_date[:2]}"
-                    end = f"{end_date[4:]}-{end_date[2:4]}-{end_date[:2]}"
-                    condition = f"transaction_time >= '{start}' AND transaction_time <= '{end}'"
+    if launch and fmt == 'xlsx' and excel_available():
+        print(f"\n>>>>> Launching {filenames[0]}...\n")
+        os.system(f"start EXCEL.EXE {filenames[0]}")
 
-                    sql_test = f"SELECT * FROM trades WHERE {condition};"
-                    execute_query(sql_test)
+    return filenames
 
-                except:
-                    print(
-                        '\n(!!!!!) Please enter a valid Date Range! (DDMMYYYY - DDMMYYYY)\n')
-                    continue
-                else:
-                    break
 
-            sql = append_sql(sql, condition, 'date')
-            sql += ')'
-            filename += f'_date_range_{start_date}_{end_date}'
+def count_trades(share_ids=None, broker_ids=None, date_range=None):
+    '''
+    Takes ZERO OR MORE filters, as for export_trades
+    Returns the number of matching trades
+    '''
 
-        sql += ';'
-        filename += '.xlsx'
-        print(f'\n>>>>> Your Query: {sql}\n')
-        data = execute_query(sql)
+    if SNAPSHOT:
+        return len(snapshot_trades(share_ids=share_ids, broker_ids=broker_ids,
+                                   date_range=date_range))
+
+    queries = build_trade_queries(share_ids=share_ids, broker_ids=broker_ids,
+                                  date_range=date_range, columns='COUNT(*)')
+    return sum(execute_query(sql, params, analytical=True)[0][0] for sql, params in queries)
 
-        # Column names
-        cols = ['Trade ID', 'Share ID', 'Broker ID', 'Stock Ex ID',
-                'Transaction Time', 'Share Amount', 'Price Total']
-        # Generate DataFrame
-        df = convert_to_df(data, cols)
 
-        # Export to Excel and launch
-        df.to_excel(filename, index=False)
-        print(f"\n>>>>> File Export Successful! Filename: {filename}\n")
-        print(f"\n>>>>> Launching {filename}...\n")
-        os.system(f"start EXCEL.EXE {filename}")
+def excel_available():
+    '''
+    Returns True if Excel is installed on this host
+    Checks the PATH, then the App Paths registry key Windows uses to resolve EXCEL.EXE
+    '''
+
+    if os.name != 'nt':
+        return False
+
+    if shutil.which('EXCEL.EXE'):
+        return True
+
+    import winreg
+    try:
+        winreg.CloseKey(winreg.OpenKey(
+            winreg.HKEY_LOCAL_MACHINE,
+            r'SOFTWARE\Microsoft\Windows\CurrentVersion\App Paths\excel.exe'))
+    except OSError:
+        return False
+    return True
 
 
 #########################
@@ -581,68 +1068,83 @@ Selection: ''')
 #########################
 
 
-def trades_per_broker_hist():
+def trades_per_broker_hist(out=None):
     '''
     Queries for the number of trades made by each broker_id
 
     Generates and displays a bar chart to show number of trades made by each broker_id
+    If a filename (out) is given the chart is saved to it instead
+    '''
+
+    fig = new_figure()
+    draw_broker_hist(fig.subplots(), get_broker_trade_counts())
+    finish_figure(fig, out)
+
+
+def get_broker_trade_counts():
+    '''
+    Returns the number of trades made by each broker_id as a pandas DataFrame
     '''
 
-    # Preparing DataFrame
+    if SERVICE_URL is not None:
+        return remote_frame('/reports/broker-counts')
+
+    # Preparing DataFrame, from the summary table if there is one
     cols = ['Broker ID', "Trades"]
-    data = execute_query(
-        'SELECT broker_id, COUNT(*) FROM trades GROUP BY broker_id;')
-    df = convert_to_df(data, cols)
+    data = read_trade_summary(
+        'SELECT broker_id, SUM(trades) FROM trade_summary_broker_day GROUP BY broker_id ORDER BY broker_id;')
+    if data is None:
+        data = execute_query(
+            'SELECT broker_id, COUNT(*) FROM trades GROUP BY broker_id ORDER BY broker_id;',
+            analytical=True)
+    return convert_to_df(data, cols)
+
+
+def draw_broker_hist(ax, df):
+    '''
+    Takes a matplotlib Axes and the trades made by each broker_id
+    Draws a bar chart of the number of trades made by each broker_id
+    '''
+
+    import numpy as np
 
     # Create bars
     height = df['Trades']
     bars = df['Broker ID']
     y_pos = np.arange(len(bars))
-    plt.bar(y_pos, height)
+    ax.bar(y_pos, height)
 
     # Create title
-    plt.title("Number of Trades by Each Broker")
+    ax.set_title("Number of Trades by Each Broker")
 
     # Create names on the x-axis
-    plt.xticks(y_pos, bars)
+    ax.set_xticks(y_pos, bars)
 
     # Add labels
-    addlabels(y_pos, height)
+    addlabels(ax, y_pos, height)
 
     # Add axis labels
-    plt.xlabel("Broker ID")
-    plt.ylabel("Number of Trades")
-
-    # Present plot
-    plt.show()
+    ax.set_xlabel("Broker ID")
+    ax.set_ylabel("Number of Trades")
 
 
 def share_price_history():
     '''
-    Prompts user for a valid share_id value
+    Prompts user for ONE OR MORE valid share_id values and a resolution
 
-    Displays price history of share_id from earliest recorded time to current time
+    Displays price history of each share_id from earliest recorded time to current time,
+    overlaid in one chart
     '''
 
     while True:
 
-        share_id = input("\nEnter share_id to query: ")
+        print()
+        share_id_list = get_id_list('Share')
 
         try:
-
-            # Check if share_id provided is digit
-            assert share_id.isdigit(), ("\n(!!!!!) Please enter a digit for Share ID!\n")
-
-            # Check if share_id is a valid share_id
-            valid_share_ids = convert_to_df(execute_query(
-                'SELECT share_id FROM shares_prices GROUP BY share_id;'), ['share_id']).values.tolist()
-
-            # Convert list of list of items into list of items
-            valid_share_ids = [
-                item for sublist in valid_share_ids for item in sublist]
-
-            assert int(
-                share_id) in valid_share_ids, ("\n(!!!!!) Share ID does not exist!\n")
+            for id in share_id_list:
+                # Check if share_id is a valid share_id
+                assert is_valid_share_id(id), (f"\n(!!!!!) Share ID {id} does not exist!\n")
 
         except AssertionError as errMsg:
             print(errMsg)
@@ -651,134 +1153,4245 @@ def share_price_history():
         else:
             break
 
-    # Preparing DataFrame
-    cols = ('Share ID', 'Price', 'Time Start', 'Time End')
-    data = execute_query(
-        f'SELECT share_id, price, time_start, time_end FROM shares_prices WHERE share_id = {share_id} ORDER BY time_start ASC')
-    df = convert_to_df(data, cols)
+    while True:
+
+        resolution = input("Resolution (1. Raw 2. Daily 3. Weekly), press ENTER for Raw: ")
+
+        if resolution in ('', '1', '2', '3'):
+            break
+        print('\n(!!!!!) Invalid Selection!\n')
+
+    resolution = {'': 'raw', '1': 'raw', '2': 'daily', '3': 'weekly'}[resolution]
+    plot_share_price_history(share_id_list, resolution=resolution)
+
+
+def plot_share_price_history(share_ids, out=None, resolution='raw', max_points=None):
+    '''
+    Takes a list of valid share_id values, an optional filename (out), a resolution
+    ('raw', 'daily' or 'weekly') and the most points to plot per share
+
+    Displays price history of each share_id from earliest recorded time to current time,
+    overlaid in one chart, or saves it to out if given
+    '''
+
+    histories = get_price_histories(share_ids, resolution)
+    if not histories:
+        print("\n>>>>> No data found\n")
+        return 1
+
+    fig = new_figure()
+    draw_price_history(fig, fig.subplots(), histories, max_points)
+    finish_figure(fig, out)
+
+
+def get_price_histories(share_ids, resolution='raw'):
+    '''
+    Takes a list of share_id values and a resolution ('raw', 'daily' or 'weekly')
+    Fetches the price history of every share in a single query
+
+    Returns {share_id: pandas DataFrame ordered by time}
+    Raw histories have SHARE_PRICE_COLUMNS; daily/weekly histories have OHLC_COLUMNS,
+    with the bucketing done by the server
+    '''
+
+    if SERVICE_URL is not None:
+        df = remote_frame('/reports/price-history', {'share': share_ids, 'resample': resolution})
+    else:
+        df = fetch_price_history(share_ids, resolution)
+
+    return {share_id: history.reset_index(drop=True)
+            for share_id, history in df.groupby('Share ID', sort=False)}
+
+
+def fetch_price_history(share_ids, resolution='raw'):
+    '''
+    Takes a list of share_id values and a resolution, as for get_price_histories
+    Returns the price histories of all the shares as one pandas DataFrame
+    '''
+
+    predicate = in_predicate('share_id', share_ids)
+
+    if resolution == 'raw':
+        sql, params = build_query('SELECT share_id, price, time_start, time_end FROM shares_prices',
+                                  [predicate], ' ORDER BY share_id, time_start')
+        headers = SHARE_PRICE_COLUMNS
+    else:
+        sql, params = build_ohlc_query(predicate, resolution)
+        headers = OHLC_COLUMNS
+
+    return fetch_df([(sql, params)], headers, analytical=True)
+
 
-    # Get earliest time, lowest price, and highest price for chart axis limits
-    earliest_time = df['Time Start'][0]
-    lowest_price = df['Price'].min()
-    highest_price = df['Price'].max()
+def build_ohlc_query(predicate, resolution, backend=None):
+    '''
+    Takes a (condition, parameters) pair on shares_prices, a resolution ('daily' or 'weekly')
+    and the backend the query is for (ANALYTICS_BACKEND if not given)
+    Returns a (sql, params) pair that buckets each share's prices by day or week and returns
+    the open, high, low and close price of each bucket, ordered by share_id and bucket
+    '''
+
+    bucket = RESAMPLE_BUCKETS[backend or ANALYTICS_BACKEND][resolution]
+    condition, params = predicate
+    sql = f"""
+SELECT share_id, bucket, MAX(open_price), MAX(price), MIN(price), MAX(close_price)
+FROM (
+    SELECT share_id, price, {bucket} AS bucket,
+    FIRST_VALUE(price) OVER w AS open_price,
+    LAST_VALUE(price) OVER w AS close_price
+    FROM shares_prices
+    WHERE {condition}
+    WINDOW w AS (PARTITION BY share_id, {bucket} ORDER BY time_start
+                 ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING)
+) p
+GROUP BY share_id, bucket
+ORDER BY share_id, bucket;"""
+    return sql, params
+
+
+def draw_price_history(fig, ax, histories, max_points=None):
+    '''
+    Takes a matplotlib Figure and Axes, {share_id: price history ordered by time} and the
+    most points to plot per share (default MAX_PLOT_POINTS)
+    Draws each price history from earliest recorded time to current time
+
+    Note: Longer histories are downsampled with LTTB, which keeps the visual shape
+    A single resampled share is drawn as its close price with the high-low range shaded
+    '''
+
+    max_points = max_points or MAX_PLOT_POINTS
+    earliest_time = None
+    lowest_price = None
+    highest_price = None
+
+    for share_id, df in histories.items():
+        resampled = 'Close' in df.columns
+        price = df['Close'] if resampled else df['Price']
+        times = df['Time Start']
 
-    # Create plot, set x and y values, set x axis range and y axis range
-    fig, ax = plt.subplots()
-    ax.plot(df['Time Start'], df['Price'])
+        # Get earliest time, lowest price, and highest price for chart axis limits
+        low = df['Low'].min() if resampled else price.min()
+        high = df['High'].max() if resampled else price.max()
+        earliest_time = times.iloc[0] if earliest_time is None else min(earliest_time, times.iloc[0])
+        lowest_price = low if lowest_price is None else min(lowest_price, low)
+        highest_price = high if highest_price is None else max(highest_price, high)
+
+        # Shade the high-low range of a single resampled share before downsampling the line
+        if resampled and len(histories) == 1:
+            ax.fill_between(times, df['Low'], df['High'], alpha=0.3, step='mid')
+
+        points = lttb(times.values.astype('int64').astype('float64'), price.values, max_points)
+        ax.plot(times.values[points], price.values[points], label=f'Share ID {share_id}')
+
+    # Set x axis range and y axis range
     fig.autofmt_xdate()
     ax.set_xlim([date(earliest_time.year, earliest_time.month,
                 earliest_time.day), date.today()])
     ax.set_ylim([lowest_price * 0.90, highest_price * 1.05])
 
     # Create title
-    plt.title(f"Price History of Share ID {share_id}")
+    if len(histories) == 1:
+        ax.set_title(f"Price History of Share ID {next(iter(histories))}")
+    else:
+        ax.set_title(f"Price History of Share IDs {', '.join(map(str, histories))}")
+        ax.legend()
 
     # Add axis labels
-    plt.xlabel("Date")
-    plt.ylabel("Share Price")
+    ax.set_xlabel("Date")
+    ax.set_ylabel("Share Price")
+
+
+def lttb(x, y, threshold):
+    '''
+    Takes NumPy arrays of x and y values (x ascending) and the number of points to keep
+    Returns the indices of the points kept by Largest-Triangle-Three-Buckets downsampling
+
+    The first and last points are always kept; between them the points are split into
+    threshold - 2 buckets, and from each bucket the point forming the largest triangle
+    with the previously kept point and the average of the next bucket is kept
+    '''
+
+    import numpy as np
+
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    edges[-1] = n - 1
+    kept = np.empty(threshold, dtype=np.int64)
+    kept[0] = 0
+    kept[-1] = n - 1
+    previous = 0
 
-    # Display plot
-    plt.show()
+    for bucket in range(threshold - 2):
+        start, end = edges[bucket], edges[bucket + 1]
 
+        # Average point of the next bucket (the last point, after the final bucket)
+        next_end = edges[bucket + 2] if bucket + 2 < len(edges) else n
+        next_x = x[end:next_end].mean()
+        next_y = y[end:next_end].mean()
 
-def trade_proportion():
+        area = np.abs((x[previous] - next_x) * (y[start:end] - y[previous])
+                      - (x[previous] - x[start:end]) * (next_y - y[previous]))
+        previous = start + int(np.argmax(area))
+        kept[bucket + 1] = previous
+
+    return kept
+
+
+def trade_proportion(out=None):
     '''
     Query for distribution of trades across stock exchanges and store data into DataFrame
 
-    Generate Pie chart to show data
+    Generate Pie chart to show data, or save it to a file (out) if given
+    '''
+
+    fig = new_figure()
+    draw_exchange_pie(fig.subplots(), get_exchange_trade_counts())
+    finish_figure(fig, out)
+
+
+def get_exchange_trade_counts():
+    '''
+    Returns the number of trades made on each stock exchange as a pandas DataFrame
     '''
 
-    # Query and convert output into DataFrame
-    sql = """
+    if SERVICE_URL is not None:
+        return remote_frame('/reports/exchange-counts')
+
+    # Query and convert output into DataFrame, from the summary table if there is one
+    data = read_trade_summary("""
+SELECT s.name, SUM(t.trades)
+FROM trade_summary_exchange_day t
+INNER JOIN stock_exchanges s
+ON t.stock_ex_id = s.stock_ex_id
+GROUP BY s.name
+ORDER BY s.name;""")
+
+    if data is None:
+        data = execute_query("""
 SELECT s.name, COUNT(t.trade_id)
 FROM trades t
 INNER JOIN stock_exchanges s
 ON t.stock_ex_id = s.stock_ex_id
-GROUP BY s.name;"""
+GROUP BY s.name
+ORDER BY s.name;""", analytical=True)
 
-    df = convert_to_df(execute_query(sql), ['Stock Exchanges', 'Trades'])
+    return convert_to_df(data, ['Stock Exchanges', 'Trades'])
+
+
+def draw_exchange_pie(ax, df):
+    '''
+    Takes a matplotlib Axes and the trades made on each stock exchange
+    Draws a pie chart of the distribution of trades across stock exchanges
+    '''
 
     # Chart Data
     y = df['Trades']
     mylabels = df['Stock Exchanges']
 
     # Create title
-    plt.title(f"Distribution of Trades Across Stock Exchanges")
+    ax.set_title(f"Distribution of Trades Across Stock Exchanges")
 
-    # Create and show plot
-    plt.pie(y, labels=mylabels)
-    plt.show()
+    # Create plot
+    ax.pie(y, labels=mylabels)
 
 
-#####################
-## Other Functions ##
-#####################
+def render_all_reports(out_dir, fmt='png', resolution='raw', max_points=None):
+    '''
+    Takes an output directory, an image format ('png' or 'svg'), the price history
+    resolution ('raw', 'daily' or 'weekly') and the most points to plot per share
+    Renders every report headlessly in a single pass: the broker histogram, the stock
+    exchange pie chart and one price history chart per share
 
+    Returns the list of files written
 
-def append_sql(sql, condition, operator, first=True):
-    '''
-    Function takes 4 arguments, current SQL string, condition to be added,
-    operator or condition ('AND' or 'OR'),
-    and whether it is the first condition of the same attribute (to add brackets or not)
-    Returns new SQL string with condition added appropriately
+    Note: Prices for all shares are read with one streamed query ordered by share_id,
+    and each share's chart is saved and closed as soon as its rows are complete
     '''
 
-    # Check if current SQL string already has a WHERE clause. If so, append AND instead
-    if 'WHERE' not in sql:
-        sql += f" WHERE ("
-    elif operator != 'date':
-        if first:
-            sql += f" {operator} ("
-        else:
-            sql += f" {operator} "
+    set_headless()
+    os.makedirs(out_dir, exist_ok=True)
+    filenames = []
+
+    def save(fig, name):
+        filename = os.path.join(out_dir, f'{name}.{fmt}')
+        finish_figure(fig, filename)
+        filenames.append(filename)
+
+    fig = new_figure()
+    draw_broker_hist(fig.subplots(), get_broker_trade_counts())
+    save(fig, 'trades_per_broker')
+
+    fig = new_figure()
+    draw_exchange_pie(fig.subplots(), get_exchange_trade_counts())
+    save(fig, 'trades_per_stock_exchange')
+
+    # Group the streamed rows by share, drawing each share once all its rows have arrived
+    if resolution == 'raw':
+        sql = 'SELECT share_id, price, time_start, time_end FROM shares_prices ORDER BY share_id, time_start;'
+        params = None
+        headers = SHARE_PRICE_COLUMNS
     else:
-        sql += f" AND ("
+        sql, params = build_ohlc_query(('1 = 1', []), resolution)
+        headers = OHLC_COLUMNS
+    rows = (row for batch in stream_query(sql, params, analytical=True) for row in batch)
 
-    sql += condition
-    return sql
+    # The stream stays open while every chart renders, so it gets an export's time limit
+    with query_time_limit(EXPORT_TIMEOUT_SECONDS):
+        for share_id, share_rows in groupby(rows, key=lambda row: row[0]):
+            df = convert_to_df(list(share_rows), headers)
+            fig = new_figure()
+            draw_price_history(fig, fig.subplots(), {share_id: df}, max_points)
+            save(fig, f'price_history_share_{share_id}')
+
+    return filenames
 
 
-def execute_query(query):
+def set_headless():
     '''
-    Takes a single SQL query string, executes, and returns SQL output as a list of rows
+    Switches report rendering to the non-interactive Agg backend
+    Charts are then only ever saved to files, so no display is needed
     '''
 
-    # Execute query and return all rows of output
-    cursor.execute(query)
-    return cursor.fetchall()
+    global HEADLESS
+
+    # pyplot is only switched over if something already loaded it
+    if 'matplotlib.pyplot' in sys.modules:
+        sys.modules['matplotlib.pyplot'].switch_backend('Agg')
+    else:
+        import matplotlib
+        matplotlib.use('Agg')
+    HEADLESS = True
 
 
-def convert_to_df(data, headers):
+def new_figure():
     '''
-    Takes SQL query output's list of rows (data) and a list of column names (headers) as argument
-    Returns a pandas DataFrame object
+    Returns a new matplotlib Figure
 
-    Note: The number of columns in data and headers must be equal
+    Note: In headless mode the Figure is created directly on an Agg canvas rather than
+    through pyplot, so pyplot never keeps a reference to it
     '''
 
-    # Create and return DataFrame
-    df = pd.DataFrame(data, columns=headers)
-    return df
+    if HEADLESS:
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+        fig = Figure()
+        FigureCanvasAgg(fig)
+        return fig
 
+    import matplotlib.pyplot as plt
+    return plt.figure()
 
-def addlabels(x, y):
+
+def finish_figure(fig, out=None):
     '''
-    Adds y labels to plot
+    Takes a Figure and displays it, or saves it to a file (out) if given
+    The Figure is closed straight afterwards so its memory is released
     '''
 
-    for i in range(len(x)):
-        plt.text(i, y[i], y[i])
+    # Figures made in headless mode never go through pyplot, so it is not loaded for them
+    if out is None:
+        import matplotlib.pyplot as plt
+        plt.show()
+    else:
+        fig.savefig(out)
+        print(f"\n>>>>> Chart saved! Filename: {out}\n")
 
+    if HEADLESS:
+        fig.clear()
+    else:
+        import matplotlib.pyplot as plt
+        plt.close(fig)
 
-def main():
 
-    while True:
+#########################
+## Valuation Functions ##
+#########################
+
+
+def mark_to_market():
+    '''
+    Prompts user for ZERO OR MORE trade filters and a valuation date
+    Prints the unrealized P&L of the matching trades per share and per broker
+    '''
+
+    print('\nPlease enter the trades to value. Press ENTER to skip a filter and value every trade.\n')
+    share_ids, broker_ids, date_range = get_trade_filters()
+
+    while True:
+
+        valuation_date = input("Valuation date (DDMMYYYY), press ENTER for the latest prices: ")
+
+        try:
+            at = parse_date(valuation_date) if valuation_date else None
+
+        except ValueError:
+            print('\n(!!!!!) Please enter a valid date! (DDMMYYYY)\n')
+
+        else:
+            break
+
+    return print_valuation(share_ids, broker_ids, date_range, at)
+
+
+def print_valuation(share_ids=None, broker_ids=None, date_range=None, at=None,
+                    by=('share', 'broker'), out=None):
+    '''
+    Takes ZERO OR MORE filters on the trades table, as for build_trade_queries, a valuation
+    date (None for the latest prices), the breakdowns to print ('trade', 'share', 'broker')
+    and an optional filename to write the valued trades to
+    Values the matching trades and prints the unrealized P&L of each breakdown and in total
+
+    Returns an exit status
+    '''
+
+    valued = value_trades(share_ids, broker_ids, date_range, at)
+
+    # If no data returned from SQL, inform user
+    if valued is None or len(valued) == 0:
+        print("\n>>>>> No data found\n")
+        return 1
+
+    when = f"at the close of {at:%d/%m/%Y}" if at else 'at the latest prices'
+    print(f"\n>>>>> {len(valued)} trades valued {when}\n")
+
+    if 'trade' in by:
+        print((enrich_trades(valued) if ENRICH_TRADES else valued).to_string(index=False))
+    for level in [level for level in ('share', 'broker') if level in by]:
+        print(f"\n>>>>> Unrealized P&L per {level}\n")
+        print(summarize_valuation(valued, VALUATION_LEVELS[level]).to_string(index=False))
+
+    # Totals are over the priced trades only, so cost, value and P&L reconcile
+    priced = valued[valued['Mark Price'].notna()]
+    unpriced = len(valued) - len(priced)
+    print(f"\n>>>>> Total cost {priced['Price Total'].sum():,.2f}, "
+          f"market value {priced['Market Value'].sum():,.2f}, "
+          f"unrealized P&L {priced['Unrealized P&L'].sum():,.2f}\n")
+    if unpriced:
+        print(f"\n(!!!!!) {unpriced} trades have no price in force at the valuation date and are left out\n")
+
+    if out is not None:
+        fmt = next((name for name in EXPORT_FORMATS[1:] if out.endswith('.' + name)), 'csv')
+        EXPORT_WRITERS[fmt](frame_batches(valued), out, list(valued.columns))
+        print(f"\n>>>>> Valued trades written to {out}\n")
+
+
+def value_trades(share_ids=None, broker_ids=None, date_range=None, at=None):
+    '''
+    Takes ZERO OR MORE filters on the trades table, as for build_trade_queries, and a
+    valuation date (None for each share's latest price)
+    Fetches the matching trades and the price histories of their shares
+
+    Returns the valued trades as for mark_trades, or None if user declined the search
+    '''
+
+    if SNAPSHOT:
+        trades = snapshot_trades(share_ids=share_ids, broker_ids=broker_ids, date_range=date_range)
+    else:
+        queries = build_trade_queries(share_ids=share_ids, broker_ids=broker_ids,
+                                      date_range=date_range, suffix=' ORDER BY trade_id')
+        print_queries(queries)
+        if not admit_queries(queries):
+            return None
+        trades = fetch_df(queries, TRADE_COLUMNS, analytical=True)
+
+    share_ids = sorted(set(trades['Share ID'].tolist()))
+    if not share_ids:
+        prices = convert_to_df([], SHARE_PRICE_COLUMNS)
+    elif SNAPSHOT:
+        prices = load_snapshot('shares_prices')
+        prices = prices[prices['Share ID'].isin(share_ids)]
+    else:
+        prices = fetch_price_history(share_ids)
+
+    return mark_trades(trades, prices, at)
+
+
+def mark_trades(trades, prices, at=None):
+    '''
+    Takes a pandas DataFrame of trades (TRADE_COLUMNS), one of price intervals
+    (SHARE_PRICE_COLUMNS) and a valuation date (None for each share's latest price)
+
+    Returns the trades with 'Trade Price' (the price in force at the transaction time),
+    'Mark Price' (the price in force at the close of the valuation date), 'Market Value'
+    (the shares at the mark price) and 'Unrealized P&L' (market value less price paid) added
+
+    Note: A share's price intervals [time_start, time_end) do not overlap, so the price in
+    force at a time is the last one to start at or before it, if that has not yet ended.
+    Trades with no such price get NaN. The latest price (no valuation date) is the last
+    one recorded, ended or not
+    '''
+
+    import numpy as np
+
+    series = price_series(prices)
+    share_ids = trades['Share ID'].to_numpy()
+    times = trades['Transaction Time'].to_numpy('datetime64[ns]').view('int64')
+
+    if at is None:
+        marks = np.full(len(trades), np.iinfo(np.int64).max)
+    else:
+        close = np.datetime64(datetime.combine(at, datetime.max.time()), 'ns')
+        marks = np.full(len(trades), close.astype('int64'))
+
+    valued = trades.copy()
+    valued['Trade Price'] = prices_at(series, share_ids, times)
+    valued['Mark Price'] = prices_at(series, share_ids, marks, bounded=at is not None)
+    valued['Market Value'] = valued['Share Amount'] * valued['Mark Price']
+    valued['Unrealized P&L'] = valued['Market Value'] - valued['Price Total']
+
+    return valued
+
+
+def price_series(prices):
+    '''
+    Takes a pandas DataFrame of price intervals (SHARE_PRICE_COLUMNS)
+    Returns {share_id: (start times, end times, prices)}, numpy arrays sorted by start time
+    with the times as int64 nanoseconds
+
+    Note: An interval with no end time is open, and ends at the largest int64
+    '''
+
+    import numpy as np
+
+    prices = prices.sort_values(['Share ID', 'Time Start'], kind='stable')
+    share_ids = prices['Share ID'].to_numpy()
+    starts = prices['Time Start'].to_numpy('datetime64[ns]').view('int64')
+    ends = prices['Time End'].to_numpy('datetime64[ns]').view('int64')
+    ends = np.where(ends == np.iinfo(np.int64).min, np.iinfo(np.int64).max, ends)
+    values = prices['Price'].to_numpy('float64')
+
+    bounds = np.flatnonzero(np.diff(share_ids)) + 1
+    return {int(share_ids[start]): (starts[start:stop], ends[start:stop], values[start:stop])
+            for start, stop in zip(np.r_[0, bounds], np.r_[bounds, len(share_ids)]) if start < stop}
+
+
+def prices_at(series, share_ids, times, bounded=True):
+    '''
+    Takes price series from price_series, numpy arrays of share_id values and of times
+    as int64 nanoseconds, and whether a price stops applying at its interval's end time
+    Returns a numpy array of the price of each share in force at each time (NaN if none)
+
+    Note: Rows are grouped by share and each group is found in its share's start times
+    with one binary search (searchsorted), so there is no per-row Python or SQL
+    '''
+
+    import numpy as np
+
+    result = np.full(len(times), np.nan)
+    order = np.argsort(share_ids, kind='stable')
+    sorted_ids = share_ids[order]
+
+    bounds = np.flatnonzero(np.diff(sorted_ids)) + 1
+    for start, stop in zip(np.r_[0, bounds], np.r_[bounds, len(order)]):
+        if start == stop or int(sorted_ids[start]) not in series:
+            continue
+
+        starts, ends, values = series[int(sorted_ids[start])]
+        rows = order[start:stop]
+        positions = np.searchsorted(starts, times[rows], side='right') - 1
+        found = positions >= 0
+
+        # Times in a gap between intervals, or after the last has closed, have no price
+        if bounded:
+            found &= times[rows] < ends[np.maximum(positions, 0)]
+        result[rows[found]] = values[positions[found]]
+
+    return result
+
+
+def summarize_valuation(valued, column):
+    '''
+    Takes valued trades from mark_trades and the ID column to group them on
+    Returns the number of trades, shares held, cost, market value and unrealized P&L of each
+    ID as a pandas DataFrame, named from the dimension store if ENRICH_TRADES is set
+
+    Note: Trades counts every trade; the other columns only sum the priced ones, so they
+    reconcile with each other
+    '''
+
+    priced = valued['Mark Price'].notna()
+    valued = valued.assign(**{'Share Amount': valued['Share Amount'].where(priced, 0),
+                              'Price Total': valued['Price Total'].where(priced, 0.0)})
+
+    summary = valued.groupby(column, sort=True).agg(**{
+        'Trades': ('Trade ID', 'size'),
+        'Share Amount': ('Share Amount', 'sum'),
+        'Cost': ('Price Total', 'sum'),
+        'Market Value': ('Market Value', 'sum'),
+        'Unrealized P&L': ('Unrealized P&L', 'sum')
+    }).reset_index()
+
+    return add_names(summary, column)
+
+
+#########################
+## Analytics Functions ##
+#########################
+
+
+def analytics_report(name):
+    '''
+    Takes the name of one of ANALYTICS_REPORTS
+    Prompts user for ZERO OR MORE trade filters, and the window or number of movers the
+    report needs, and prints the report
+    '''
+
+    print('\nPlease enter the trades to report on. Press ENTER to skip a filter and use every trade.\n')
+    share_ids, broker_ids, date_range = get_trade_filters()
+
+    window = ROLLING_WINDOW_DAYS
+    top = TOP_MOVERS
+    if name == 'rolling-volume':
+        window = get_count('Rolling window in trading days', ROLLING_WINDOW_DAYS)
+    if name == 'top-movers':
+        top = get_count('Gainers and losers to show', TOP_MOVERS)
+
+    return print_analytics(name, share_ids, broker_ids, date_range, window, top)
+
+
+def print_analytics(name, share_ids=None, broker_ids=None, date_range=None,
+                    window=ROLLING_WINDOW_DAYS, top=TOP_MOVERS, out=None):
+    '''
+    Takes the name of one of ANALYTICS_REPORTS, ZERO OR MORE filters on the trades table,
+    the rolling window in trading days, the number of top movers and an optional filename
+    Prints the report as a pandas DataFrame to stdout, and writes it to the file if given
+
+    Returns an exit status
+    '''
+
+    report, title = ANALYTICS_REPORTS[name]
+    options = {'rolling-volume': {'window': window}, 'top-movers': {'top': top}}.get(name, {})
+    df = report(share_ids, broker_ids, date_range, **options)
+
+    # If no data returned from SQL, inform user
+    if len(df) == 0:
+        print("\n>>>>> No data found\n")
+        return 1
+
+    print(f"\n>>>>> {title}\n")
+    print(df)
+
+    if out is not None:
+        fmt = next((extension for extension in EXPORT_FORMATS[1:] if out.endswith('.' + extension)), 'csv')
+        EXPORT_WRITERS[fmt](frame_batches(df), out, list(df.columns))
+        print(f"\n>>>>> Report written to {out}\n")
+
+
+def trade_predicates(share_ids=None, broker_ids=None, date_range=None):
+    '''
+    Takes ZERO OR MORE of a list of share_id values, a list of broker_id values and an
+    inclusive date range
+    Returns the (condition, parameters) pairs selecting the matching trades
+    '''
+
+    predicates = []
+    if share_ids:
+        predicates.append(in_predicate('share_id', share_ids))
+    if broker_ids:
+        predicates.append(in_predicate('broker_id', broker_ids))
+    if date_range:
+        predicates.append(date_range_predicate('transaction_time', *date_range))
+
+    return predicates
+
+
+def daily_share_query(share_ids=None, broker_ids=None, date_range=None):
+    '''
+    Takes ZERO OR MORE filters, as for trade_predicates
+    Returns a (sql, params) pair, without its semicolon, grouping the matching trades by share
+    and day into share_id, trade_date, notional, volume and trades columns
+    '''
+
+    sql, params = build_query(
+        'SELECT share_id, DATE(transaction_time) AS trade_date, SUM(price_total) AS notional, '
+        'SUM(share_amount) AS volume, COUNT(*) AS trades FROM trades',
+        trade_predicates(share_ids, broker_ids, date_range),
+        ' GROUP BY share_id, DATE(transaction_time)')
+
+    return sql.rstrip(';'), params
+
+
+def vwap_report(share_ids=None, broker_ids=None, date_range=None):
+    '''
+    Takes ZERO OR MORE filters, as for trade_predicates
+    Returns the volume weighted average price (notional over shares traded), volume and
+    number of trades of each share on each day as a pandas DataFrame
+    '''
+
+    daily, params = daily_share_query(share_ids, broker_ids, date_range)
+    sql = (f'SELECT share_id, trade_date, notional / volume, volume, trades '
+           f'FROM ({daily}) daily ORDER BY share_id, trade_date;')
+
+    return add_names(convert_to_df(execute_query(sql, params, analytical=True), VWAP_COLUMNS),
+                     'Share ID')
+
+
+def rolling_volume_report(share_ids=None, broker_ids=None, date_range=None, window=ROLLING_WINDOW_DAYS):
+    '''
+    Takes ZERO OR MORE filters, as for trade_predicates, and a window in trading days
+    Returns the shares of each share traded on each day, and over the window of trading
+    days ending on it, as a pandas DataFrame
+
+    Note: The rolling sum is a window function over the daily totals, so the server does it
+    in the same pass as the grouping
+    '''
+
+    daily, params = daily_share_query(share_ids, broker_ids, date_range)
+    sql = (f'SELECT share_id, trade_date, volume, SUM(volume) OVER (PARTITION BY share_id '
+           f'ORDER BY trade_date ROWS BETWEEN {int(window) - 1} PRECEDING AND CURRENT ROW) '
+           f'FROM ({daily}) daily ORDER BY share_id, trade_date;')
+
+    return add_names(convert_to_df(execute_query(sql, params, analytical=True), ROLLING_VOLUME_COLUMNS),
+                     'Share ID')
+
+
+def broker_turnover_report(share_ids=None, broker_ids=None, date_range=None):
+    '''
+    Takes ZERO OR MORE filters, as for trade_predicates
+    Returns the trades, shares traded, notional (sum of price_total), average notional per
+    trade, share of all notional and notional rank of each broker as a pandas DataFrame,
+    largest first
+    '''
+
+    sql, params = build_query(
+        'SELECT broker_id, COUNT(*), SUM(share_amount), SUM(price_total), AVG(price_total), '
+        '100 * SUM(price_total) / SUM(SUM(price_total)) OVER (), '
+        'RANK() OVER (ORDER BY SUM(price_total) DESC) FROM trades',
+        trade_predicates(share_ids, broker_ids, date_range),
+        ' GROUP BY broker_id ORDER BY SUM(price_total) DESC, broker_id')
+
+    return add_names(convert_to_df(execute_query(sql, params, analytical=True), TURNOVER_COLUMNS),
+                     'Broker ID')
+
+
+def top_movers_report(share_ids=None, broker_ids=None, date_range=None, top=TOP_MOVERS):
+    '''
+    Takes ZERO OR MORE filters, as for trade_predicates, and a number of shares
+    Returns the top gainers then the top losers, by change from each share's first to its
+    last daily VWAP in the matching trades, as a pandas DataFrame
+
+    Note: The server keeps only each share's first and last day (ROW_NUMBER over its days
+    both ways), and the changes are ranked with NumPy
+    '''
+
+    import numpy as np
+    import pandas as pd
+
+    daily, params = daily_share_query(share_ids, broker_ids, date_range)
+    sql = ('SELECT share_id, trade_date, notional / volume, day_first, day_last FROM ('
+           'SELECT share_id, trade_date, notional, volume, '
+           'ROW_NUMBER() OVER (PARTITION BY share_id ORDER BY trade_date) AS day_first, '
+           'ROW_NUMBER() OVER (PARTITION BY share_id ORDER BY trade_date DESC) AS day_last '
+           f'FROM ({daily}) daily) ranked WHERE day_first = 1 OR day_last = 1 '
+           'ORDER BY share_id, trade_date;')
+    ends = convert_to_df(execute_query(sql, params, analytical=True),
+                         ['Share ID', 'Date', 'VWAP', 'First', 'Last'])
+
+    # Rows come in share order, so each share's first and last days line up
+    first = ends[ends['First'].to_numpy() == 1]
+    last = ends[ends['Last'].to_numpy() == 1]
+    first_vwap = first['VWAP'].to_numpy()
+    last_vwap = last['VWAP'].to_numpy()
+
+    movers = pd.DataFrame({
+        'Share ID': first['Share ID'].to_numpy(),
+        'First Date': first['Date'].to_numpy(),
+        'Last Date': last['Date'].to_numpy(),
+        'First VWAP': first_vwap,
+        'Last VWAP': last_vwap,
+        'Change %': 100 * (last_vwap / first_vwap - 1)
+    })
+
+    # Largest change first, keeping the top gainers and the top losers
+    order = np.argsort(-movers['Change %'].to_numpy(), kind='stable')
+    if len(order) > 2 * top:
+        order = np.r_[order[:top], order[len(order) - top:]]
+
+    return add_names(movers.iloc[order].reset_index(drop=True), 'Share ID')
+
+
+def add_names(df, column):
+    '''
+    Takes a pandas DataFrame and its ID column ('Share ID' or 'Broker ID')
+    Returns it with the company or broker names of the IDs added after the column, from the
+    dimension store, if ENRICH_TRADES is set
+    '''
+
+    if ENRICH_TRADES:
+        name = next(name for name, (id_column, *_) in DIMENSIONS.items() if id_column == column)
+        df.insert(df.columns.get_loc(column) + 1, name,
+                  name_ids(name, df[column].to_numpy()))
+        df[name] = df[name].astype(COLUMN_TYPES[name])
+
+    return df
+
+
+###########################
+## Name Search Functions ##
+###########################
+
+
+def find_shares():
+    '''
+    Prompts user for a company name or part of one
+
+    Prints the best matching companies and their share_id values as a pandas DataFrame
+    '''
+
+    while True:
+
+        text = input("Please enter a company name, or the start of one: ").strip()
+
+        if text:
+            break
+        print('\n(!!!!!) Please enter a company name!\n')
+
+    return print_company_matches(text)
+
+
+def print_company_matches(text):
+    '''
+    Takes a company name, or part or a misspelling of one
+    Prints the best matching companies and their share_id values as a pandas DataFrame
+
+    Returns an exit status
+    '''
+
+    rows = [(name, share_id) for name, share_ids in search_companies(text) for share_id in share_ids]
+
+    # If no match found, inform user
+    if len(rows) == 0:
+        print("\n>>>>> No data found\n")
+        return 1
+
+    print(convert_to_df(rows, ['Company', 'Share ID']))
+
+
+def get_name_index():
+    '''
+    Returns the company name index (see build_name_index), built from the dimension store
+    and rebuilt whenever the store is reloaded, so it follows changes to companies and shares
+    '''
+
+    global name_index
+
+    store = get_dimensions()
+    if name_index is None or name_index[0] is not store:
+        name_index = (store, build_name_index(*store['Company']))
+
+    return name_index[1]
+
+
+def build_name_index(index, names):
+    '''
+    Takes the (index, names) arrays of the Company dimension
+    Returns the name index as a dict of:
+        names     - each company name once, sorted
+        folded    - the names case folded, for matching
+        share_ids - the share_id values of each name
+        prefixes  - sorted (text, position) pairs of every folded name and each word in it,
+                    so all names starting with a query are one binary search away
+        grams     - {trigram: positions of the names containing it}, for fuzzy matches
+        sizes     - the number of trigrams in each name
+    '''
+
+    import numpy as np
+
+    share_ids = np.flatnonzero(index >= 0)
+
+    companies = {}
+    for share_id, position in zip(share_ids.tolist(), index[share_ids].tolist()):
+        companies.setdefault(names[position], []).append(share_id)
+
+    entries = sorted(name for name in companies if name is not None)
+    folded = [' '.join(name.casefold().split()) for name in entries]
+
+    grams = {}
+    for position, name in enumerate(folded):
+        for gram in trigrams(name):
+            grams.setdefault(gram, []).append(position)
+
+    return {
+        'names': entries,
+        'folded': folded,
+        'share_ids': [companies[name] for name in entries],
+        'prefixes': sorted((text, position) for position, name in enumerate(folded)
+                           for text in {name, *name.split()}),
+        'grams': grams,
+        'sizes': [len(trigrams(name)) for name in folded]
+    }
+
+
+def trigrams(text):
+    '''
+    Takes a case folded string and returns the set of its three character substrings, padded
+    so the start of the string and of each word count for more
+    '''
+
+    padded = f"  {text.replace(' ', '  ')} "
+    return {padded[start:start + 3] for start in range(len(padded) - 2)}
+
+
+def search_companies(text, limit=NAME_SEARCH_LIMIT):
+    '''
+    Takes a company name, or part or a misspelling of one, and the most matches to return
+    Returns [(company name, [share_id, ...]), ...], best match first: an exact name, then
+    names starting with the text, then names with a word starting with it, then names
+    sharing enough trigrams with it (NAME_MATCH_THRESHOLD)
+    '''
+
+    from bisect import bisect_left
+
+    index = get_name_index()
+    query = ' '.join(text.casefold().split())
+    if not query:
+        return []
+
+    scores = {}
+
+    # Prefix matches sit together in the sorted prefixes, starting where the query would go
+    prefixes = index['prefixes']
+    for entry in range(bisect_left(prefixes, (query,)), len(prefixes)):
+        text, position = prefixes[entry]
+        if not text.startswith(query):
+            break
+        name = index['folded'][position]
+        score = 3.0 if name == query else 2.0 if name.startswith(query) else 1.5
+        scores[position] = max(score, scores.get(position, 0.0))
+
+    # Fuzzy matches by the Dice coefficient of shared trigrams, which always rank below
+    # prefix matches, so are only needed when those fall short of the limit
+    if len(scores) >= limit:
+        return top_companies(index, scores, limit)
+
+    grams = trigrams(query)
+    shared = Counter(position for gram in grams for position in index['grams'].get(gram, ()))
+    for position, count in shared.items():
+        dice = 2 * count / (len(grams) + index['sizes'][position])
+        if dice >= NAME_MATCH_THRESHOLD and position not in scores:
+            scores[position] = dice
+
+    return top_companies(index, scores, limit)
+
+
+def top_companies(index, scores, limit):
+    '''
+    Takes the company name index, {position: score} of the names matched and the most to return
+    Returns [(company name, [share_id, ...]), ...], best score first, then shortest name
+    '''
+
+    best = sorted(scores, key=lambda position: (-scores[position], len(index['names'][position]),
+                                                index['names'][position]))[:limit]
+    return [(index['names'][position], index['share_ids'][position]) for position in best]
+
+
+def resolve_company(text):
+    '''
+    Takes a company name, or part or a misspelling of one, typed at a Share ID prompt
+    Returns the share_id values of the company it names, asking user to pick one when it
+    matches several
+
+    Note: Raises AssertionError if no company matches
+    '''
+
+    matches = search_companies(text)
+    assert matches, f"\n(!!!!!) No company matches '{text}'!\n"
+
+    # A single or exact match needs no confirming
+    if len(matches) == 1 or matches[0][0].casefold() == ' '.join(text.casefold().split()):
+        print(f">>>>> {matches[0][0]}: Share ID {' '.join(map(str, matches[0][1]))}")
+        return matches[0][1]
+
+    print(f"\n>>>>> Companies matching '{text}':\n")
+    for number, (name, share_ids) in enumerate(matches, 1):
+        print(f"{number}. {name} (Share ID {' '.join(map(str, share_ids))})")
+    print()
+
+    while True:
+
+        selection = input(f"Pick a company (1-{len(matches)}): ")
+
+        if selection.isdigit() and 1 <= int(selection) <= len(matches):
+            return matches[int(selection) - 1][1]
+        print('\n(!!!!!) Invalid Selection!\n')
+
+
+def parse_share_ids(text):
+    '''
+    Takes the text of a Share ID prompt: IDs (1 2 3), company names, or both separated by
+    semicolons (Acme, Inc.; 4 5; Globex)
+    Returns the list of share_id values, resolving each name through the company name index
+
+    Note: Raises AssertionError if a name matches no company. Semicolons rather than commas
+    separate names, as company names often contain commas
+    '''
+
+    share_ids = []
+    for part in text.split(';'):
+        words = part.split()
+        if all(word.isdigit() for word in words):
+            share_ids += [int(word) for word in words]
+        else:
+            share_ids += resolve_company(part.strip())
+
+    assert share_ids, '\n(!!!!!) Please enter AT LEAST ONE Share ID or company name!\n'
+    return share_ids
+
+
+###############################
+## Parallel Export Functions ##
+###############################
+
+
+def parallel_stream_trades(queries, share_ids, broker_ids, date_range, workers):
+    '''
+    Takes the serial export's list of (sql, params) pairs, the filters they were built from
+    and the number of worker processes
+    Fetches the trades in partitions, each in its own worker process on its own connection,
+    showing per-partition progress
+
+    Yields the rows as batches in exactly the order the serial queries return them
+
+    Note: Partitions are ordered by trade_id and merged on trade_id. If the serial export
+    is already split into several statements, those statements are the partitions and
+    are concatenated in order instead
+    '''
+
+    if len(queries) > 1:
+        partitions = [[query] for query in queries]
+        merge = False
+    else:
+        partitions = [build_trade_queries(**filters, suffix=' ORDER BY trade_id') for filters in
+                      partition_trade_filters(share_ids, broker_ids, date_range, workers)]
+        merge = True
+
+    workdir = tempfile.mkdtemp(prefix='trade_export_')
+
+    try:
+        paths = run_export_partitions(partitions, workers, workdir)
+        readers = [read_partition(path) for path in paths]
+
+        if merge:
+            rows = heapq.merge(*readers, key=lambda row: row[0])
+        else:
+            rows = chain(*readers)
+
+        # Re-batch the merged rows for the writer
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == STREAM_BATCH_SIZE:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def partition_trade_filters(share_ids, broker_ids, date_range, count):
+    '''
+    Takes export filters (lists of share_id and broker_id values and an inclusive date range)
+    and the number of partitions wanted
+    Returns a list of at most count filter dicts (keyword arguments of build_trade_queries)
+    that together select the same trades
+
+    The date range is split into contiguous day ranges if given, otherwise the share or
+    broker list is split, otherwise the trade_id range is split
+    '''
+
+    filters = {'share_ids': share_ids, 'broker_ids': broker_ids, 'date_range': date_range}
+
+    if date_range:
+        # Narrow an open-ended range down to the dates that actually have trades
+        first, last = trade_bounds(filters, 'transaction_time')
+        if first is None:
+            return [filters]
+
+        first = max(date_range[0], first.date())
+        last = min(date_range[1], last.date())
+        days = (last - first).days + 1
+        count = min(count, days)
+        return [dict(filters, date_range=(first + timedelta(days=days * part // count),
+                                          first + timedelta(days=days * (part + 1) // count - 1)))
+                for part in range(count)]
+
+    for key in ('share_ids', 'broker_ids'):
+        values = sorted(filters[key] or [])
+        if len(values) > 1:
+            count = min(count, len(values))
+            return [dict(filters, **{key: values[len(values) * part // count:len(values) * (part + 1) // count]})
+                    for part in range(count)]
+
+    first, last = trade_bounds(filters, 'trade_id')
+    if first is None:
+        return [filters]
+
+    total = last - first + 1
+    count = min(count, total)
+    return [dict(filters, trade_id_ranges=[(first + total * part // count,
+                                            first + total * (part + 1) // count - 1)])
+            for part in range(count)]
+
+
+def trade_bounds(filters, column):
+    '''
+    Takes filter keyword arguments of build_trade_queries and a trades column
+    Returns the (lowest, highest) value of the column over the matching trades, across every
+    statement the filters are split into, or (None, None) if none match
+    '''
+
+    bounds = [execute_query(sql, params)[0] for sql, params in
+              build_trade_queries(**filters, columns=f'MIN({column}), MAX({column})')]
+    lows = [low for low, high in bounds if low is not None]
+    highs = [high for low, high in bounds if high is not None]
+
+    return (min(lows), max(highs)) if lows else (None, None)
+
+
+def run_export_partitions(partitions, workers, workdir):
+    '''
+    Takes a list of partitions (each a list of (sql, params) pairs), the number of worker
+    processes and a working directory
+    Runs every partition in a worker process and prints progress as rows arrive
+
+    Returns the path of each partition's output file, in partition order
+    '''
+
+    context = multiprocessing.get_context('spawn')
+    progress = context.Manager().Queue()
+    settings = {name: globals()[name] for name in WORKER_SETTINGS}
+    rows = [0] * len(partitions)
+    finished = [False] * len(partitions)
+    paths = [None] * len(partitions)
+    shown = None
+
+    def show_progress():
+        nonlocal shown
+        status = ' '.join(f"[{index + 1}: {count}{' done' if done else ''}]"
+                          for index, (count, done) in enumerate(zip(rows, finished)))
+        if status != shown:
+            print(f'\r>>>>> Partition rows: {status}', end='', flush=True)
+            shown = status
+
+    with ProcessPoolExecutor(max_workers=min(workers, len(partitions)), mp_context=context) as executor:
+        pending = {executor.submit(export_partition, index, queries, workdir, progress, settings)
+                   for index, queries in enumerate(partitions)}
+
+        while pending:
+            done, pending = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+
+            while not progress.empty():
+                index, count = progress.get()
+                rows[index] = count
+
+            for future in done:
+                index, paths[index], rows[index] = future.result()
+                finished[index] = True
+
+            show_progress()
+
+    print('\n')
+    return paths
+
+
+def export_partition(index, queries, workdir, progress, settings):
+    '''
+    Runs in a worker process
+    Takes the partition number, its list of (sql, params) pairs, a working directory, a
+    queue for progress updates and the parent's WORKER_SETTINGS values
+    Streams the partition's rows into a file of pickled batches on the worker's own connection
+
+    Returns (index, path of the file, number of rows)
+    '''
+
+    global POOL_SIZE, QUERY_TIMEOUT_SECONDS
+
+    globals().update(settings)
+
+    # One connection is all a worker needs, and its queries are export queries
+    POOL_SIZE = 1
+    QUERY_TIMEOUT_SECONDS = EXPORT_TIMEOUT_SECONDS
+    path = os.path.join(workdir, f'partition_{index:05d}.pickle')
+    rows = 0
+
+    try:
+        with open(path, 'wb') as file:
+            for batch in stream_queries(queries):
+                pickle.dump(batch, file, protocol=pickle.HIGHEST_PROTOCOL)
+                rows += len(batch)
+                progress.put((index, rows))
+    finally:
+        close_pool()
+
+    return index, path, rows
+
+
+def read_partition(path):
+    '''
+    Takes the path of a partition file written by export_partition and yields its rows
+    '''
+
+    with open(path, 'rb') as file:
+        while True:
+            try:
+                batch = pickle.load(file)
+            except EOFError:
+                return
+            yield from batch
+
+
+#############################
+## Summary Table Functions ##
+#############################
+
+
+def create_trade_summaries(summary_cursor):
+    '''
+    Takes a cursor and creates the trade summary tables and their watermark row if they
+    do not already exist, dropping any left by earlier versions (OLD_SUMMARY_TABLES)
+    '''
+
+    summary_cursor.execute(f"DROP TABLE IF EXISTS {', '.join(OLD_SUMMARY_TABLES)};")
+
+    for statement in SUMMARY_TABLES:
+        summary_cursor.execute(statement)
+
+    summary_cursor.execute(
+        'INSERT IGNORE INTO trade_summary_day_watermark (id, last_trade_id) VALUES (1, 0);')
+
+
+def refresh_trade_summaries():
+    '''
+    Brings the per-day broker and stock exchange trade summary tables up to date
+    Whole days are recomputed from trades: each day with a trade above the trade_id
+    watermark, and each day from SUMMARY_RESCAN_DAYS before the transaction_time watermark.
+    All tables and the watermark are updated in one transaction
+
+    Returns the number of trades above the trade_id watermark
+
+    Note: The re-scan window catches trades that commit after a higher trade_id was
+    summarised. A late trade dated before the window is only counted once its day is
+    recomputed for another reason
+    '''
+
+    with get_connection() as conn:
+        summary_cursor = conn.cursor()
+
+        try:
+            create_trade_summaries(summary_cursor)
+            conn.commit()
+            conn.start_transaction()
+
+            # Lock the watermark so concurrent refreshes do not interleave
+            summary_cursor.execute('SELECT last_trade_id, last_transaction_time '
+                                   'FROM trade_summary_day_watermark WHERE id = 1 FOR UPDATE;')
+            last_trade_id, last_transaction_time = summary_cursor.fetchone()
+
+            summary_cursor.execute(
+                'SELECT COUNT(*), MAX(trade_id), MAX(transaction_time) FROM trades WHERE trade_id > %s;',
+                (last_trade_id,))
+            new_trades, max_trade_id, max_transaction_time = summary_cursor.fetchone()
+
+            # Days to recompute
+            sql = 'SELECT DATE(transaction_time) FROM trades WHERE trade_id > %s'
+            params = [last_trade_id]
+            if last_transaction_time is not None:
+                sql += (' UNION SELECT DATE(transaction_time) FROM trades '
+                        'WHERE transaction_time >= %s')
+                params.append(datetime.combine(last_transaction_time.date(), datetime.min.time())
+                              - timedelta(days=SUMMARY_RESCAN_DAYS))
+            summary_cursor.execute(sql + ';', params)
+            days = sorted(row[0] for row in summary_cursor.fetchall())
+
+            for first, last in day_ranges(days):
+                start = datetime.combine(first, datetime.min.time())
+                end = datetime.combine(last + timedelta(days=1), datetime.min.time())
+                for table, statement in SUMMARY_UPDATES.items():
+                    summary_cursor.execute(
+                        f'DELETE FROM {table} WHERE trade_date >= %s AND trade_date < %s;',
+                        (start.date(), end.date()))
+                    summary_cursor.execute(statement, (start, end))
+
+            if max_trade_id is not None:
+                summary_cursor.execute(
+                    'UPDATE trade_summary_day_watermark SET last_trade_id = %s, '
+                    'last_transaction_time = GREATEST(COALESCE(last_transaction_time, %s), %s) '
+                    'WHERE id = 1;',
+                    (max_trade_id, max_transaction_time, max_transaction_time))
+            conn.commit()
+
+        except:
+            conn.rollback()
+            raise
+
+        finally:
+            summary_cursor.close()
+
+    return new_trades
+
+
+def day_ranges(days):
+    '''
+    Takes a sorted list of dates
+    Returns a list of inclusive (first, last) ranges of consecutive dates covering them
+    '''
+
+    ranges = []
+    for day in days:
+        if ranges and (day - ranges[-1][1]).days <= 1:
+            ranges[-1] = (ranges[-1][0], day)
+        else:
+            ranges.append((day, day))
+
+    return ranges
+
+
+def read_trade_summary(sql):
+    '''
+    Takes a query over the trade summary tables
+    Returns its rows, or None if the summaries can not be read or were never filled, e.g.
+    because 'maintenance refresh-summaries' has never run, so the caller counts the trades
+    directly instead
+
+    Note: Reports only ever read the summaries. Keeping them current is left to the
+    refresh-summaries maintenance task, run from cron or by hand
+    '''
+
+    if ANALYTICS_BACKEND != 'mysql':
+        return None
+
+    try:
+        watermark = execute_query('SELECT last_trade_id FROM trade_summary_day_watermark WHERE id = 1;')
+        if not watermark or not watermark[0][0]:
+            return None
+        return execute_query(sql)
+
+    except mysql.connector.Error:
+        return None
+
+
+########################
+## Snapshot Functions ##
+########################
+
+
+def sync_snapshot():
+    '''
+    Brings the local snapshot in SNAPSHOT_DIR up to date with the database
+    Tables with a watermark only pull the rows above the last one seen, appended as a new
+    Parquet part; the other (small) tables are reloaded in full
+
+    Returns a dict of the number of rows pulled per table
+
+    Note: Rows are pulled in watermark order, so an interrupted sync resumes where it stopped
+    '''
+
+    global snapshot_state
+
+    state = read_snapshot_state() or {'watermarks': {}, 'synced_at': None}
+    state.setdefault('boundaries', {})
+    pulled = {}
+
+    for table, (base, headers, watermark) in SNAPSHOT_TABLES.items():
+        directory = os.path.join(SNAPSHOT_DIR, table)
+        os.makedirs(directory, exist_ok=True)
+        parts = sorted(name for name in os.listdir(directory) if name.endswith('.parquet'))
+        predicates = []
+        suffix = ''
+        high = None
+        boundary = None
+
+        if watermark is not None:
+            column, header, key = watermark
+            high = state['watermarks'].get(table)
+
+            # Keys of the rows already pulled at the watermark value (a state saved before
+            # boundaries were kept has none, so pulls above the watermark as before)
+            if key is not None and high is not None and table in state['boundaries']:
+                boundary = set(state['boundaries'][table])
+                predicates.append((f'{column} >= %s', [high]))
+            elif high is not None:
+                predicates.append((f'{column} > %s', [high]))
+            elif key is not None:
+                boundary = set()
+            suffix = f' ORDER BY {column}'
+
+        sql, params = build_query(base, predicates, suffix)
+        rows = 0
+
+        def tracked(batches):
+            nonlocal rows, high, boundary
+            for batch in batches:
+                if watermark is not None and key is not None:
+                    position = headers.index(header)
+                    positions = [headers.index(name) for name in key]
+                    fresh = []
+                    for row in batch:
+                        row_key = tuple(row[index] for index in positions)
+                        if row[position] != high:
+                            high = row[position]
+                            boundary = set()
+                        elif row_key in boundary:
+                            continue
+                        boundary.add(row_key)
+                        fresh.append(row)
+                    batch = fresh
+                elif batch and watermark is not None:
+                    high = batch[-1][headers.index(header)]
+                rows += len(batch)
+                yield batch
+
+        # Write to a temporary file first so a failed pull never leaves a partial part behind
+        temp = os.path.join(directory, 'pull.tmp')
+        with query_time_limit(EXPORT_TIMEOUT_SECONDS):
+            write_parquet_stream(tracked(stream_query(sql, params or None)), temp, headers)
+
+        if watermark is None:
+            for name in parts:
+                os.remove(os.path.join(directory, name))
+            os.replace(temp, os.path.join(directory, 'part-000000.parquet'))
+        elif rows:
+            os.replace(temp, os.path.join(directory, f'part-{len(parts):06d}.parquet'))
+            state['watermarks'][table] = high
+            if boundary is not None:
+                state['boundaries'][table] = boundary
+        else:
+            os.remove(temp)
+
+        pulled[table] = rows
+        write_snapshot_state(state)
+
+    state['synced_at'] = datetime.now()
+    write_snapshot_state(state)
+    snapshot_state = state
+    return pulled
+
+
+def read_snapshot_state():
+    '''
+    Returns the snapshot's watermarks and sync time as a dict, or None if there is no snapshot
+    '''
+
+    try:
+        with open(os.path.join(SNAPSHOT_DIR, 'state.pickle'), 'rb') as state_file:
+            return pickle.load(state_file)
+
+    except FileNotFoundError:
+        return None
+
+
+def write_snapshot_state(state):
+    '''
+    Takes the snapshot's watermarks and sync time as a dict and saves them, replacing the
+    previous state in one step
+    '''
+
+    temp = os.path.join(SNAPSHOT_DIR, 'state.tmp')
+    with open(temp, 'wb') as state_file:
+        pickle.dump(state, state_file)
+    os.replace(temp, os.path.join(SNAPSHOT_DIR, 'state.pickle'))
+
+
+def snapshot_freshness():
+    '''
+    Returns a line telling when the snapshot was last synced and how old it is, flagged
+    as stale once older than SNAPSHOT_MAX_AGE seconds
+    '''
+
+    global snapshot_state
+
+    if snapshot_state is None:
+        snapshot_state = read_snapshot_state()
+
+    if snapshot_state is None or snapshot_state['synced_at'] is None:
+        return "\n(!!!!!) No local snapshot! Run 'maintenance sync-snapshot' first.\n"
+
+    synced_at = snapshot_state['synced_at']
+    age = datetime.now() - synced_at
+    age_text = str(timedelta(seconds=int(age.total_seconds())))
+
+    if age.total_seconds() > SNAPSHOT_MAX_AGE:
+        return f"\n(!!!!!) Local snapshot is stale! Synced {synced_at:%Y-%m-%d %H:%M:%S} ({age_text} ago)\n"
+    return f"\n>>>>> From local snapshot synced {synced_at:%Y-%m-%d %H:%M:%S} ({age_text} ago)\n"
+
+
+def load_snapshot(table):
+    '''
+    Takes the name of a table in SNAPSHOT_TABLES and prints the snapshot's freshness
+    Returns the table as a pandas DataFrame, read from its Parquet parts once per sync
+
+    Note: An empty DataFrame is returned if the table has not been synced
+    '''
+
+    import pandas as pd
+
+    print(snapshot_freshness())
+    synced_at = snapshot_state and snapshot_state['synced_at']
+
+    cached = snapshot_frames.get(table)
+    if cached is not None and cached[0] == synced_at:
+        return cached[1]
+
+    headers = SNAPSHOT_TABLES[table][1]
+    directory = os.path.join(SNAPSHOT_DIR, table)
+    parts = sorted(name for name in os.listdir(directory) if name.endswith('.parquet')) \
+        if os.path.isdir(directory) else []
+
+    if parts:
+        df = pd.concat([pd.read_parquet(os.path.join(directory, name)) for name in parts],
+                       ignore_index=True)
+    else:
+        df = convert_to_df([], headers)
+
+    snapshot_frames[table] = (synced_at, df)
+    return df
+
+
+def snapshot_trades(trade_ids=None, share_ids=None, broker_ids=None, date_range=None):
+    '''
+    Takes ZERO OR MORE filters on the trades table, as for build_trade_queries
+    Returns the matching trades from the local snapshot as a pandas DataFrame, ordered by trade_id
+    '''
+
+    import numpy as np
+
+    df = load_snapshot('trades')
+    mask = np.ones(len(df), dtype=bool)
+
+    for header, values in (('Trade ID', trade_ids), ('Share ID', share_ids),
+                           ('Broker ID', broker_ids)):
+        if values:
+            mask &= df[header].isin(values).to_numpy()
+
+    # Compare whole days so open-ended ranges (date.min/date.max) stay representable
+    if date_range:
+        start, end = date_range
+        days = df['Transaction Time'].to_numpy().astype('datetime64[D]')
+        mask &= (days >= np.datetime64(start)) & (days <= np.datetime64(end))
+
+    return df[mask].reset_index(drop=True)
+
+
+def snapshot_lookup(trade_ids, ranges):
+    '''
+    Takes a list of trade_id values and a list of inclusive (low, high) trade_id ranges
+    Returns the trades matching either from the local snapshot as a pandas DataFrame
+
+    Note: Snapshot trades are stored in trade_id order, so each range is found by binary search
+    '''
+
+    import numpy as np
+
+    df = load_snapshot('trades')
+    ids = df['Trade ID'].to_numpy()
+    mask = np.isin(ids, trade_ids)
+
+    if ranges:
+        starts = np.searchsorted(ids, [low for low, _ in ranges], side='left')
+        stops = np.searchsorted(ids, [high for _, high in ranges], side='right')
+        for start, stop in zip(starts, stops):
+            mask[start:stop] = True
+
+    return df[mask].reset_index(drop=True)
+
+
+def frame_batches(df, batch_size=STREAM_BATCH_SIZE):
+    '''
+    Takes a pandas DataFrame and yields its rows as lists of at most batch_size tuples,
+    like stream_query does for SQL output
+    '''
+
+    for start in range(0, len(df), batch_size):
+        yield list(df.iloc[start:start + batch_size].itertuples(index=False, name=None))
+
+
+#########################
+## Dimension Functions ##
+#########################
+
+
+def get_dimensions():
+    '''
+    Returns the dimension store: {name column: (index, names)} for each of DIMENSIONS, as
+    built by build_dimension
+
+    Note: The store is loaded on first use and reloaded when its tables change, which is
+    checked at most every DIMENSION_CHECK_SECONDS
+    '''
+
+    global dimension_store, dimension_version, dimension_checked
+
+    with dimension_lock:
+        if dimension_store is not None and time.monotonic() < dimension_checked + DIMENSION_CHECK_SECONDS:
+            return dimension_store
+
+        version = get_dimension_version()
+        if dimension_store is None or version != dimension_version:
+            dimension_store = load_dimensions()
+            dimension_version = version
+        dimension_checked = time.monotonic()
+
+        return dimension_store
+
+
+def get_dimension_version():
+    '''
+    Returns a value that changes whenever the dimension tables do: the snapshot's sync time
+    in snapshot mode, else the CHECKSUM TABLE of DIMENSION_TABLES
+
+    Note: The query service only serves SELECTs, so through it (or if CHECKSUM TABLE is not
+    allowed) the store is reloaded every REFERENCE_DATA_TTL seconds instead
+    '''
+
+    if SNAPSHOT:
+        return (read_snapshot_state() or {}).get('synced_at')
+
+    if SERVICE_URL is None:
+        try:
+            return tuple(execute_query(f"CHECKSUM TABLE {', '.join(DIMENSION_TABLES)};"))
+        except mysql.connector.Error:
+            pass
+
+    return int(time.monotonic() // REFERENCE_DATA_TTL)
+
+
+def load_dimensions():
+    '''
+    Loads every one of DIMENSIONS from the snapshot or the database
+
+    Returns the dimension store, as for get_dimensions
+    '''
+
+    store = {}
+
+    for column, (id_column, sql, table, headers) in DIMENSIONS.items():
+        if SNAPSHOT:
+            rows = list(load_snapshot(table)[headers].itertuples(index=False, name=None))
+        else:
+            rows = execute_query(sql)
+        store[column] = build_dimension(rows)
+
+    return store
+
+
+def build_dimension(rows):
+    '''
+    Takes (ID, name parts...) rows of a dimension table
+    Returns (index, names) numpy arrays: index[ID] is the dense position of the ID's name in
+    names, or -1 for unknown IDs, and names ends with None, so names[index[ids]] names a
+    whole array of IDs at once
+
+    Note: index is as long as the largest ID, which suits the small, dense IDs of dimension tables
+    '''
+
+    import numpy as np
+
+    ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+    index = np.full(int(ids.max()) + 1 if len(ids) else 0, -1, dtype=np.int32)
+    index[ids] = np.arange(len(ids), dtype=np.int32)
+
+    names = np.empty(len(rows) + 1, dtype=object)
+    names[:-1] = [' '.join(str(part) for part in row[1:]) for row in rows]
+
+    return index, names
+
+
+def name_ids(column, ids):
+    '''
+    Takes a name column of DIMENSIONS and a sequence of IDs
+    Returns a numpy array of the IDs' names, with None for IDs the dimension does not hold
+    '''
+
+    import numpy as np
+
+    index, names = get_dimensions()[column]
+    ids = np.asarray(ids, dtype=np.int64)
+
+    dense = np.full(len(ids), -1, dtype=np.int32)
+    known = (ids >= 0) & (ids < len(index))
+    dense[known] = index[ids[known]]
+
+    return names[dense]
+
+
+def enrich_trades(df):
+    '''
+    Takes a pandas DataFrame of trades with TRADE_COLUMNS
+    Returns it with the company, broker and exchange names of its IDs added (ENRICHED_TRADE_COLUMNS)
+    '''
+
+    df = df.copy()
+    for column, (id_column, *_) in DIMENSIONS.items():
+        df[column] = name_ids(column, df[id_column].to_numpy())
+        df[column] = df[column].astype(COLUMN_TYPES[column])
+
+    return df
+
+
+def enrich_batches(batches):
+    '''
+    Takes an iterable of trade row batches (TRADE_COLUMNS)
+    Yields each batch with the company, broker and exchange names of its IDs appended to
+    every row (ENRICHED_TRADE_COLUMNS)
+    '''
+
+    positions = [TRADE_COLUMNS.index(id_column) for id_column, *_ in DIMENSIONS.values()]
+
+    for batch in batches:
+        names = [name_ids(column, [row[position] for row in batch])
+                 for column, position in zip(DIMENSIONS, positions)]
+        yield [(*row, *row_names) for row, row_names in zip(batch, zip(*names))]
+
+
+#######################
+## Backend Functions ##
+#######################
+
+
+def get_duckdb():
+    '''
+    Returns a new cursor on the embedded DuckDB connection, opening it on first use
+    with a view over the local snapshot for each table in DUCKDB_VIEWS
+
+    Note: Views read the Parquet parts as they are at query time, so a sync is seen straight away
+    '''
+
+    global duckdb_conn
+
+    with duckdb_lock:
+        if duckdb_conn is None:
+            import duckdb
+
+            conn = duckdb.connect()
+            for view, (table, columns) in DUCKDB_VIEWS.items():
+                path = os.path.join(SNAPSHOT_DIR, table, '*.parquet').replace("'", "''")
+                # Microsecond timestamps, like MySQL's, so open-ended date ranges stay comparable
+                select = ', '.join(
+                    f'CAST("{header}" AS TIMESTAMP) AS {column}'
+                    if COLUMN_TYPES.get(header, '').startswith('datetime') else f'"{header}" AS {column}'
+                    for column, header in columns)
+                conn.execute(f"CREATE VIEW {view} AS SELECT {select} FROM read_parquet('{path}');")
+            duckdb_conn = conn
+
+        return duckdb_conn.cursor()
+
+
+def duckdb_sql(query):
+    '''
+    Takes a SQL query string with %s placeholders and returns it with DuckDB's ? placeholders
+    '''
+
+    return query.replace('%s', '?')
+
+
+def execute_duckdb(query, params=None):
+    '''
+    Takes a single SQL query string and optional parameters, executes it on the embedded
+    DuckDB connection, and returns SQL output as a list of rows
+    '''
+
+    duckdb_cursor = get_duckdb()
+    try:
+        started = time.perf_counter()
+        duckdb_cursor.execute(duckdb_sql(query), params)
+        executed = time.perf_counter()
+        data = duckdb_cursor.fetchall()
+        fetched = time.perf_counter()
+    finally:
+        duckdb_cursor.close()
+
+    record_query(query, params, executed - started, fetched - executed, data, backend='duckdb')
+    return data
+
+
+def stream_duckdb(query, params=None, batch_size=STREAM_BATCH_SIZE):
+    '''
+    Takes a single SQL query string and optional parameters and executes it on the
+    embedded DuckDB connection
+    Yields SQL output as lists of at most batch_size rows
+    '''
+
+    execute_seconds = 0.0
+    fetch_seconds = 0.0
+    row_count = 0
+    sample = []
+
+    duckdb_cursor = get_duckdb()
+    try:
+        started = time.perf_counter()
+        duckdb_cursor.execute(duckdb_sql(query), params)
+        execute_seconds = time.perf_counter() - started
+
+        while True:
+            started = time.perf_counter()
+            rows = duckdb_cursor.fetchmany(batch_size)
+            fetch_seconds += time.perf_counter() - started
+
+            if not rows:
+                break
+            if not sample:
+                sample = rows
+            row_count += len(rows)
+            yield rows
+
+    finally:
+        duckdb_cursor.close()
+
+    record_query(query, params, execute_seconds, fetch_seconds, sample, row_count, backend='duckdb')
+
+
+def explain_duckdb(query, params=None):
+    '''
+    Takes a SELECT query string and optional parameters
+    Returns DuckDB's EXPLAIN output as a list of (key, plan) rows
+    '''
+
+    duckdb_cursor = get_duckdb()
+    try:
+        duckdb_cursor.execute(f'EXPLAIN {duckdb_sql(query)}', params)
+        return duckdb_cursor.fetchall()
+    finally:
+        duckdb_cursor.close()
+
+
+#################################
+## Admission Control Functions ##
+#################################
+
+
+def admit_queries(queries):
+    '''
+    Takes a list of (sql, params) pairs about to run on MySQL
+    Asks the server with EXPLAIN how many rows they will examine, and if that is more than
+    ADMISSION_MAX_ROWS asks user to confirm (unless ADMISSION_FORCE is set)
+
+    Returns True if the queries may run
+
+    Note: Queries for another backend or the snapshot, and ones EXPLAIN fails on, are let through
+    '''
+
+    if ANALYTICS_BACKEND != 'mysql' or ADMISSION_FORCE:
+        return True
+
+    estimate = estimate_rows(queries)
+    if estimate is None or estimate <= ADMISSION_MAX_ROWS:
+        return True
+
+    print(f"\n(!!!!!) This query is estimated to examine {estimate:,} rows "
+          f"(limit {ADMISSION_MAX_ROWS:,}). Add filters to narrow it down.\n")
+    try:
+        answer = input('Run it anyway? (y/n): ')
+    except EOFError:
+        answer = ''
+
+    if answer.strip().lower() != 'y':
+        print("\n>>>>> Query not run. Use --force to run it without asking.\n")
+        return False
+    return True
+
+
+def estimate_rows(queries):
+    '''
+    Takes a list of (sql, params) pairs
+    Returns the number of rows the server estimates they will examine, or None if EXPLAIN fails
+    '''
+
+    try:
+        return sum(int(row.get('rows') or 0)
+                   for sql, params in queries for row in explain_query(sql, params))
+    except mysql.connector.Error:
+        return None
+
+
+@contextmanager
+def query_time_limit(seconds):
+    '''
+    Takes a time limit in seconds (0 for none) for the queries the current thread runs in
+    the with block, in place of QUERY_TIMEOUT_SECONDS
+    '''
+
+    previous = getattr(admission_local, 'seconds', None)
+    admission_local.seconds = seconds
+    try:
+        yield
+    finally:
+        admission_local.seconds = previous
+
+
+def add_time_limit(query):
+    '''
+    Takes a SQL query string and returns it with a MAX_EXECUTION_TIME optimizer hint for the
+    current time limit if it is a SELECT, so the server stops it once the limit is reached
+    '''
+
+    seconds = getattr(admission_local, 'seconds', None)
+    if seconds is None:
+        seconds = QUERY_TIMEOUT_SECONDS
+    if not seconds:
+        return query
+
+    return re.sub(r'^(\s*SELECT)\b', rf'\1 /*+ MAX_EXECUTION_TIME({int(seconds * 1000)}) */',
+                  query, count=1, flags=re.IGNORECASE)
+
+
+@contextmanager
+def cancel_on_interrupt(conn):
+    '''
+    Takes a connection and runs the with block, in which a statement is executed or fetched
+    If user presses Ctrl-C meanwhile, the statement is stopped on the server and the
+    KeyboardInterrupt passed on
+    '''
+
+    try:
+        yield
+    except KeyboardInterrupt:
+        cancel_statement(conn)
+        raise
+
+
+def cancel_statement(conn, announce=True):
+    '''
+    Takes a connection whose statement was interrupted part way, and whether to tell user
+    Stops the statement on the server with KILL QUERY from a side connection (the pool may
+    have none free), then reconnects conn, as a half-read result can not be picked up again
+
+    Note: announce is False when a reader merely stopped early, e.g. an abandoned stream
+    '''
+
+    try:
+        side = mysql.connector.connect(**DB_CONFIG)
+        try:
+            kill_cursor = side.cursor()
+            kill_cursor.execute(f'KILL QUERY {int(conn.connection_id)};')
+            kill_cursor.close()
+        finally:
+            side.close()
+        if announce:
+            print('\n(!!!!!) Query cancelled on the server!\n')
+
+    except mysql.connector.Error as errMsg:
+        if announce:
+            print(f'\n(!!!!!) Could not cancel the query on the server: {errMsg}\n')
+
+    # Dropping the old session also stops the server sending the rest of the result
+    try:
+        conn.reconnect(attempts=3, delay=1)
+    except mysql.connector.Error as errMsg:
+        if announce:
+            print(f'\n(!!!!!) Could not reconnect: {errMsg}\n')
+
+
+#############################
+## Index Advisor Functions ##
+#############################
+
+
+def advise_indexes(create=False):
+    '''
+    Takes whether to create missing indexes without asking
+    Prints the EXPLAIN access type, key, row estimate, warnings (full scan, filesort) and
+    timing of every query shape the tool emits, and the ADVISED_INDEXES missing from
+    information_schema.STATISTICS as CREATE INDEX statements
+
+    Creates the missing indexes if create is True or the user confirms, then prints the
+    plans and timings again next to the old ones
+    Returns the list of CREATE INDEX statements not run
+    '''
+
+    shapes = advisor_queries()
+    before = explain_shapes(shapes)
+    print('\n>>>>> Query plans:\n')
+    print(before.to_string(index=False))
+
+    statements = [f"CREATE INDEX {name} ON {table} ({', '.join(columns)}) ALGORITHM=INPLACE LOCK=NONE;"
+                  for name, (table, columns) in missing_indexes().items()]
+    if not statements:
+        print('\n>>>>> Every advised index already exists\n')
+        return []
+
+    print('\n>>>>> Missing indexes:\n')
+    print('\n'.join(statements))
+
+    if not create:
+        try:
+            create = input('\nCreate the missing indexes now? (y/n): ').strip().lower() == 'y'
+        except EOFError:
+            create = False
+
+    if not create:
+        return statements
+
+    with get_connection() as conn:
+        index_cursor = conn.cursor()
+        try:
+            for statement in statements:
+                print(f'\n>>>>> Running: {statement}')
+                started = time.perf_counter()
+                index_cursor.execute(statement)
+                print(f'>>>>> Done in {time.perf_counter() - started:.1f}s')
+        finally:
+            index_cursor.close()
+
+    invalidate_cache()
+    after = explain_shapes(shapes)
+    comparison = before[['Shape', 'Access', 'Warnings', 'Seconds']].merge(
+        after[['Shape', 'Access', 'Warnings', 'Seconds']], on='Shape', suffixes=(' Before', ' After'))
+    print('\n>>>>> Before and after:\n')
+    print(comparison.to_string(index=False))
+    return []
+
+
+def advisor_queries():
+    '''
+    Returns a list of (label, sql, params) triples, one per query shape the tool emits,
+    built by the tool's own query builders with the filters of the first trade on record
+    '''
+
+    share_id, broker_id, day = execute_query(
+        'SELECT share_id, broker_id, DATE(transaction_time) FROM trades ORDER BY trade_id LIMIT 1;')[0]
+    date_range = (day, day + timedelta(days=6))
+
+    trade_filters = [
+        ('trades by share', dict(share_ids=[share_id])),
+        ('trades by broker', dict(broker_ids=[broker_id])),
+        ('trades by date', dict(date_range=date_range)),
+        ('trades by share + date', dict(share_ids=[share_id], date_range=date_range)),
+        ('trades by broker + date', dict(broker_ids=[broker_id], date_range=date_range)),
+        ('trades by share + broker', dict(share_ids=[share_id], broker_ids=[broker_id]))
+    ]
+
+    shapes = [(label, *build_trade_queries(**filters)[0]) for label, filters in trade_filters]
+    shapes += [(f'export {label[7:]}', *build_trade_queries(**filters, suffix=' ORDER BY trade_id')[0])
+               for label, filters in trade_filters[:3]]
+
+    predicate = in_predicate('share_id', [share_id])
+    shapes.append(('price history raw',
+                   *build_query('SELECT share_id, price, time_start, time_end FROM shares_prices',
+                                [predicate], ' ORDER BY share_id, time_start')))
+    shapes.append(('price history daily', *build_ohlc_query(predicate, 'daily', 'mysql')))
+    return shapes
+
+
+def explain_shapes(shapes):
+    '''
+    Takes a list of (label, sql, params) triples
+    Returns a pandas DataFrame of each query's plan on the base tables and its fastest run
+    of ADVISOR_REPEAT, in seconds
+    '''
+
+    import pandas as pd
+
+    rows = []
+    for label, sql, params in shapes:
+        plan = [row for row in explain_query(sql, params)
+                if row.get('table') in ('trades', 'shares_prices')]
+        extra = ' '.join(str(row.get('Extra') or '') for row in plan)
+
+        warnings = []
+        if any(row.get('type') == 'ALL' for row in plan):
+            warnings.append('full scan')
+        if 'Using filesort' in extra:
+            warnings.append('filesort')
+
+        seconds = []
+        for _ in range(ADVISOR_REPEAT):
+            started = time.perf_counter()
+            execute_query(sql, params)
+            seconds.append(time.perf_counter() - started)
+
+        rows.append([label,
+                     ', '.join(str(row.get('type')) for row in plan),
+                     ', '.join(str(row.get('key')) for row in plan),
+                     sum(int(row.get('rows') or 0) for row in plan),
+                     ', '.join(warnings) or '-',
+                     round(min(seconds), 4)])
+
+    return pd.DataFrame(rows, columns=['Shape', 'Access', 'Key', 'Rows', 'Warnings', 'Seconds'])
+
+
+def missing_indexes():
+    '''
+    Reads the indexes of the advised tables from information_schema.STATISTICS
+    Returns the ADVISED_INDEXES whose columns are not a leading prefix of an existing index
+    '''
+
+    tables = sorted({table for table, _ in ADVISED_INDEXES.values()})
+    condition, params = in_predicate('TABLE_NAME', tables)
+    data = execute_query(
+        'SELECT TABLE_NAME, INDEX_NAME, COLUMN_NAME FROM information_schema.STATISTICS '
+        f'WHERE TABLE_SCHEMA = DATABASE() AND {condition} '
+        'ORDER BY TABLE_NAME, INDEX_NAME, SEQ_IN_INDEX;', params)
+
+    existing = [(table, [row[2].lower() for row in rows])
+                for (table, _), rows in groupby(data, key=lambda row: (row[0], row[1]))]
+
+    return {name: (table, columns) for name, (table, columns) in ADVISED_INDEXES.items()
+            if not any(other == table and index[:len(columns)] == columns
+                       for other, index in existing)}
+
+
+###############################
+## Instrumentation Functions ##
+###############################
+
+
+def query_shape(query):
+    '''
+    Takes a SQL query string and returns its shape: the normalized SQL with literals
+    replaced by ? and IN lists of any length collapsed, so queries that differ only in
+    their values are grouped together
+    '''
+
+    shape = normalize_sql(query).replace('%s', '?')
+    shape = re.sub(r"'[^']*'", '?', shape)
+    shape = re.sub(r'\b\d+(\.\d+)?\b', '?', shape)
+    return re.sub(r'IN \(\?(, \?)*\)', 'IN (...)', shape, flags=re.IGNORECASE)
+
+
+def find_caller():
+    '''
+    Returns the name of the function of this script that issued the current query
+
+    Note: Query helpers, functions consuming row batches (a stream's caller is often a
+    writer pulling from it) and comprehensions are skipped
+    '''
+
+    frame = sys._getframe(1)
+    while frame is not None:
+        code = frame.f_code
+        if (frame.f_globals is globals() and code.co_name not in QUERY_HELPERS
+                and not code.co_name.startswith('<')
+                and 'batches' not in code.co_varnames[:code.co_argcount]):
+            return code.co_name
+        frame = frame.f_back
+    return 'other'
+
+
+def record_query(query, params, execute_seconds, fetch_seconds, sample, row_count=None,
+                 backend='mysql'):
+    '''
+    Takes a query, its parameters, the seconds spent executing it and fetching its rows,
+    its rows (or a sample of them), the row count if only a sample is given and the backend
+    it ran on
+    Adds the timings to the session statistics and logs the query if it was slow
+    '''
+
+    if row_count is None:
+        row_count = len(sample)
+
+    # Approximate size on the wire from the printed size of a sample of rows
+    sample = sample[:100]
+    row_bytes = sum(len(repr(row)) for row in sample) / len(sample) if sample else 0
+
+    record = {
+        'shape': query_shape(query),
+        'caller': find_caller(),
+        'execute': execute_seconds,
+        'fetch': fetch_seconds,
+        'convert': 0.0,
+        'rows': row_count,
+        'bytes': int(row_bytes * row_count)
+    }
+
+    with stats_lock:
+        query_stats.append(record)
+    stats_local.record = record
+
+    if execute_seconds + fetch_seconds >= SLOW_QUERY_SECONDS:
+        log_slow_query(query, params, record, backend)
+
+
+def record_convert(seconds):
+    '''
+    Adds the seconds spent building a DataFrame to the timings of the query that produced it
+    '''
+
+    record = getattr(stats_local, 'record', None)
+    if record is not None:
+        record['convert'] += seconds
+        stats_local.record = None
+
+
+def get_slow_query_logger():
+    '''
+    Returns the slow-query logger, which writes to a rotating SLOW_QUERY_LOG file
+    '''
+
+    global slow_query_logger
+
+    if slow_query_logger is None:
+        logger = logging.getLogger('trade_system_tools.slow_queries')
+        handler = logging.handlers.RotatingFileHandler(
+            SLOW_QUERY_LOG, maxBytes=SLOW_QUERY_LOG_BYTES, backupCount=SLOW_QUERY_LOG_BACKUPS)
+        handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        slow_query_logger = logger
+
+    return slow_query_logger
+
+
+def log_slow_query(query, params, record, backend='mysql'):
+    '''
+    Takes a slow query, its parameters, its timings and the backend it ran on
+    Writes them and the query's EXPLAIN output, from that same backend, to the slow-query log
+    '''
+
+    plan = ''
+    if normalize_sql(query).upper().startswith('SELECT') and backend == 'duckdb':
+        import duckdb
+
+        try:
+            plan = '\n'.join(row[-1] for row in explain_duckdb(query, params))
+        except duckdb.Error as errMsg:
+            plan = f'EXPLAIN failed: {errMsg}'
+
+    elif normalize_sql(query).upper().startswith('SELECT'):
+        try:
+            plan = '\n'.join(str(row) for row in explain_query(query, params))
+        except mysql.connector.Error as errMsg:
+            plan = f'EXPLAIN failed: {errMsg}'
+
+    get_slow_query_logger().info(
+        f"{record['caller']} backend={backend} execute={record['execute']:.3f}s fetch={record['fetch']:.3f}s "
+        f"rows={record['rows']} bytes~{record['bytes']}\n"
+        f"{normalize_sql(query)}\nParameters: {params}\n{plan}\n")
+
+
+def explain_query(query, params=None, read_only=False):
+    '''
+    Takes a SELECT query string, optional parameters and whether it must run in a read-only
+    transaction
+    Returns the server's EXPLAIN output as a list of dicts keyed on column name
+    '''
+
+    if SERVICE_URL is not None:
+        return remote_json('/explain', {'sql': query, 'params': params})
+
+    with get_connection() as conn, read_only_transaction(conn, read_only):
+        explain_cursor = conn.cursor(prepared=params is not None)
+        try:
+            explain_cursor.execute(f'EXPLAIN {query}', params)
+            columns = [column[0] for column in explain_cursor.description]
+            return [dict(zip(columns, row)) for row in explain_cursor.fetchall()]
+        finally:
+            explain_cursor.close()
+
+
+def print_query_stats():
+    '''
+    Prints the number of calls, p50/p95/p99 latencies and rows of each query shape run
+    this session as a pandas DataFrame to stdout
+    '''
+
+    import numpy as np
+    import pandas as pd
+
+    with stats_lock:
+        records = list(query_stats)
+
+    if len(records) == 0:
+        print("\n>>>>> No queries run yet\n")
+        return 1
+
+    df = pd.DataFrame(records)
+    df['total'] = df['execute'] + df['fetch'] + df['convert']
+
+    summary = df.groupby('shape').agg(
+        calls=('total', 'size'),
+        callers=('caller', lambda callers: ', '.join(sorted(set(callers)))),
+        p50=('total', lambda total: np.percentile(total, 50)),
+        p95=('total', lambda total: np.percentile(total, 95)),
+        p99=('total', lambda total: np.percentile(total, 99)),
+        execute=('execute', 'mean'),
+        fetch=('fetch', 'mean'),
+        convert=('convert', 'mean'),
+        rows=('rows', 'mean'),
+        bytes=('bytes', 'sum')
+    ).sort_values('p95', ascending=False)
+
+    with pd.option_context('display.max_colwidth', 80, 'display.max_columns', None, 'display.width', 250):
+        print('\n>>>>> Session Query Statistics (seconds)\n')
+        print(summary)
+
+
+#############################
+## Query Builder Functions ##
+#############################
+
+
+def in_predicate(column, values):
+    '''
+    Takes a column name and a list of values
+    Returns a parameterized "column IN (%s, ...)" condition and its list of parameters
+    '''
+
+    placeholders = ', '.join(['%s'] * len(values))
+    return f'{column} IN ({placeholders})', list(values)
+
+
+def date_range_predicate(column, start, end):
+    '''
+    Takes a column name and an inclusive (start, end) pair of dates
+    Returns a parameterized half-open condition "column >= start AND column < end + 1 day"
+    and its list of parameters
+
+    Note: The half-open form keeps every time on the end date and lets the server use a range scan
+    '''
+
+    return f'{column} >= %s AND {column} < %s', [start, end + timedelta(days=1)]
+
+
+def between_predicate(column, ranges):
+    '''
+    Takes a column name and a list of inclusive (low, high) pairs
+    Returns a parameterized "column BETWEEN %s AND %s OR ..." condition and its list of parameters
+    '''
+
+    condition = ' OR '.join([f'{column} BETWEEN %s AND %s'] * len(ranges))
+    return condition, [value for pair in ranges for value in pair]
+
+
+def keyset_predicate(columns, key):
+    '''
+    Takes a list of column names and a tuple of values, one per column
+    Returns a parameterized condition that rows sorting after key on those columns meet,
+    e.g. "a > %s OR (a = %s AND b > %s)", and its list of parameters
+
+    Note: Written out rather than as a row comparison "(a, b) > (%s, %s)" so the server
+    can turn it into an index range scan
+    '''
+
+    terms = []
+    params = []
+    for index, column in enumerate(columns):
+        terms.append(' AND '.join([f'{other} = %s' for other in columns[:index]] + [f'{column} > %s']))
+        params += list(key[:index]) + [key[index]]
+
+    return ' OR '.join(f'({term})' for term in terms), params
+
+
+def build_query(base, predicates, suffix=''):
+    '''
+    Takes a base SELECT statement, a list of (condition, parameters) pairs and an optional
+    suffix (e.g. ORDER BY clause)
+    Returns the SQL string with the conditions joined by AND, and the combined parameters
+    '''
+
+    sql = base
+    params = []
+
+    if predicates:
+        sql += ' WHERE ' + ' AND '.join(f'({condition})' for condition, _ in predicates)
+        for _, values in predicates:
+            params += values
+
+    return sql + suffix + ';', params
+
+
+def build_trade_queries(trade_ids=None, share_ids=None, broker_ids=None, date_range=None,
+                        trade_id_ranges=None, columns='*', suffix='', after=None):
+    '''
+    Takes ZERO OR MORE filters on the trades table: lists of trade_id, share_id and broker_id
+    values, an inclusive (start, end) date range on transaction_time, a list of
+    inclusive (low, high) trade_id ranges and a (transaction_time, trade_id) key that the
+    trades must sort after
+    Returns a list of (sql, params) pairs that together select the matching trades
+
+    Note: Every ID list is split into chunks of at most MAX_IN_LIST values, with one
+    statement per combination of chunks, so a single statement never carries an unbounded
+    number of parameters
+    '''
+
+    id_filters = [(column, list(values)) for column, values in
+                  (('trade_id', trade_ids), ('share_id', share_ids), ('broker_id', broker_ids))
+                  if values]
+
+    chunked = [[(column, values[start:start + MAX_IN_LIST])
+                for start in range(0, len(values), MAX_IN_LIST)]
+               for column, values in id_filters]
+
+    queries = []
+    for chunks in product(*chunked):
+        predicates = [in_predicate(column, values) for column, values in chunks]
+
+        if date_range:
+            predicates.append(date_range_predicate('transaction_time', *date_range))
+
+        if trade_id_ranges:
+            predicates.append(between_predicate('trade_id', trade_id_ranges))
+
+        if after is not None:
+            predicates.append(keyset_predicate(['transaction_time', 'trade_id'], after))
+
+        queries.append(build_query(f'SELECT {columns} FROM trades', predicates, suffix))
+
+    return queries
+
+
+def group_trade_ids(trade_ids, ranges=()):
+    '''
+    Takes a list of trade_id values and a list of inclusive (low, high) trade_id ranges
+    Returns (singles, ranges): the sorted IDs not covered by any range, and the ranges merged
+    where they overlap, with runs of MIN_RANGE_RUN or more consecutive IDs turned into ranges
+    '''
+
+    import numpy as np
+
+    ids = np.unique(np.asarray(trade_ids, dtype=np.int64))
+    spans = [(int(low), int(high)) for low, high in ranges]
+
+    # Split the sorted IDs wherever they stop being consecutive
+    if len(ids):
+        runs = np.split(ids, np.flatnonzero(np.diff(ids) != 1) + 1)
+        singles = [int(id) for run in runs if len(run) < MIN_RANGE_RUN for id in run]
+        spans += [(int(run[0]), int(run[-1])) for run in runs if len(run) >= MIN_RANGE_RUN]
+    else:
+        singles = []
+
+    merged = []
+    for low, high in sorted(spans):
+        if merged and low <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], high))
+        else:
+            merged.append((low, high))
+
+    # Drop single IDs already covered by a range
+    if merged and singles:
+        lows = np.array([low for low, _ in merged])
+        highs = np.array([high for _, high in merged])
+        position = np.searchsorted(lows, singles, side='right') - 1
+        covered = (position >= 0) & (np.asarray(singles) <= highs[np.maximum(position, 0)])
+        singles = [id for id, skip in zip(singles, covered) if not skip]
+
+    return singles, merged
+
+
+def build_trade_lookup_queries(trade_ids, ranges):
+    '''
+    Takes a list of trade_id values and a list of inclusive (low, high) trade_id ranges
+    Returns a list of (sql, params) pairs that together select the trades matching either:
+    chunked IN lists for the IDs, and chunked BETWEEN predicates for the ranges
+    '''
+
+    queries = build_trade_queries(trade_ids=trade_ids) if trade_ids else []
+
+    # Each range carries two parameters
+    step = MAX_IN_LIST // 2
+    for start in range(0, len(ranges), step):
+        queries += build_trade_queries(trade_id_ranges=ranges[start:start + step])
+
+    return queries
+
+
+def print_queries(queries):
+    '''
+    Takes a list of (sql, params) pairs and prints the first statement and its parameters
+    '''
+
+    sql, params = queries[0]
+    print(f'\n>>>>> Your Query: {sql}\n')
+
+    if params:
+        print(f">>>>> Parameters: {', '.join(map(str, params))}\n")
+
+    if len(queries) > 1:
+        print(f'>>>>> Split into {len(queries)} statements of at most {MAX_IN_LIST} values\n')
+
+
+#####################
+## Other Functions ##
+#####################
+
+
+def get_pool():
+    '''
+    Returns the connection pool, creating it on first use
+
+    Note: If the database is unreachable the error is raised here and the next call retries
+    '''
+
+    global pool
+
+    with pool_lock:
+        if pool is None:
+            pool = mysql.connector.pooling.MySQLConnectionPool(
+                pool_name=POOL_NAME, pool_size=POOL_SIZE, **DB_CONFIG)
+
+    return pool
+
+
+@contextmanager
+def get_connection():
+    '''
+    Borrows a connection from the pool for the duration of a with block
+    Waits up to POOL_TIMEOUT seconds if every pooled connection is in use
+
+    The connection is pinged (and reconnected if it has dropped) before it is handed out,
+    and is returned to the pool when the block exits
+    '''
+
+    deadline = time.monotonic() + POOL_TIMEOUT
+
+    while True:
+        try:
+            conn = get_pool().get_connection()
+        except mysql.connector.errors.PoolError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+        else:
+            break
+
+    try:
+        conn.ping(reconnect=True, attempts=3, delay=1)
+        yield conn
+    finally:
+        # Returning a pooled connection puts it back in the pool
+        conn.close()
+
+
+def close_pool():
+    '''
+    Closes every idle connection held by the pool
+    '''
+
+    global pool
+
+    with pool_lock:
+        if pool is not None:
+            pool._remove_connections()
+            pool = None
+
+
+def execute_query(query, params=None, analytical=False, read_only=False):
+    '''
+    Takes a single SQL query string, optional parameters, whether it is an analytical
+    query (a scan or aggregate rather than a point lookup) and whether it must run in a
+    read-only transaction, executes, and returns SQL output as a list of rows
+
+    Each call runs on its own short-lived cursor over a pooled connection, so queries
+    can be issued from several threads at once
+    Queries with parameters are run as prepared statements
+    Analytical queries run on ANALYTICS_BACKEND
+    '''
+
+    if analytical and ANALYTICS_BACKEND == 'duckdb':
+        return execute_duckdb(query, params)
+
+    if SERVICE_URL is not None:
+        return remote_query(query, params, analytical)
+
+    # Execute query and return all rows of output
+    with get_connection() as conn, read_only_transaction(conn, read_only):
+        query_cursor = conn.cursor(prepared=params is not None)
+
+        try:
+            with cancel_on_interrupt(conn):
+                started = time.perf_counter()
+                query_cursor.execute(add_time_limit(query), params)
+                executed = time.perf_counter()
+                data = query_cursor.fetchall()
+                fetched = time.perf_counter()
+        finally:
+            query_cursor.close()
+
+    record_query(query, params, executed - started, fetched - executed, data)
+    return data
+
+
+def execute_queries(queries):
+    '''
+    Takes a list of (sql, params) pairs, executes each, and returns all rows as one list
+    '''
+
+    data = []
+    for sql, params in queries:
+        data += execute_query(sql, params)
+    return data
+
+
+def normalize_sql(query):
+    '''
+    Takes a SQL query string and returns it with whitespace collapsed and any trailing
+    semicolon removed, so equivalent queries share a cache key
+    '''
+
+    return ' '.join(query.split()).rstrip(';').rstrip()
+
+
+def cached_query(query, params=None, ttl=CACHE_TTL, read_only=False):
+    '''
+    Takes a single SQL query string, optional parameters, a time to live in seconds and
+    whether it must run in a read-only transaction
+    Returns SQL output as a list of rows, from the result cache if a copy younger than
+    ttl is held, otherwise by executing the query and caching its output
+
+    Note: The cache holds at most CACHE_MAX_ENTRIES results and evicts the least recently used
+    With SERVICE_URL set the service's cache, shared by all its clients, is used instead
+    '''
+
+    if SERVICE_URL is not None:
+        return remote_query(query, params, ttl=ttl)
+
+    key = (normalize_sql(query), tuple(params or ()))
+
+    with cache_lock:
+        entry = query_cache.get(key)
+
+        if entry is not None and entry[0] > time.monotonic():
+            query_cache.move_to_end(key)
+            stats_local.record = None
+            return entry[1]
+
+    data = execute_query(query, params, read_only=read_only)
+
+    with cache_lock:
+        query_cache[key] = (time.monotonic() + ttl, data)
+        query_cache.move_to_end(key)
+
+        while len(query_cache) > CACHE_MAX_ENTRIES:
+            query_cache.popitem(last=False)
+
+    return data
+
+
+def invalidate_cache(table=None):
+    '''
+    Drops cached results that read from table, or every cached result if no table is given
+    '''
+
+    global valid_share_ids
+
+    with cache_lock:
+        if table is None:
+            query_cache.clear()
+        else:
+            pattern = re.compile(rf'\b{re.escape(table)}\b', re.IGNORECASE)
+            for key in [key for key in query_cache if pattern.search(key[0])]:
+                del query_cache[key]
+
+        if table in (None, 'shares_prices'):
+            valid_share_ids = None
+
+
+def is_valid_share_id(share_id):
+    '''
+    Takes a share_id and returns True if it has a recorded price history
+
+    Note: The set of valid IDs is loaded once and refreshed every REFERENCE_DATA_TTL seconds,
+    so each check is a set lookup rather than a query
+    '''
+
+    global valid_share_ids, valid_share_ids_expiry
+
+    with cache_lock:
+        share_ids = valid_share_ids
+        if share_ids is not None and valid_share_ids_expiry <= time.monotonic():
+            share_ids = None
+
+    if share_ids is None and SNAPSHOT:
+        share_ids = set(load_snapshot('shares_prices')['Share ID'].tolist())
+
+    elif share_ids is None:
+        share_ids = {row[0] for row in execute_query(
+            'SELECT DISTINCT share_id FROM shares_prices;')}
+
+        with cache_lock:
+            valid_share_ids = share_ids
+            valid_share_ids_expiry = time.monotonic() + REFERENCE_DATA_TTL
+
+    return share_id in share_ids
+
+
+def stream_query(query, params=None, batch_size=STREAM_BATCH_SIZE, analytical=False,
+                 read_only=False):
+    '''
+    Takes a single SQL query string, optional parameters and whether it is an analytical
+    query, and executes it on an unbuffered cursor (a prepared statement if parameters
+    are given), or on ANALYTICS_BACKEND if it is analytical
+    Yields SQL output as lists of at most batch_size rows
+
+    Note: Rows are pulled from the server as they are consumed, so the full result
+    set is never held in memory. The pooled connection is held until the stream ends
+    '''
+
+    if analytical and ANALYTICS_BACKEND == 'duckdb':
+        yield from stream_duckdb(query, params, batch_size)
+        return
+
+    if SERVICE_URL is not None:
+        yield from remote_stream(query, params, batch_size, analytical)
+        return
+
+    with get_connection() as conn, read_only_transaction(conn, read_only):
+        timings = yield from stream_connection_query(conn, query, params, batch_size)
+
+    # Recorded once the connection is back in the pool, as a slow query's EXPLAIN needs one
+    record_query(query, params, *timings)
+
+
+def stream_connection_query(conn, query, params=None, batch_size=STREAM_BATCH_SIZE):
+    '''
+    Takes a connection, a single SQL query string and optional parameters and streams the
+    query on that connection, as for stream_query
+    Yields SQL output as lists of at most batch_size rows
+
+    Returns (execute seconds, fetch seconds, first batch, row count) for record_query, which
+    the caller runs after releasing the connection
+    '''
+
+    execute_seconds = 0.0
+    fetch_seconds = 0.0
+    row_count = 0
+    sample = []
+
+    if params is None:
+        stream_cursor = conn.cursor(buffered=False)
+    else:
+        stream_cursor = conn.cursor(prepared=True)
+
+    try:
+        with cancel_on_interrupt(conn):
+            started = time.perf_counter()
+            stream_cursor.execute(add_time_limit(query), params)
+            execute_seconds = time.perf_counter() - started
+
+        while True:
+            with cancel_on_interrupt(conn):
+                started = time.perf_counter()
+                rows = stream_cursor.fetchmany(batch_size)
+                fetch_seconds += time.perf_counter() - started
+
+            if not rows:
+                break
+            if not sample:
+                sample = rows
+            row_count += len(rows)
+            yield rows
+
+    finally:
+        # If the consumer stopped early, stop the statement rather than read and discard
+        # the rest of its result
+        if conn.unread_result:
+            cancel_statement(conn, announce=False)
+        stream_cursor.close()
+
+    return execute_seconds, fetch_seconds, sample, row_count
+
+
+def stream_trades_by_id_table(trade_ids, batch_size=STREAM_BATCH_SIZE):
+    '''
+    Takes a list of trade_id values
+    Loads them into a temporary table in chunks of MAX_IN_LIST and streams the trades
+    joined against it, ordered by trade_id, as lists of at most batch_size rows
+
+    Note: Temporary tables only exist on the connection that made them, so the whole
+    lookup holds one pooled connection
+    '''
+
+    query = ('SELECT t.* FROM trades t INNER JOIN lookup_trade_ids l '
+             'ON t.trade_id = l.trade_id ORDER BY t.trade_id;')
+
+    with get_connection() as conn:
+        id_cursor = conn.cursor()
+        try:
+            id_cursor.execute('CREATE TEMPORARY TABLE lookup_trade_ids (trade_id INT PRIMARY KEY);')
+            for start in range(0, len(trade_ids), MAX_IN_LIST):
+                id_cursor.executemany('INSERT IGNORE INTO lookup_trade_ids VALUES (%s);',
+                                      [(id,) for id in trade_ids[start:start + MAX_IN_LIST]])
+
+            print(f'\n>>>>> Your Query: {len(trade_ids)} Trade IDs joined from a temporary table\n')
+            timings = yield from stream_connection_query(conn, query, batch_size=batch_size)
+
+        finally:
+            id_cursor.execute('DROP TEMPORARY TABLE IF EXISTS lookup_trade_ids;')
+            id_cursor.close()
+
+    # Note: The temporary table is gone by now, so a slow join is logged without its plan
+    record_query(query, None, *timings)
+
+
+def stream_queries(queries, batch_size=STREAM_BATCH_SIZE, analytical=False):
+    '''
+    Takes a list of (sql, params) pairs and whether they are analytical queries
+    Yields the output of each in turn as row batches
+    '''
+
+    for sql, params in queries:
+        yield from stream_query(sql, params, batch_size, analytical)
+
+
+def write_excel_stream(batches, filename, headers):
+    '''
+    Takes an iterable of row batches, a .xlsx filename and a list of column names (headers)
+    Writes rows into write-only openpyxl workbooks as they arrive
+    A new sheet is started whenever Excel's row limit is reached, and a new file
+    (filename_part2.xlsx, ...) every EXCEL_MAX_SHEETS sheets
+
+    Returns a list of the filenames written
+    '''
+
+    import openpyxl
+
+    base, extension = os.path.splitext(filename)
+    rows_per_sheet = EXCEL_MAX_ROWS - 1
+    filenames = []
+    workbook = None
+    sheet = None
+    sheet_count = 0
+    sheet_rows = rows_per_sheet
+
+    def new_sheet():
+        nonlocal workbook, sheet, sheet_count, sheet_rows
+
+        # Roll over into a new workbook once the current one is full
+        if sheet_count % EXCEL_MAX_SHEETS == 0:
+            if workbook is not None:
+                workbook.save(filenames[-1])
+            part = sheet_count // EXCEL_MAX_SHEETS + 1
+            filenames.append(
+                filename if part == 1 else f'{base}_part{part}{extension}')
+            workbook = openpyxl.Workbook(write_only=True)
+
+        sheet_count += 1
+        sheet = workbook.create_sheet(f'Sheet{sheet_count}')
+        sheet.append(headers)
+        sheet_rows = 0
+
+    for batch in batches:
+        start = 0
+        while start < len(batch):
+            if sheet_rows == rows_per_sheet:
+                new_sheet()
+
+            # Append as many rows of the batch as fit on the current sheet
+            stop = min(len(batch), start + rows_per_sheet - sheet_rows)
+            for row in batch[start:stop]:
+                sheet.append(row)
+            sheet_rows += stop - start
+            start = stop
+
+    # Always produce a file, even if no rows were returned
+    if workbook is None:
+        new_sheet()
+
+    workbook.save(filenames[-1])
+    return filenames
+
+
+def arrow_batches(batches, headers):
+    '''
+    Takes an iterable of row batches and a list of column names (headers)
+    Yields each batch as a pyarrow Table, all cast to one schema built from COLUMN_TYPES
+
+    Note: The schema is fixed up front rather than taken from the first batch, where a column
+    of only NULLs would have no type. An empty input yields one empty Table so the file
+    still gets a schema
+    '''
+
+    import pyarrow as pa
+
+    types = {
+        'int32': pa.int32(),
+        'int64': pa.int64(),
+        'float64': pa.float64(),
+        'datetime64[ns]': pa.timestamp('ns'),
+        'category': pa.dictionary(pa.int32(), pa.large_string())
+    }
+    schema = pa.schema([(header, types.get(COLUMN_TYPES.get(header), pa.large_string()))
+                        for header in headers])
+
+    empty = True
+    for batch in batches:
+        if len(batch) == 0:
+            continue
+        empty = False
+        yield pa.Table.from_pandas(convert_to_df(batch, headers), preserve_index=False).cast(schema)
+
+    if empty:
+        yield schema.empty_table()
+
+
+def write_parquet_stream(batches, filename, headers):
+    '''
+    Takes an iterable of row batches, a .parquet filename and a list of column names (headers)
+    Writes each batch as a row group, compressed with PARQUET_COMPRESSION
+
+    Returns a list of the filenames written
+    '''
+
+    import pyarrow.parquet as pq
+
+    writer = None
+    try:
+        for table in arrow_batches(batches, headers):
+            if writer is None:
+                writer = pq.ParquetWriter(filename, table.schema, compression=PARQUET_COMPRESSION)
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    return [filename]
+
+
+def write_arrow_stream(batches, filename, headers):
+    '''
+    Takes an iterable of row batches, a .arrow filename and a list of column names (headers)
+    Writes each batch as a record batch of an Arrow IPC file
+
+    Returns a list of the filenames written
+    '''
+
+    import pyarrow as pa
+
+    writer = None
+    try:
+        for table in arrow_batches(batches, headers):
+            if writer is None:
+                writer = pa.ipc.new_file(filename, table.schema)
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    return [filename]
+
+
+def write_csv_stream(batches, text_file, headers):
+    '''
+    Takes an iterable of row batches, an open text file and a list of column names (headers)
+    Writes a header line and then each batch as CSV rows
+    '''
+
+    writer = csv.writer(text_file)
+    writer.writerow(headers)
+    for batch in batches:
+        writer.writerows(batch)
+
+
+def write_csv_file_stream(batches, filename, headers):
+    '''
+    Takes an iterable of row batches, a .csv filename and a list of column names (headers)
+    Writes the rows as plain CSV
+
+    Returns a list of the filenames written
+    '''
+
+    with open(filename, 'w', newline='') as text_file:
+        write_csv_stream(batches, text_file, headers)
+
+    return [filename]
+
+
+def write_csv_gz_stream(batches, filename, headers):
+    '''
+    Takes an iterable of row batches, a .csv.gz filename and a list of column names (headers)
+    Writes the rows as gzip compressed CSV
+
+    Returns a list of the filenames written
+    '''
+
+    with gzip.open(filename, 'wt', newline='') as text_file:
+        write_csv_stream(batches, text_file, headers)
+
+    return [filename]
+
+
+def write_csv_zst_stream(batches, filename, headers):
+    '''
+    Takes an iterable of row batches, a .csv.zst filename and a list of column names (headers)
+    Writes the rows as zstd compressed CSV
+
+    Returns a list of the filenames written
+    '''
+
+    import zstandard
+
+    with open(filename, 'wb') as raw_file:
+        with zstandard.ZstdCompressor().stream_writer(raw_file) as compressed:
+            with io.TextIOWrapper(compressed, newline='') as text_file:
+                write_csv_stream(batches, text_file, headers)
+
+    return [filename]
+
+
+def convert_to_df(data, headers):
+    '''
+    Takes SQL query output's list of rows (data) and a list of column names (headers) as argument
+    Returns a pandas DataFrame object with columns typed from COLUMN_TYPES
+
+    Note: The number of columns in data and headers must be equal
+    '''
+
+    # Create and return DataFrame
+    return materialize([data], headers)
+
+
+def fetch_df(queries, headers, batch_size=STREAM_BATCH_SIZE, analytical=False):
+    '''
+    Takes a list of (sql, params) pairs, a list of column names (headers) and whether
+    they are analytical queries
+    Fetches SQL output in batches straight into typed column arrays
+
+    Returns a pandas DataFrame object
+    '''
+
+    return materialize(stream_queries(queries, batch_size, analytical), headers)
+
+
+def materialize(batches, headers):
+    '''
+    Takes an iterable of row batches and a list of column names (headers)
+    Copies each batch column by column into one preallocated NumPy array per column,
+    using the dtype given for the column in COLUMN_TYPES
+
+    Returns a pandas DataFrame object
+
+    Note: A column whose values do not fit its dtype (e.g. NULL in an ID column, or an ID
+    above the int32 range) is kept as Python objects instead
+    '''
+
+    import numpy as np
+    import pandas as pd
+
+    kinds = [COLUMN_TYPES.get(header, 'object') for header in headers]
+    dtypes = [object if kind in ('category', 'object') else np.dtype(kind) for kind in kinds]
+    arrays = [np.empty(0, dtype) for dtype in dtypes]
+    size = 0
+    convert_seconds = 0.0
+
+    for batch in batches:
+        count = len(batch)
+        if count == 0:
+            continue
+        started = time.perf_counter()
+
+        # Grow the arrays geometrically so appending stays amortised O(1)
+        if size + count > len(arrays[0]):
+            capacity = max(size + count, 2 * len(arrays[0]))
+            for index, array in enumerate(arrays):
+                grown = np.empty(capacity, array.dtype)
+                grown[:size] = array[:size]
+                arrays[index] = grown
+
+        for index, values in enumerate(zip(*batch)):
+
+            # NumPy before 2.0 wraps integers that overflow the dtype instead of raising,
+            # so check the batch's range first (NULLs fail the comparison and fall back below)
+            if arrays[index].dtype.kind in 'iu':
+                info = np.iinfo(arrays[index].dtype)
+                try:
+                    if min(values) < info.min or max(values) > info.max:
+                        arrays[index] = arrays[index].astype(object)
+                except TypeError:
+                    pass
+
+            try:
+                arrays[index][size:size + count] = values
+            except (TypeError, ValueError, OverflowError):
+                arrays[index] = arrays[index].astype(object)
+                arrays[index][size:size + count] = values
+
+        size += count
+        convert_seconds += time.perf_counter() - started
+
+    started = time.perf_counter()
+    columns = {}
+    for header, kind, array in zip(headers, kinds, arrays):
+        array = array[:size]
+        columns[header] = pd.Categorical(array) if kind == 'category' else array
+
+    df = pd.DataFrame(columns, columns=list(headers))
+    record_convert(convert_seconds + time.perf_counter() - started)
+    return df
+
+
+def get_id_list(label, skip=False):
+    '''
+    Function takes the kind of ID being asked for (label, e.g. 'Share') and whether
+    the prompt may be skipped with ENTER
+
+    User is prompt continuously until ONE OR MORE valid digits are provided, or for
+    shares company names (see parse_share_ids)
+
+    Returns a list of IDs as integers (an empty list if skipped)
+    '''
+
+    # Shares may also be given by company name
+    if label == 'Share':
+        prompt = "Please enter ONE OR MORE Share IDs in the format (1 2 3), or company names separated by semicolons: "
+    else:
+        prompt = f"Please enter ONE OR MORE {label} IDs in the format (1 2 3): "
+
+    while True:
+
+        ids = input(prompt)
+
+        if skip and len(ids) == 0:
+            return []
+
+        try:
+            assert len(ids) > 0, f'\n(!!!!!) Please enter AT LEAST ONE {label} ID!\n'
+            if label == 'Share':
+                return parse_share_ids(ids)
+            id_list = ids.split(' ')
+
+            for id in id_list:
+                if skip:
+                    assert id.isdigit(), f'\n(!!!!!) Please enter digit(s) for {label} ID or ENTER to skip!\n'
+                else:
+                    assert id.isdigit(), f'\n(!!!!!) Please enter digit(s) for {label} ID!\n'
+
+        except AssertionError as errMsg:
+            print(errMsg)
+            continue
+
+        else:
+            return [int(id) for id in id_list]
+
+
+def read_trade_ids(text):
+    '''
+    Takes the text of a Trade ID prompt: IDs and ranges (1 2 1000-2000), or the path of a
+    file of them separated by spaces, commas or new lines
+    Returns (trade_ids, ranges): a list of IDs and a list of inclusive (low, high) ranges
+
+    Note: Raises ValueError on anything that is not a digit or a range
+    '''
+
+    if os.path.isfile(text):
+        with open(text) as id_file:
+            text = id_file.read()
+
+    trade_ids = []
+    ranges = []
+    for token in re.split(r'[\s,]+', text.strip()):
+        if not token:
+            continue
+        low, _, high = token.partition('-')
+        if not low.isdigit() or (high and not high.isdigit()):
+            raise ValueError(f'Invalid Trade ID: {token}')
+        if high:
+            if int(high) < int(low):
+                raise ValueError(f'Invalid Trade ID range: {token}')
+            ranges.append((int(low), int(high)))
+        else:
+            trade_ids.append(int(low))
+
+    return trade_ids, ranges
+
+
+def parse_date_range(date_range):
+    '''
+    Takes a date range string in the format (DDMMYYYY - DDMMYYYY)
+    Returns an inclusive (start, end) pair of dates
+
+    Note: Raises ValueError if the string is not a valid date range
+    '''
+
+    start_date, end_date = date_range.split(' - ')
+    return parse_date(start_date), parse_date(end_date)
+
+
+def parse_date(text):
+    '''
+    Takes a date string in the format DDMMYYYY and returns a date
+
+    Note: Raises ValueError if the string is not a valid date
+    '''
+
+    return datetime.strptime(text, '%d%m%Y').date()
+
+
+def get_date_range():
+    '''
+    User is prompt continuously until a valid date range is provided
+
+    Returns an inclusive (start, end) pair of dates
+    '''
+
+    while True:
+
+        date_range = input(
+            "Please enter a Date Range in the format (DDMMYYYY - DDMMYYYY): ")
+
+        try:
+            return parse_date_range(date_range)
+
+        except ValueError:
+            print(
+                '\n(!!!!!) Please enter a valid Date Range! (DDMMYYYY - DDMMYYYY)\n')
+
+
+def get_count(label, default):
+    '''
+    Takes what is being counted (label) and the count used if user presses ENTER
+    User is prompt continuously until a whole number above zero is provided
+
+    Returns the count
+    '''
+
+    while True:
+
+        count = input(f"{label}, press ENTER for {default}: ")
+
+        if count == '':
+            return default
+        if count.isdigit() and int(count) > 0:
+            return int(count)
+        print(f'\n(!!!!!) Please enter a digit for {label}!\n')
+
+
+def get_trade_filters():
+    '''
+    Prompts user for ZERO OR MORE of share_id, broker_id and date_range, each skipped with ENTER
+
+    Returns (share_ids, broker_ids, date_range), with empty lists and None for skipped filters
+    '''
+
+    share_id_list = get_id_list('Share', skip=True)
+    broker_id_list = get_id_list('Broker', skip=True)
+
+    while True:
+
+        date_range = input("Date Range (DDMMYYYY - DDMMYYYY), press ENTER to skip: ")
+
+        try:
+            return share_id_list, broker_id_list, parse_date_range(date_range) if date_range else None
+
+        except ValueError:
+            print('\n(!!!!!) Please enter a valid Date Range! (DDMMYYYY - DDMMYYYY)\n')
+
+
+def addlabels(ax, x, y):
+    '''
+    Adds y labels to plot (ax)
+    '''
+
+    for i in range(len(x)):
+        ax.text(i, y[i], y[i])
+
+
+#######################
+## Service Functions ##
+#######################
+
+
+def serve(host=SERVICE_HOST, port=SERVICE_PORT):
+    '''
+    Takes a host and port and serves SERVICE_ROUTES over HTTP/JSON until user presses Ctrl-C
+
+    Note: Every client shares this process's connection pool, result cache and snapshot.
+    At most POOL_SIZE requests run against the database at once, and identical requests
+    that arrive while one is running wait for its result instead of querying again
+    Returns an exit status
+    '''
+
+    import asyncio
+
+    # Anyone who can reach a non-local address could otherwise read the whole database
+    if SERVICE_TOKEN is None and not is_loopback(host):
+        print(f"\n(!!!!!) Set {SERVICE_TOKEN_ENV} to a shared secret before serving on {host}!\n")
+        return 2
+
+    try:
+        asyncio.run(run_service(host, port))
+    except KeyboardInterrupt:
+        print("\n>>>>> Service stopped\n")
+    finally:
+        close_pool()
+
+    return 0
+
+
+def is_loopback(host):
+    '''
+    Takes a host name or address and returns True if it only accepts local connections
+    '''
+
+    import ipaddress
+
+    if host == 'localhost':
+        return True
+
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+async def run_service(host, port):
+    '''
+    Takes a host and port and accepts service requests on them forever
+    '''
+
+    import asyncio
+
+    global service_executor, service_slots
+
+    service_executor = ThreadPoolExecutor(max_workers=POOL_SIZE, thread_name_prefix='service')
+    service_slots = asyncio.Semaphore(POOL_SIZE)
+
+    try:
+        server = await asyncio.start_server(handle_request, host, port)
+        print(f"\n>>>>> Serving on http://{host}:{port} with {POOL_SIZE} connections. "
+              "Press Ctrl-C to stop\n")
+        async with server:
+            await server.serve_forever()
+    finally:
+        service_executor.shutdown(wait=False, cancel_futures=True)
+
+
+async def handle_request(reader, writer):
+    '''
+    Takes the stream pair of a client connection
+    Reads one HTTP request, answers it from SERVICE_ROUTES and closes the connection
+
+    Note: A route's parameters are its query string merged with its JSON body
+    '''
+
+    import asyncio
+    import urllib.parse
+
+    try:
+        try:
+            method, target, _ = (await reader.readline()).decode('latin-1').split(' ', 2)
+            headers = {}
+            while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+            url = urllib.parse.urlsplit(target)
+            params = dict(urllib.parse.parse_qsl(url.query))
+            if body:
+                params.update(json.loads(body, object_hook=service_object_hook))
+
+        except (ValueError, asyncio.IncompleteReadError):
+            await send_response(writer, 400, {'error': 'Malformed request'})
+            return
+
+        if SERVICE_TOKEN is not None and not hmac.compare_digest(
+                headers.get('authorization', '').encode(), f'Bearer {SERVICE_TOKEN}'.encode()):
+            await send_response(writer, 401, {'error': 'Missing or wrong service token'})
+            return
+
+        if method not in ('GET', 'POST') or url.path not in SERVICE_ROUTES:
+            await send_response(writer, 404, {'error': f'No such route: {method} {url.path}'})
+            return
+
+        route, content_type = SERVICE_ROUTES[url.path]
+
+        try:
+            if content_type == 'application/json':
+                result = await coalesce((url.path, url.query, body), route, params)
+                await send_response(writer, 200, result)
+            else:
+                await send_stream(writer, content_type, route(params))
+
+        except ValueError as errMsg:
+            await send_response(writer, 400, {'error': str(errMsg)})
+
+        except mysql.connector.Error as errMsg:
+            await send_response(writer, 502, {'error': str(errMsg), 'errno': errMsg.errno})
+
+        # Anything else (e.g. a parameter of the wrong type) still gets an answer
+        except Exception as errMsg:
+            await send_response(writer, 500, {'error': f'{type(errMsg).__name__}: {errMsg}'})
+
+    # The client went away
+    except ConnectionError:
+        pass
+
+    finally:
+        writer.close()
+
+
+async def coalesce(key, route, params):
+    '''
+    Takes a request key, a route function and its parameters
+    Runs the route in a worker thread, or if an identical request is already running waits
+    for that one instead
+
+    Returns the route's result
+    '''
+
+    import asyncio
+
+    future = service_inflight.get(key)
+
+    if future is None:
+        future = asyncio.ensure_future(run_route(route, params))
+        service_inflight[key] = future
+        future.add_done_callback(lambda done: service_inflight.pop(key, None))
+
+    # One client hanging up must not cancel the query the others are waiting on
+    return await asyncio.shield(future)
+
+
+async def run_route(route, params):
+    '''
+    Takes a route function and its parameters
+    Waits for a free connection slot and runs the route in a worker thread
+
+    Returns the route's result
+    '''
+
+    import asyncio
+
+    async with service_slots:
+        return await asyncio.get_running_loop().run_in_executor(service_executor, route, params)
+
+
+async def send_stream(writer, content_type, chunks):
+    '''
+    Takes a client's stream writer, a content type and a generator of bytes chunks
+    Pulls the chunks in a worker thread, holding one connection slot, and writes each to the
+    client as it arrives, so large results are never held whole
+
+    Note: The first chunk is pulled before the response head is sent, so errors raised before
+    any rows arrive (bad parameters, a refused search) still get an error status. Later
+    errors end an NDJSON stream with an {'error', 'errno'} line
+    '''
+
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+
+    async with service_slots:
+        try:
+            chunk = await loop.run_in_executor(service_executor, next, chunks, None)
+            writer.write(response_head(200, content_type))
+
+            while chunk is not None:
+                writer.write(chunk)
+                await writer.drain()
+
+                try:
+                    chunk = await loop.run_in_executor(service_executor, next, chunks, None)
+                # The head is already sent, so any error can only end the stream
+                except Exception as errMsg:
+                    if content_type == 'application/x-ndjson':
+                        writer.write(service_encode({'error': str(errMsg),
+                                                     'errno': getattr(errMsg, 'errno', None)}) + b'\n')
+                    return
+
+        finally:
+            await loop.run_in_executor(service_executor, chunks.close)
+
+
+async def send_response(writer, status, result):
+    '''
+    Takes a client's stream writer, an HTTP status and a JSON result, and sends them
+    '''
+
+    body = service_encode(result)
+    writer.write(response_head(status, 'application/json', len(body)) + body)
+    await writer.drain()
+
+
+def response_head(status, content_type, length=None):
+    '''
+    Takes an HTTP status, a content type and an optional body length
+    Returns the status line and headers of a response as bytes
+
+    Note: Without a length the body runs until the connection is closed
+    '''
+
+    from http import HTTPStatus
+
+    head = (f'HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n'
+            f'Content-Type: {content_type}\r\nConnection: close\r\n')
+    if length is not None:
+        head += f'Content-Length: {length}\r\n'
+
+    return (head + '\r\n').encode('latin-1')
+
+
+def service_encode(result):
+    '''
+    Takes a JSON result and returns it encoded as bytes (see service_json_default)
+    '''
+
+    return json.dumps(result, default=service_json_default).encode()
+
+
+def service_json_default(value):
+    '''
+    Takes a value json can not encode (a SQL or numpy value) and returns a JSON form of it
+    Dates, datetimes and decimals are tagged, e.g. {'$date': '2020-01-31'}, so
+    service_object_hook can bring back the original type
+    '''
+
+    if isinstance(value, datetime):
+        return {'$datetime': value.isoformat()}
+    if isinstance(value, date):
+        return {'$date': value.isoformat()}
+    if isinstance(value, Decimal):
+        return {'$decimal': str(value)}
+    if hasattr(value, 'item'):
+        return value.item()
+
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def service_object_hook(obj):
+    '''
+    Takes a decoded JSON object and returns the value it tags, or the object itself
+    '''
+
+    if len(obj) == 1:
+        tag, text = next(iter(obj.items()))
+        if tag in SERVICE_TYPES:
+            return SERVICE_TYPES[tag](text)
+
+    return obj
+
+
+def ndjson_batches(batches):
+    '''
+    Takes an iterable of row batches and yields each as a line of JSON
+    '''
+
+    for batch in batches:
+        yield service_encode(batch) + b'\n'
+
+
+def csv_batches(batches, headers):
+    '''
+    Takes an iterable of row batches and a list of column names (headers)
+    Yields a CSV header line and then each batch as CSV rows
+    '''
+
+    text_file = io.StringIO()
+    writer = csv.writer(text_file)
+    writer.writerow(headers)
+
+    for batch in chain([[]], batches):
+        writer.writerows(batch)
+        yield text_file.getvalue().encode()
+        text_file.seek(0)
+        text_file.truncate()
+
+
+def frame_json(df):
+    '''
+    Takes a pandas DataFrame and returns it as a JSON result of columns and rows
+    '''
+
+    return {'columns': list(df.columns),
+            'rows': list(df.itertuples(index=False, name=None))}
+
+
+def id_param(params, name):
+    '''
+    Takes route parameters and a parameter name
+    Returns the IDs given as a JSON list or a comma separated string, or [] if there are none
+
+    Note: Raises ValueError if an ID is not a whole number
+    '''
+
+    values = params.get(name) or []
+    if isinstance(values, str):
+        values = values.split(',')
+
+    return [int(value) for value in values]
+
+
+def trade_filter_params(params):
+    '''
+    Takes route parameters with share and broker IDs ('share', 'broker') and inclusive
+    DDMMYYYY dates ('from', 'to')
+    Returns the (share_ids, broker_ids, date_range) filters of a search, after checking
+    the search may run
+
+    Note: Raises ValueError if no filter is given or, without 'force', if the search is
+    estimated to examine more than ADMISSION_MAX_ROWS rows
+    '''
+
+    share_ids = id_param(params, 'share')
+    broker_ids = id_param(params, 'broker')
+    date_range = None
+    if params.get('from') or params.get('to'):
+        date_range = (parse_date(params['from']) if params.get('from') else date.min,
+                      parse_date(params['to']) if params.get('to') else date.max - timedelta(days=1))
+
+    if not (share_ids or broker_ids or date_range):
+        raise ValueError('Not enough details provided: give share, broker, from or to')
+
+    if not SNAPSHOT and ANALYTICS_BACKEND == 'mysql' and not params.get('force'):
+        estimate = estimate_rows(build_trade_queries(share_ids=share_ids, broker_ids=broker_ids,
+                                                     date_range=date_range))
+        if estimate is not None and estimate > ADMISSION_MAX_ROWS:
+            raise ValueError(f'Search is estimated to examine {estimate} rows '
+                             f'(limit {ADMISSION_MAX_ROWS}); narrow it down or add force=1')
+
+    return share_ids, broker_ids, date_range
+
+
+def search_batches(share_ids, broker_ids, date_range):
+    '''
+    Takes the filters of a search
+    Yields the matching trades, ordered by trade_id, as row batches from the snapshot or
+    ANALYTICS_BACKEND
+    '''
+
+    if SNAPSHOT:
+        yield from frame_batches(snapshot_trades(share_ids=share_ids, broker_ids=broker_ids,
+                                                 date_range=date_range))
+    else:
+        yield from stream_queries(build_trade_queries(share_ids=share_ids, broker_ids=broker_ids,
+                                                      date_range=date_range,
+                                                      suffix=' ORDER BY trade_id'),
+                                  analytical=True)
+
+
+def route_query(params):
+    '''
+    Takes {'sql', 'params', 'analytical', 'ttl'} and runs one SELECT as execute_query does,
+    or through the shared result cache if a ttl is given
+    Returns SQL output as a list of rows
+    '''
+
+    sql = service_sql(params)
+
+    if params.get('ttl') is not None:
+        return cached_query(sql, params.get('params'), params['ttl'], read_only=True)
+    return execute_query(sql, params.get('params'), bool(params.get('analytical')), read_only=True)
+
+
+def route_explain(params):
+    '''
+    Takes {'sql', 'params'} and returns the EXPLAIN output of one SELECT
+    '''
+
+    return explain_query(service_sql(params), params.get('params'), read_only=True)
+
+
+def route_stream(params):
+    '''
+    Takes {'sql', 'params', 'analytical', 'batch_size'} and streams one SELECT as
+    stream_query does, as lines of JSON row batches
+    '''
+
+    yield from ndjson_batches(stream_query(service_sql(params), params.get('params'),
+                                           int(params.get('batch_size') or STREAM_BATCH_SIZE),
+                                           bool(params.get('analytical')), read_only=True))
+
+
+def route_search(params):
+    '''
+    Takes search filters (see trade_filter_params) and streams the matching trades as
+    lines of JSON row batches
+    '''
+
+    yield from ndjson_batches(search_batches(*trade_filter_params(params)))
+
+
+def route_export(params):
+    '''
+    Takes search filters (see trade_filter_params) and streams the matching trades as CSV
+    '''
+
+    yield from csv_batches(search_batches(*trade_filter_params(params)), TRADE_COLUMNS)
+
+
+def route_trades(params):
+    '''
+    Takes trade IDs and inclusive ranges as a space or comma separated string ('ids') and
+    streams the trades as lines of JSON row batches
+    '''
+
+    # Only IDs, never the path of a file on this host
+    text = str(params.get('ids', ''))
+    if not re.fullmatch(r'[\d\s,-]+', text):
+        raise ValueError('Give Trade IDs or ranges, e.g. ids=1,2,1000-2000')
+
+    singles, ranges = group_trade_ids(*read_trade_ids(text))
+
+    if SNAPSHOT:
+        yield from ndjson_batches(frame_batches(snapshot_lookup(singles, ranges)))
+    else:
+        yield from ndjson_batches(stream_queries(build_trade_lookup_queries(singles, ranges)))
+
+
+def route_reference(table):
+    '''
+    Takes 'brokers' or 'shares' and returns the table as a JSON result, through the shared
+    result cache
+    '''
+
+    if SNAPSHOT:
+        return frame_json(load_snapshot(table))
+
+    sql, headers = REFERENCE_QUERIES[table]
+    return {'columns': headers, 'rows': cached_query(sql, ttl=REFERENCE_DATA_TTL)}
+
+
+def route_broker_counts(params):
+    '''
+    Returns the number of trades per broker as a JSON result
+    '''
+
+    return frame_json(get_broker_trade_counts())
+
+
+def route_exchange_counts(params):
+    '''
+    Returns the number of trades per stock exchange as a JSON result
+    '''
+
+    return frame_json(get_exchange_trade_counts())
+
+
+def route_price_history(params):
+    '''
+    Takes {'share', 'resample'} and returns the price histories of the shares as a JSON result
+    '''
+
+    share_ids = id_param(params, 'share')
+    resolution = params.get('resample', 'raw')
+    if not share_ids or resolution not in ('raw', 'daily', 'weekly'):
+        raise ValueError("Give one or more share IDs and a resample of 'raw', 'daily' or 'weekly'")
+
+    return frame_json(fetch_price_history(share_ids, resolution))
+
+
+def service_sql(params):
+    '''
+    Takes route parameters and returns their 'sql', after checking it is a single SELECT
+    that neither writes a file (INTO) nor takes row locks (FOR UPDATE / FOR SHARE)
+
+    Note: Raises ValueError for anything else. The check only catches mistakes early; what
+    keeps clients from changing the database is that routes run the SQL in a read-only
+    transaction (see read_only_transaction)
+    '''
+
+    sql = str(params.get('sql', ''))
+
+    # Blank out string literals and comments so neither hides nor fakes a keyword
+    code = re.sub(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"|`[^`]*`|/\*.*?\*/|(?:--\s|#).*?$",
+                  ' ', sql, flags=re.DOTALL | re.MULTILINE)
+
+    if not re.match(r'\s*(SELECT|WITH)\b', code, re.IGNORECASE) or ';' in normalize_sql(code):
+        raise ValueError('Only single SELECT statements are served')
+
+    if re.search(r'\bINTO\b|\bFOR\s+(UPDATE|SHARE)\b|\bLOCK\s+IN\s+SHARE\s+MODE\b', code,
+                 re.IGNORECASE):
+        raise ValueError('SELECT ... INTO and locking reads are not served')
+
+    return sql
+
+
+@contextmanager
+def read_only_transaction(conn, read_only=True):
+    '''
+    Takes a connection and whether to restrict it
+    Runs the with block in a START TRANSACTION READ ONLY transaction on the connection,
+    rolled back on exit, so the server refuses any statement in it that would change data
+
+    Note: Does nothing if read_only is False
+    '''
+
+    if not read_only:
+        yield
+        return
+
+    # Close the implicit transaction a pooled connection may still have open
+    conn.rollback()
+    conn.start_transaction(readonly=True)
+    try:
+        yield
+    finally:
+        # A client that hung up mid-stream leaves a result unread: stop it, don't read it
+        if conn.unread_result:
+            cancel_statement(conn, announce=False)
+        conn.rollback()
+
+
+def remote_request(path, payload=None):
+    '''
+    Takes a service path and an optional JSON payload, sent as a POST
+    Returns the open HTTP response from the service at SERVICE_URL
+
+    Note: Errors are raised as mysql.connector errors, as if the query had run here
+    '''
+
+    import urllib.error
+    import urllib.request
+
+    data = None if payload is None else service_encode(payload)
+    headers = {'Content-Type': 'application/json'}
+    if SERVICE_TOKEN is not None:
+        headers['Authorization'] = f'Bearer {SERVICE_TOKEN}'
+    request = urllib.request.Request(SERVICE_URL.rstrip('/') + path, data=data, headers=headers)
+
+    try:
+        return urllib.request.urlopen(request)
+
+    except urllib.error.HTTPError as errMsg:
+        try:
+            error = json.loads(errMsg.read())
+        except ValueError:
+            error = {}
+        raise mysql.connector.errors.DatabaseError(msg=error.get('error', str(errMsg)),
+                                                   errno=error.get('errno'))
+
+    except urllib.error.URLError as errMsg:
+        raise mysql.connector.errors.InterfaceError(
+            msg=f'Query service at {SERVICE_URL} unreachable: {errMsg.reason}')
+
+
+def remote_json(path, payload=None):
+    '''
+    Takes a service path and an optional JSON payload
+    Returns the service's JSON result
+    '''
+
+    with remote_request(path, payload) as response:
+        return json.load(response, object_hook=service_object_hook)
+
+
+def remote_query(query, params=None, analytical=False, ttl=None):
+    '''
+    Takes a SQL query string, optional parameters, whether it is analytical and an optional
+    cache time to live
+    Runs the query on the service, as execute_query (or cached_query, with a ttl) would here
+
+    Returns SQL output as a list of rows
+    '''
+
+    return remote_json('/query', {'sql': query, 'params': params, 'analytical': analytical,
+                                  'ttl': ttl})
+
+
+def remote_stream(query, params=None, batch_size=STREAM_BATCH_SIZE, analytical=False):
+    '''
+    Takes a SQL query string, optional parameters, a batch size and whether it is analytical
+    Streams the query from the service, as stream_query would here
+    Yields SQL output as lists of at most batch_size rows
+    '''
+
+    payload = {'sql': query, 'params': params, 'batch_size': batch_size, 'analytical': analytical}
+
+    with remote_request('/stream', payload) as response:
+        for line in response:
+            batch = json.loads(line, object_hook=service_object_hook)
+            if isinstance(batch, dict):
+                raise mysql.connector.errors.DatabaseError(msg=batch['error'], errno=batch.get('errno'))
+            yield batch
+
+
+def remote_frame(path, payload=None):
+    '''
+    Takes a service path and an optional JSON payload
+    Returns the service's columns and rows result as a pandas DataFrame
+    '''
+
+    result = remote_json(path, payload)
+    return convert_to_df(result['rows'], result['columns'])
+
+
+############################
+## Command Line Functions ##
+############################
+
+
+def build_parser():
+    '''
+    Returns the argparse parser for the non-interactive command line interface
+    Running the script with no command starts the interactive menus
+    '''
+
+    parser = argparse.ArgumentParser(
+        description='Trade System Tools. Run without a command for the interactive menus.')
+    parser.add_argument('--stats', action='store_true',
+                        help='print per-query latency statistics when the command finishes')
+    parser.add_argument('--slow-query-seconds', type=float, default=SLOW_QUERY_SECONDS,
+                        help=f'log queries slower than this to {SLOW_QUERY_LOG}')
+    parser.add_argument('--timeout', type=float, default=QUERY_TIMEOUT_SECONDS, metavar='SECONDS',
+                        help='server-side time limit of each query (0 for none; exports use '
+                             f'{EXPORT_TIMEOUT_SECONDS}s)')
+    parser.add_argument('--max-rows', type=int, default=ADMISSION_MAX_ROWS,
+                        help='ask before running searches and exports estimated to examine more rows')
+    parser.add_argument('--force', action='store_true',
+                        help='run searches and exports over --max-rows without asking')
+    parser.add_argument('--backend', choices=['mysql', 'duckdb'], default=ANALYTICS_BACKEND,
+                        help='run reports, searches and exports on MySQL, or in-process on DuckDB '
+                             "over the local snapshot (see 'maintenance sync-snapshot')")
+    parser.add_argument('--service', metavar='URL',
+                        help="send queries to a running query service (see 'serve'), e.g. "
+                             f"http://{SERVICE_HOST}:{SERVICE_PORT}, instead of connecting to MySQL "
+                             f"(sends {SERVICE_TOKEN_ENV} if set)")
+    parser.add_argument('--names', action='store_true',
+                        help='show and export trades with company, broker and exchange name columns')
+    parser.add_argument('--snapshot', action='store_true',
+                        help=f"answer queries and exports from the local snapshot in {SNAPSHOT_DIR}/ "
+                             "(see 'maintenance sync-snapshot')")
+    commands = parser.add_subparsers(dest='command')
+
+    # Trade filters shared by search and export
+    filters = argparse.ArgumentParser(add_help=False)
+    filters.add_argument('--share', nargs='+', type=int, default=[], metavar='ID',
+                         help='one or more share IDs')
+    filters.add_argument('--broker', nargs='+', type=int, default=[], metavar='ID',
+                         help='one or more broker IDs')
+    filters.add_argument('--from', dest='start', type=parse_date, metavar='DDMMYYYY',
+                         help='first transaction date (inclusive)')
+    filters.add_argument('--to', dest='end', type=parse_date, metavar='DDMMYYYY',
+                         help='last transaction date (inclusive)')
+
+    query = commands.add_parser('query', help='run a query and print the result')
+    query.set_defaults(func=command_query)
+    queries = query.add_subparsers(dest='query', required=True)
+    queries.add_parser('brokers', help='list all brokers')
+    queries.add_parser('shares', help='list all shares')
+    company = queries.add_parser('company', help='find shares by company name (prefix or fuzzy)')
+    company.add_argument('name', nargs='+', help='company name, or the start of one')
+    trade = queries.add_parser('trade', help='look up trades by trade ID')
+    trade.add_argument('trade_ids', nargs='*', metavar='TRADE_ID',
+                       help='trade IDs or inclusive ranges (1000-2000)')
+    trade.add_argument('--file', help='read trade IDs and ranges from this file')
+    trade.add_argument('--out', help='write the trades to this file (.csv, .csv.gz, .parquet, ...) '
+                                     'instead of stdout')
+    search = queries.add_parser('search', parents=[filters],
+                                help='search trades by share, broker and date range')
+    search.add_argument('--page-size', type=int, metavar='N',
+                        help='show the trades N at a time, asking before each next page')
+
+    export = commands.add_parser('export', parents=[filters],
+                                 help='export trades to a .xlsx, Parquet, Arrow or compressed CSV file')
+    export.add_argument('--out', help='output filename (default: generated from the filters)')
+    export.add_argument('--format', choices=EXPORT_FORMATS, default='auto',
+                        help="file format; 'auto' follows the --out extension, else uses Parquet "
+                             "when the trades do not fit on one Excel sheet")
+    export.add_argument('--compression', choices=['zstd', 'snappy'], default=PARQUET_COMPRESSION,
+                        help='Parquet compression codec')
+    export.add_argument('--workers', type=int, default=1,
+                        help='fetch partitions of the export in this many worker processes')
+    export.set_defaults(func=command_export)
+
+    report = commands.add_parser('report', help='generate a report chart')
+    report.add_argument('report', choices=sorted(REPORTS) + ['all'],
+                        help="report to generate; 'all' renders every report, including one price chart per share")
+    report.add_argument('--share', nargs='+', type=int, metavar='ID',
+                        help='one or more share IDs to overlay (price-history only)')
+    report.add_argument('--resample', choices=['raw', 'daily', 'weekly'], default='raw',
+                        help='price history resolution; daily/weekly are OHLC buckets computed by the server')
+    report.add_argument('--max-points', type=int, default=MAX_PLOT_POINTS,
+                        help='most points plotted per share (LTTB downsampling)')
+    report.add_argument('--out', help='save the chart to this file instead of displaying it')
+    report.add_argument('--out-dir', default='reports', help="output directory ('all' only)")
+    report.add_argument('--format', choices=['png', 'svg'], default='png',
+                        help="image format ('all' only)")
+    report.set_defaults(func=command_report)
+
+    value = commands.add_parser('value', parents=[filters],
+                                help='mark trades to market and print their unrealized P&L')
+    value.add_argument('--at', type=parse_date, metavar='DDMMYYYY',
+                       help='valuation date (default: the latest price of each share)')
+    value.add_argument('--by', nargs='+', choices=['trade', 'share', 'broker'],
+                       default=['share', 'broker'], help='breakdowns to print')
+    value.add_argument('--out', help='write the valued trades to this file (.csv, .parquet, ...)')
+    value.set_defaults(func=command_value)
+
+    analytics = commands.add_parser('analytics', parents=[filters],
+                                    help='print a trade analytics report computed by the database')
+    analytics.add_argument('report', choices=sorted(ANALYTICS_REPORTS))
+    analytics.add_argument('--window', type=int, default=ROLLING_WINDOW_DAYS,
+                           help='trading days in the rolling volume window (rolling-volume only)')
+    analytics.add_argument('--top', type=int, default=TOP_MOVERS,
+                           help='gainers and losers to show (top-movers only)')
+    analytics.add_argument('--out', help='also write the report to this file (.csv, .parquet, ...)')
+    analytics.set_defaults(func=command_analytics)
+
+    maintenance = commands.add_parser('maintenance', help='database maintenance tasks')
+    maintenance.add_argument('task', choices=['refresh-summaries', 'sync-snapshot', 'advise-indexes'])
+    maintenance.add_argument('--yes', action='store_true',
+                             help='advise-indexes: create missing indexes without asking')
+    maintenance.set_defaults(func=command_maintenance)
+
+    service = commands.add_parser('serve', help='serve queries, searches, exports and reports to '
+                                                'other copies of this tool over local HTTP/JSON')
+    service.add_argument('--host', default=SERVICE_HOST,
+                         help=f'address to listen on (other than loopback, needs {SERVICE_TOKEN_ENV} set)')
+    service.add_argument('--port', type=int, default=SERVICE_PORT, help='port to listen on')
+    service.add_argument('--pool-size', type=int, default=POOL_SIZE,
+                         help='database connections shared by all clients')
+    service.set_defaults(func=command_serve)
+
+    return parser
+
+
+def get_date_filter(args):
+    '''
+    Takes parsed command line arguments and returns the inclusive (start, end) date range
+    given by --from/--to, or None if neither was given
+    '''
+
+    if args.start is None and args.end is None:
+        return None
+
+    return (args.start or date.min, args.end or date.max - timedelta(days=1))
+
+
+def command_query(args):
+    '''
+    Runs the query command and returns an exit status
+    '''
+
+    if args.query == 'brokers':
+        return list_all_brokers()
+
+    if args.query == 'shares':
+        return list_all_shares()
+
+    if args.query == 'company':
+        return print_company_matches(' '.join(args.name))
+
+    if args.query == 'trade':
+        try:
+            trade_ids, ranges = read_trade_ids(' '.join(args.trade_ids))
+            if args.file is not None:
+                with open(args.file) as id_file:
+                    more_ids, more_ranges = read_trade_ids(id_file.read())
+                trade_ids += more_ids
+                ranges += more_ranges
+        except (ValueError, OSError) as errMsg:
+            print(f'\n(!!!!!) {errMsg}\n')
+            return 2
+
+        if not (trade_ids or ranges):
+            print('\n(!!!!!) Not enough details provided!\n')
+            return 2
+        return lookup_trades(trade_ids, ranges, args.out)
+
+    date_range = get_date_filter(args)
+    if not (args.share or args.broker or date_range):
+        print('\n(!!!!!) Not enough details provided!\n')
+        return 2
+
+    if args.page_size:
+        return print_trade_pages(args.share, args.broker, date_range, args.page_size)
+
+    return print_trades(share_ids=args.share, broker_ids=args.broker, date_range=date_range)
+
+
+def command_export(args):
+    '''
+    Runs the export command and returns an exit status
+    '''
+
+    global PARQUET_COMPRESSION
+
+    PARQUET_COMPRESSION = args.compression
+    export_trades(args.share, args.broker, get_date_filter(args), args.out, launch=False,
+                  workers=args.workers, fmt=args.format)
+    return 0
+
+
+def command_report(args):
+    '''
+    Runs the report command and returns an exit status
+    '''
+
+    if args.report == 'all':
+        filenames = render_all_reports(args.out_dir, args.format, args.resample, args.max_points)
+        print(f"\n>>>>> Rendered {len(filenames)} reports to {args.out_dir}\n")
+        return 0
+
+    # Charts saved to a file do not need a display
+    if args.out is not None:
+        set_headless()
+
+    if args.report == 'price-history':
+        if not args.share or not all(is_valid_share_id(share_id) for share_id in args.share):
+            print("\n(!!!!!) Please give valid Share IDs with --share!\n")
+            return 2
+        return plot_share_price_history(args.share, args.out, args.resample, args.max_points)
+
+    return REPORTS[args.report](args.out)
+
+
+def command_value(args):
+    '''
+    Runs the value command and returns an exit status
+    '''
+
+    return print_valuation(args.share, args.broker, get_date_filter(args), args.at, args.by, args.out)
+
+
+def command_analytics(args):
+    '''
+    Runs the analytics command and returns an exit status
+    '''
+
+    if args.window < 1 or args.top < 1:
+        print('\n(!!!!!) --window and --top must be at least 1!\n')
+        return 2
+
+    return print_analytics(args.report, args.share, args.broker, get_date_filter(args),
+                           args.window, args.top, args.out)
+
+
+def command_maintenance(args):
+    '''
+    Runs the maintenance command and returns an exit status
+    '''
+
+    if args.task == 'refresh-summaries':
+        new_trades = refresh_trade_summaries()
+        print(f"\n>>>>> Summary tables refreshed! New trades: {new_trades}\n")
+
+    if args.task == 'sync-snapshot':
+        for table, rows in sync_snapshot().items():
+            print(f">>>>> {table}: {rows} rows pulled")
+        print(snapshot_freshness())
+
+    if args.task == 'advise-indexes':
+        advise_indexes(create=args.yes)
+
+    return 0
+
+
+def command_serve(args):
+    '''
+    Runs the serve command and returns an exit status
+    '''
+
+    global POOL_SIZE
+
+    POOL_SIZE = args.pool_size
+    return serve(args.host, args.port)
+
+
+def main(argv=None):
+    '''
+    Runs the command given on the command line, or the interactive menus if there is none
+
+    Returns an exit status
+    '''
+
+    global SLOW_QUERY_SECONDS, SNAPSHOT, ANALYTICS_BACKEND, SERVICE_URL, SERVICE_TOKEN
+    global QUERY_TIMEOUT_SECONDS, ADMISSION_MAX_ROWS, ADMISSION_FORCE, ENRICH_TRADES
+
+    args = build_parser().parse_args(argv)
+    SLOW_QUERY_SECONDS = args.slow_query_seconds
+    QUERY_TIMEOUT_SECONDS = args.timeout
+    ADMISSION_MAX_ROWS = args.max_rows
+    ADMISSION_FORCE = args.force
+    ENRICH_TRADES = args.names
+    SNAPSHOT = args.snapshot
+    ANALYTICS_BACKEND = args.backend
+    SERVICE_URL = args.service if args.command != 'serve' else None
+    SERVICE_TOKEN = os.environ.get(SERVICE_TOKEN_ENV) or None
+
+    if (SNAPSHOT or ANALYTICS_BACKEND == 'duckdb') and args.command != 'maintenance':
+        if read_snapshot_state() is None:
+            print(snapshot_freshness())
+            return 2
+        if not SNAPSHOT:
+            print(snapshot_freshness())
+
+    if args.command is None:
+        run_menus()
+        return 0
+
+    try:
+        return args.func(args) or 0
+
+    except KeyboardInterrupt:
+        print('\n(!!!!!) Cancelled!\n')
+        return 130
+
+    except mysql.connector.Error as errMsg:
+        if errMsg.errno not in (ER_QUERY_TIMEOUT, ER_QUERY_INTERRUPTED):
+            raise
+        print(f'\n(!!!!!) Query stopped by the server: {errMsg.msg}\n')
+        return 1
 
-        main_menu()
+    finally:
+        if args.stats:
+            print_query_stats()
+        close_pool()
+
+
+# Interactive menus by name, as returned from each menu function
+MENUS = {
+    'main': main_menu,
+    'query': query_menu,
+    'export': export_trade_data,
+    'reporting': reporting_menu,
+    'exit': exit_program
+}
+
+# Valid selections of each menu
+MENU_CHOICES = {
+    'main': '1234',
+    'query': '1234567',
+    'reporting': '123456789'
+}
+
+# Export file writers by format
+EXPORT_WRITERS = {
+    'xlsx': write_excel_stream,
+    'parquet': write_parquet_stream,
+    'arrow': write_arrow_stream,
+    'csv.gz': write_csv_gz_stream,
+    'csv.zst': write_csv_zst_stream,
+    'csv': write_csv_file_stream
+}
+
+# Reports available from the command line
+REPORTS = {
+    'broker-hist': trades_per_broker_hist,
+    'price-history': plot_share_price_history,
+    'exchange-pie': trade_proportion
+}
+
+# Analytics reports by name, with their titles
+ANALYTICS_REPORTS = {
+    'vwap': (vwap_report, 'VWAP per share per day'),
+    'rolling-volume': (rolling_volume_report, 'Rolling traded volume per share'),
+    'broker-turnover': (broker_turnover_report, 'Broker turnover and notional'),
+    'top-movers': (top_movers_report, 'Top movers by daily VWAP')
+}
+
+# Query service routes by path, with their response content type; JSON routes are answered
+# whole (and coalesced), the others are streamed
+SERVICE_ROUTES = {
+    '/query': (route_query, 'application/json'),
+    '/explain': (route_explain, 'application/json'),
+    '/stream': (route_stream, 'application/x-ndjson'),
+    '/brokers': (lambda params: route_reference('brokers'), 'application/json'),
+    '/shares': (lambda params: route_reference('shares'), 'application/json'),
+    '/trades': (route_trades, 'application/x-ndjson'),
+    '/search': (route_search, 'application/x-ndjson'),
+    '/export': (route_export, 'text/csv'),
+    '/reports/broker-counts': (route_broker_counts, 'application/json'),
+    '/reports/exchange-counts': (route_exchange_counts, 'application/json'),
+    '/reports/price-history': (route_price_history, 'application/json')
+}
+
+# Tagged JSON values sent to and from the query service, by tag
+SERVICE_TYPES = {
+    '$datetime': datetime.fromisoformat,
+    '$date': date.fromisoformat,
+    '$decimal': Decimal
+}
 
 
 ##########
 ## Main ##
 ##########
 
-main()
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,20 @@
+import importlib.util
+import os
+
+import pytest
+
+
+TOOLS_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                          'Trade System Tools.py')
+
+
+@pytest.fixture(scope='session')
+def tools():
+    '''
+    Loads Trade System Tools as a module without starting its menus
+    '''
+
+    spec = importlib.util.spec_from_file_location('trade_system_tools', TOOLS_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
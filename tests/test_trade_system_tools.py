@@ -0,0 +1,389 @@
+import os
+import pickle
+import re
+import sqlite3
+from datetime import date, datetime, timedelta
+
+import numpy as np
+import pytest
+
+
+##################
+## Downsampling ##
+##################
+
+
+def test_lttb_empty_input(tools):
+    kept = tools.lttb(np.array([]), np.array([]), 10)
+    assert kept.tolist() == []
+
+
+def test_lttb_single_point(tools):
+    kept = tools.lttb(np.array([1.0]), np.array([5.0]), 10)
+    assert kept.tolist() == [0]
+
+
+def test_lttb_keeps_ends_and_threshold_points(tools):
+    x = np.arange(100, dtype=float)
+    y = np.sin(x / 5)
+    kept = tools.lttb(x, y, 10)
+
+    assert len(kept) == 10
+    assert kept[0] == 0 and kept[-1] == 99
+    assert (np.diff(kept) > 0).all()
+
+
+def test_lttb_keeps_spike(tools):
+    x = np.arange(50, dtype=float)
+    y = np.zeros(50)
+    y[23] = 100.0
+    assert 23 in tools.lttb(x, y, 5).tolist()
+
+
+def test_lttb_short_series_unchanged(tools):
+    x = np.arange(5, dtype=float)
+    assert tools.lttb(x, x, 10).tolist() == [0, 1, 2, 3, 4]
+
+
+#########################
+## Partitioned Exports ##
+#########################
+
+
+def write_partition(path, batches):
+    with open(path, 'wb') as file:
+        for batch in batches:
+            pickle.dump(batch, file)
+
+
+def fake_partitions(partition_rows):
+    '''
+    Returns a stand-in for run_export_partitions writing the given rows as each
+    partition's output instead of querying
+    '''
+
+    def run_export_partitions(partitions, workers, workdir):
+        paths = []
+        for index, rows in enumerate(partition_rows):
+            path = os.path.join(workdir, f'partition_{index:05d}.pickle')
+            write_partition(path, [rows[start:start + 2] for start in range(0, len(rows), 2)])
+            paths.append(path)
+        return paths
+
+    return run_export_partitions
+
+
+def test_read_partition_empty_file(tools, tmp_path):
+    path = tmp_path / 'partition.pickle'
+    write_partition(path, [])
+    assert list(tools.read_partition(path)) == []
+
+
+def test_parallel_stream_merges_on_trade_id(tools, monkeypatch):
+    partition_rows = [[(1, 'a'), (4, 'd'), (7, 'g')], [(2, 'b'), (3, 'c')], [], [(5, 'e'), (6, 'f')]]
+    monkeypatch.setattr(tools, 'STREAM_BATCH_SIZE', 3)
+    monkeypatch.setattr(tools, 'partition_trade_filters',
+                        lambda *args: [{'share_ids': [index]} for index in range(len(partition_rows))])
+    monkeypatch.setattr(tools, 'run_export_partitions', fake_partitions(partition_rows))
+
+    batches = list(tools.parallel_stream_trades([('SELECT', None)], None, None, None, 4))
+
+    assert [len(batch) for batch in batches] == [3, 3, 1]
+    assert [row[0] for batch in batches for row in batch] == list(range(1, 8))
+
+
+def test_parallel_stream_concatenates_split_statements(tools, monkeypatch):
+    partition_rows = [[(5, 'e'), (9, 'i')], [(1, 'a'), (2, 'b')]]
+    monkeypatch.setattr(tools, 'run_export_partitions', fake_partitions(partition_rows))
+
+    batches = list(tools.parallel_stream_trades([('SELECT 1', None), ('SELECT 2', None)],
+                                                None, None, None, 2))
+
+    assert [row[0] for batch in batches for row in batch] == [5, 9, 1, 2]
+
+
+def test_partition_filters_split_share_ids(tools):
+    parts = tools.partition_trade_filters([5, 1, 3, 2, 4], None, None, 2)
+    assert [part['share_ids'] for part in parts] == [[1, 2], [3, 4, 5]]
+
+
+def test_partition_filters_split_date_range(tools, monkeypatch):
+    monkeypatch.setattr(tools, 'trade_bounds', lambda filters, column: (
+        datetime(2024, 1, 3, 9, 30), datetime(2024, 1, 9, 17, 0)))
+
+    parts = tools.partition_trade_filters(None, None, (date(2024, 1, 1), date(2024, 1, 31)), 3)
+
+    ranges = [part['date_range'] for part in parts]
+    assert ranges[0][0] == date(2024, 1, 3) and ranges[-1][1] == date(2024, 1, 9)
+    assert all(low <= high for low, high in ranges)
+    assert all(ranges[index + 1][0] == ranges[index][1] + timedelta(days=1)
+               for index in range(len(ranges) - 1))
+
+
+def test_partition_filters_split_trade_ids(tools, monkeypatch):
+    monkeypatch.setattr(tools, 'trade_bounds', lambda filters, column: (10, 19))
+
+    parts = tools.partition_trade_filters(None, [7], None, 4)
+
+    ranges = [range_ for part in parts for range_ in part['trade_id_ranges']]
+    assert ranges[0][0] == 10 and ranges[-1][1] == 19
+    assert all(ranges[index + 1][0] == ranges[index][1] + 1 for index in range(len(ranges) - 1))
+
+
+def test_partition_filters_no_trades(tools, monkeypatch):
+    monkeypatch.setattr(tools, 'trade_bounds', lambda filters, column: (None, None))
+    assert tools.partition_trade_filters(None, None, None, 4) == [
+        {'share_ids': None, 'broker_ids': None, 'date_range': None}]
+
+
+###################
+## Trade Queries ##
+###################
+
+
+def test_trade_queries_no_filters(tools):
+    assert tools.build_trade_queries() == [('SELECT * FROM trades;', [])]
+
+
+def test_trade_queries_chunk_every_long_list(tools, monkeypatch):
+    monkeypatch.setattr(tools, 'MAX_IN_LIST', 3)
+
+    queries = tools.build_trade_queries(trade_ids=range(1, 8), share_ids=range(1, 6), broker_ids=[1, 2])
+
+    assert len(queries) == 3 * 2 * 1
+    for sql, params in queries:
+        assert all(in_list.count('%s') <= 3 for in_list in re.findall(r'IN \(([^)]*)\)', sql))
+
+
+def test_trade_queries_select_each_trade_once(tools, monkeypatch):
+    monkeypatch.setattr(tools, 'MAX_IN_LIST', 3)
+    trades = [(trade_id, trade_id % 7, trade_id % 3) for trade_id in range(1, 61)]
+    trade_ids, share_ids, broker_ids = range(5, 50, 2), [1, 2, 3, 4, 5], [0, 2]
+
+    conn = sqlite3.connect(':memory:')
+    conn.execute('CREATE TABLE trades (trade_id, share_id, broker_id);')
+    conn.executemany('INSERT INTO trades VALUES (?, ?, ?);', trades)
+    found = [row[0] for sql, params in tools.build_trade_queries(trade_ids, share_ids, broker_ids)
+             for row in conn.execute(sql.replace('%s', '?'), params)]
+    conn.close()
+
+    assert sorted(found) == [trade_id for trade_id, share_id, broker_id in trades
+                             if trade_id in trade_ids and share_id in share_ids and broker_id in broker_ids]
+
+
+######################
+## Trade ID Lookups ##
+######################
+
+
+def test_group_trade_ids_merges_overlapping_ranges(tools):
+    assert tools.group_trade_ids([], [(3, 8), (1, 5)]) == ([], [(1, 8)])
+
+
+def test_group_trade_ids_merges_adjacent_ranges(tools):
+    assert tools.group_trade_ids([], [(6, 9), (1, 5)]) == ([], [(1, 9)])
+
+
+def test_group_trade_ids_merges_nested_ranges(tools):
+    assert tools.group_trade_ids([], [(1, 10), (3, 4)]) == ([], [(1, 10)])
+
+
+def test_group_trade_ids_turns_runs_into_ranges(tools):
+    assert tools.group_trade_ids([20, 7, 3, 5, 4, 3]) == ([7, 20], [(3, 5)])
+
+
+def test_group_trade_ids_merges_run_adjacent_to_range(tools):
+    assert tools.group_trade_ids([11, 12, 13], [(1, 10)]) == ([], [(1, 13)])
+
+
+def test_group_trade_ids_drops_covered_ids(tools):
+    assert tools.group_trade_ids([1, 4, 10, 50], [(1, 10)]) == ([50], [(1, 10)])
+
+
+def test_group_trade_ids_empty(tools):
+    assert tools.group_trade_ids([]) == ([], [])
+
+
+def test_lookup_queries_chunk_ranges(tools, monkeypatch):
+    monkeypatch.setattr(tools, 'MAX_IN_LIST', 4)
+    ranges = [(low, low + 1) for low in range(0, 60, 10)]
+
+    queries = tools.build_trade_lookup_queries([100, 200], ranges)
+
+    assert len(queries) == 4
+    assert all(len(params) <= 4 for _, params in queries)
+    assert sorted(param for _, params in queries for param in params) == sorted(
+        [100, 200] + [bound for range_ in ranges for bound in range_])
+
+
+#######################
+## Keyset Pagination ##
+#######################
+
+
+def rows_after(tools, rows, columns, key):
+    '''
+    Returns the rows matching keyset_predicate(columns, key), evaluated by SQLite
+    '''
+
+    condition, params = tools.keyset_predicate(columns, key)
+    conn = sqlite3.connect(':memory:')
+    conn.execute(f"CREATE TABLE t ({', '.join(columns)});")
+    conn.executemany(f"INSERT INTO t VALUES ({', '.join('?' * len(columns))});", rows)
+    found = conn.execute(f"SELECT * FROM t WHERE {condition.replace('%s', '?')};", params).fetchall()
+    conn.close()
+    return sorted(found)
+
+
+def test_keyset_predicate_shape(tools):
+    assert tools.keyset_predicate(['a', 'b'], (1, 2)) == ('(a > %s) OR (a = %s AND b > %s)', [1, 1, 2])
+
+
+def test_keyset_predicate_ties_on_first_column(tools):
+    rows = [(1, 1), (1, 5), (2, 1), (2, 2), (2, 3), (3, 0)]
+    assert rows_after(tools, rows, ['a', 'b'], (2, 2)) == [(2, 3), (3, 0)]
+
+
+def test_keyset_predicate_ties_on_every_column(tools):
+    rows = [(1, 1, 1), (1, 1, 2), (1, 2, 0), (1, 1, 1)]
+    assert rows_after(tools, rows, ['a', 'b', 'c'], (1, 1, 1)) == [(1, 1, 2), (1, 2, 0)]
+
+
+def test_keyset_predicate_pages_cover_every_row(tools):
+    rows = sorted((day % 2, trade_id) for day in range(4) for trade_id in range(day * 10, day * 10 + 5))
+    page = []
+    key = (-1, -1)
+
+    while True:
+        found = rows_after(tools, rows, ['a', 'b'], key)[:3]
+        if not found:
+            break
+        page += found
+        key = found[-1]
+
+    assert page == rows
+
+
+#########################
+## Company Name Search ##
+#########################
+
+
+COMPANIES = {
+    1: 'Acme, Inc.', 2: 'Acme, Inc.', 3: '3M Company', 4: 'Globex', 5: '7-Eleven',
+    6: 'Acme Industries', 7: 'Company 1', 8: 'Company 12'
+}
+
+
+@pytest.fixture
+def name_index(tools, monkeypatch):
+    '''
+    Replaces the company name index with one over COMPANIES, indexed by share_id
+    '''
+
+    names = np.array(sorted(set(COMPANIES.values())), dtype=object)
+    index = np.full(max(COMPANIES) + 1, -1)
+    for share_id, name in COMPANIES.items():
+        index[share_id] = names.tolist().index(name)
+
+    built = tools.build_name_index(index, names)
+    monkeypatch.setattr(tools, 'get_name_index', lambda: built)
+    return built
+
+
+def test_search_companies_exact_name_with_comma(tools, name_index):
+    assert tools.search_companies('acme, inc.')[0] == ('Acme, Inc.', [1, 2])
+
+
+def test_search_companies_prefix_ranks_shorter_first(tools, name_index):
+    assert [name for name, _ in tools.search_companies('Acme')] == ['Acme, Inc.', 'Acme Industries']
+
+
+def test_search_companies_word_prefix(tools, name_index):
+    assert [name for name, _ in tools.search_companies('inc')] == ['Acme, Inc.']
+
+
+def test_search_companies_name_with_digits(tools, name_index):
+    assert tools.search_companies('3m')[0] == ('3M Company', [3])
+    assert tools.search_companies('company 1')[:2] == [('Company 1', [7]), ('Company 12', [8])]
+
+
+def test_search_companies_misspelling(tools, name_index):
+    assert tools.search_companies('Globx')[0] == ('Globex', [4])
+
+
+def test_search_companies_blank(tools, name_index):
+    assert tools.search_companies('   ') == []
+
+
+def test_parse_share_ids_numbers(tools, name_index):
+    assert tools.parse_share_ids('4 5 6') == [4, 5, 6]
+
+
+def test_parse_share_ids_names_with_commas_and_numbers(tools, name_index, capsys):
+    assert tools.parse_share_ids('Acme, Inc.; 4 5; 3M Company') == [1, 2, 4, 5, 3]
+
+
+def test_parse_share_ids_names_with_digits(tools, name_index, capsys):
+    assert tools.parse_share_ids('7-Eleven; Company 1') == [5, 7]
+
+
+def test_parse_share_ids_unknown_name(tools, name_index):
+    with pytest.raises(AssertionError):
+        tools.parse_share_ids('Initech')
+
+
+def test_parse_share_ids_empty(tools, name_index):
+    with pytest.raises(AssertionError):
+        tools.parse_share_ids(' ; ')
+
+
+####################
+## Price Matching ##
+####################
+
+
+@pytest.fixture
+def series(tools):
+    '''
+    Price series of share 1 with a gap between its first two intervals and an open last
+    one, and of share 2 with a single closed interval
+    '''
+
+    import pandas as pd
+
+    prices = pd.DataFrame([
+        (1, 12.0, datetime(2024, 1, 3), datetime(2024, 1, 4)),
+        (1, 10.0, datetime(2024, 1, 1), datetime(2024, 1, 2)),
+        (1, 15.0, datetime(2024, 1, 4), None),
+        (2, 99.0, datetime(2024, 1, 1), datetime(2024, 1, 5))
+    ], columns=tools.SHARE_PRICE_COLUMNS)
+    prices['Time End'] = pd.to_datetime(prices['Time End'])
+    return tools.price_series(prices)
+
+
+def nanoseconds(*times):
+    return np.array([np.datetime64(time, 'ns').astype('int64') for time in times])
+
+
+def test_prices_at_gaps_have_no_price(tools, series):
+    times = nanoseconds(datetime(2023, 12, 31), datetime(2024, 1, 1, 12), datetime(2024, 1, 2),
+                        datetime(2024, 1, 2, 12), datetime(2024, 1, 3, 12), datetime(2024, 2, 1))
+    prices = tools.prices_at(series, np.ones(len(times), dtype=np.int64), times)
+
+    np.testing.assert_array_equal(prices, [np.nan, 10.0, np.nan, np.nan, 12.0, 15.0])
+
+
+def test_prices_at_unbounded_carries_last_price(tools, series):
+    times = nanoseconds(datetime(2023, 12, 31), datetime(2024, 1, 2, 12))
+    prices = tools.prices_at(series, np.array([1, 1]), times, bounded=False)
+
+    np.testing.assert_array_equal(prices, [np.nan, 10.0])
+
+
+def test_prices_at_mixed_and_unknown_shares(tools, series):
+    times = nanoseconds(datetime(2024, 1, 6), datetime(2024, 1, 3, 12), datetime(2024, 1, 2),
+                        datetime(2024, 1, 1, 12))
+    prices = tools.prices_at(series, np.array([2, 1, 3, 2]), times)
+
+    np.testing.assert_array_equal(prices, [np.nan, 12.0, np.nan, 99.0])